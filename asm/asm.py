@@ -16,6 +16,32 @@
 
 import sys
 import re
+import io
+import os
+import struct
+import tempfile
+import hashlib
+import argparse
+import itertools
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+# Bump when the output for a given source changes, so cached results from
+# older versions are not reused
+ASM_VERSION = "4.0.1"
+
+# Where --cache keeps assembled results, keyed by a hash of the source,
+# unless --cache-dir or $LS8_ASM_CACHE says otherwise. The cache is off
+# unless one of those is given
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "ls8-asm")
+
+# Most entries the cache keeps; the least recently used go first
+CACHE_ENTRIES = 512
+
+# Output lines buffered before they're written out, and the block size
+# sources are read in for hashing
+CHUNK_LINES = 4096
+CHUNK_BYTES = 1 << 16
 
 # Opcodes
 OPCODES = {
@@ -58,37 +84,86 @@ OPCODES = {
 # Regex for matching lines
 # Capturing groups: label, opcode, operandA, operandB
 REGEX = r"(?:(\w+?):)?\s*(?:(\w+)\s*(?:(\w+)(?:\s*,\s*(\w+))?)?)?"
+LINE_RE = re.compile(REGEX)
+
+# Binary image header; must match ls8/image.py
+IMAGE_MAGIC = b"LS8\x00"
+IMAGE_VERSION = 1
+IMAGE_HEADER = struct.Struct("<4sBBHHI")
+IMAGE_FLAG_CHECKSUM = 0b00000001
 
 # Regex for capturing DS and DB data
 REGEX_DS = r"(?:(\w+?):)?\s*DS\s*(.+)"  # insensitive
 REGEX_DB = r"(?:(\w+?):)?\s*DB\s*(.+)"  # insensitive
+DS_RE = re.compile(REGEX_DS, re.IGNORECASE)
+DB_RE = re.compile(REGEX_DB, re.IGNORECASE)
+
+# Register operands
+REG_RE = re.compile(r"R([0-7])")
+REGISTERS = {f"R{n}": n for n in range(8)}
 
 
 def parse_commandline(argv):
     """
-    Usage: asm.py [inputfile] [outputfile]
+    Usage: asm.py [-b] [-O] [--cache] [--cache-dir DIR] [--no-cache]
+                  [inputfile] [outputfile]
+           asm.py [-b] [-O] [--cache] [--cache-dir DIR] [--no-cache]
+                  [-j N] -o OUTDIR inputfile...
+           asm.py [-b] [-O] [--cache] [--cache-dir DIR] [--no-cache]
+                  [-j N] --build SRCDIR OUTDIR
+
+    -b writes a binary image instead of the text .ls8 format
+    -O runs the peephole optimiser
+    --cache reuses results for sources assembled before, kept in
+    $LS8_ASM_CACHE, or ~/.cache/ls8-asm if that's unset
+    --cache-dir keeps them in DIR instead, and turns the cache on too,
+    as setting $LS8_ASM_CACHE does; --no-cache turns it off again. Input
+    from stdin is never cached
+    -o assembles each input file into a .ls8 file of the same name in
+    OUTDIR
+    --build assembles every .asm file in SRCDIR into OUTDIR, rebuilding
+    only the files whose source changed
+    -j sets how many files -o and --build assemble at once (default: one
+    per CPU)
     """
 
-    if len(argv) == 1:
-        inputfile = "-"
-        outputfile = "-"
-
-    elif len(argv) == 2:
-        inputfile = argv[1]
-        outputfile = "-"
-
-    elif len(argv) == 3:
-        inputfile = argv[1]
-        outputfile = argv[2]
-
+    options = "[-b] [-O] [--cache] [--cache-dir DIR] [--no-cache]"
+    parser = argparse.ArgumentParser(
+        prog="asm.py",
+        usage=f"asm.py {options}\n"
+              "              [infile.asm] [outfile.ls8]\n"
+              f"       asm.py {options}\n"
+              "              [-j N] -o OUTDIR infile.asm...\n"
+              f"       asm.py {options}\n"
+              "              [-j N] --build SRCDIR OUTDIR")
+    parser.add_argument("-b", dest="binary", action="store_true")
+    parser.add_argument("-O", dest="optimise", action="store_true")
+    parser.add_argument("--cache", action="store_true")
+    parser.add_argument("--cache-dir",
+                        default=os.environ.get("LS8_ASM_CACHE"))
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--build", nargs=2, metavar=("SRCDIR", "OUTDIR"))
+    parser.add_argument("-o", dest="out_dir")
+    parser.add_argument("-j", dest="jobs", type=int)
+    parser.add_argument("files", nargs="*")
+
+    args = parser.parse_args(argv[1:])
+
+    # args.cache ends up as the cache directory, or None for no cache
+    if args.no_cache or not (args.cache or args.cache_dir):
+        args.cache = None
     else:
-        print("usage: asm.py [infile.asm] [outfile.ls8]", file=sys.stderr)
-        sys.exit(1)
+        args.cache = args.cache_dir or DEFAULT_CACHE_DIR
 
-    return inputfile, outputfile
+    if args.out_dir is None:
+        if len(args.files) > 2:
+            parser.error("more than one input file needs -o OUTDIR")
+        args.inputfile, args.outputfile = (args.files + ["-", "-"])[:2]
+
+    return args
 
 
-def open_files(inputfile, outputfile):
+def open_files(inputfile, outputfile, binary=False):
     """
     Open files for reading and writing. If either of the files are named "-",
     stdin or stdout is returned as appropriate.
@@ -100,127 +175,400 @@ def open_files(inputfile, outputfile):
         inputfile = open(inputfile)
 
     if outputfile == "-":
-        outputfile = sys.stdout
+        outputfile = sys.stdout.buffer if binary else sys.stdout
     else:
-        outputfile = open(outputfile, "w")
+        outputfile = open(outputfile, "wb" if binary else "w")
 
     return inputfile, outputfile
 
 
-def normalize_line(groups):
+def p8(v):
+    return "{:08b}".format(v)
+
+
+# p8 of every byte, for the operands that are always in range
+BITS = [p8(v) for v in range(256)]
+
+
+# Peephole optimiser
+#
+# Works on the parsed items from pass 1, before any addresses are given
+# out, so labels and the symbol table come out consistent with the
+# shortened code. Removing instructions moves everything after them, so
+# optimised programs must refer to code addresses through labels only.
+
+# Instructions that never fall through to the next one
+NO_FALLTHROUGH = {"HLT", "JMP", "RET", "IRET"}
+
+# Instructions that change the register in their first operand
+WRITES_REG_A = {"ADD", "AND", "DEC", "DIV", "INC", "LD", "MOD", "MUL",
+                "NOT", "OR", "POP", "SHL", "SHR", "SUB", "XOR"}
+
+# Instructions that change the stack pointer (R7)
+WRITES_SP = {"PUSH", "POP"}
+
+
+def reg_num(op):
+    """Register number for an operand, or None if it isn't a register"""
+
+    m = REG_RE.match(op or "")
+
+    return None if m is None else int(m.group(1))
+
+
+def ldi_value(op_b):
+    """LDI operand as a number, or the symbol name"""
+
+    try:
+        return int(op_b, 0)
+    except ValueError:
+        return op_b
+
+
+def drop_nops(items):
+    return [item for item in items
+            if item[0] != "op" or item[1] != "NOP"]
+
+
+def drop_unreachable(items):
     """
-    Takes match groups and uppercases them if they're not None.
+    Drop instructions after HLT, JMP, RET and IRET up to the next label.
+    Data is kept, since it may be reached through an address.
     """
 
     result = []
+    reachable = True
+
+    for item in items:
+        if item[0] != "op":
+            reachable = True
+        elif not reachable:
+            continue
+        elif item[1] in NO_FALLTHROUGH:
+            reachable = False
+
+        result.append(item)
+
+    return result
+
 
-    for g in groups:
-        if g is None:
-            result.append(None)
+def thread_jumps(items):
+    """
+    Retarget "LDI Rn,A / JMP Rn" when A starts with "LDI Rn,B / JMP Rn",
+    so the jump goes straight to B. Only unconditional jumps through the
+    same register are threaded: Rn ends up holding B either way.
+    """
+
+    # first item after each label that isn't a label itself
+    starts = {}
+    pending = []
+    for i, item in enumerate(items):
+        if item[0] == "label":
+            pending.append(item[1])
         else:
-            result.append(g.upper())
+            for label in pending:
+                starts[label] = i
+            pending = []
+
+    def jump_at(i):
+        """(register, target) for an LDI/JMP pair at i, or None"""
+
+        if i is None or i + 1 >= len(items):
+            return None
+
+        ldi, jmp = items[i], items[i + 1]
+        if ldi[0] != "op" or ldi[1] != "LDI" or jmp[0] != "op" or \
+                jmp[1] != "JMP":
+            return None
+
+        reg = reg_num(ldi[2])
+        if reg is None or reg != reg_num(jmp[2]) or \
+                not isinstance(ldi_value(ldi[3]), str):
+            return None
+
+        return reg, ldi[3]
+
+    result = list(items)
+
+    for i in range(len(items)):
+        jump = jump_at(i)
+        if jump is None:
+            continue
+
+        reg, target = jump
+        seen = {target}
+
+        while True:
+            nxt = jump_at(starts.get(target))
+            if nxt is None or nxt[0] != reg or nxt[1] in seen:
+                break
+            target = nxt[1]
+            seen.add(target)
+
+        if target != jump[1]:
+            _, opcode, op_a, _, line_num = items[i]
+            result[i] = ("op", opcode, op_a, target, line_num)
 
     return result
 
 
-def p8(v):
-    return "{:08b}".format(v)
+def fold_inc_dec(items):
+    """Replace each run of INC/DEC on one register with its net effect"""
 
+    result = []
+    i = 0
+
+    while i < len(items):
+        item = items[i]
 
-def pass1(inputfile, sym, code):
+        if item[0] != "op" or item[1] not in ("INC", "DEC") or \
+                reg_num(item[2]) is None:
+            result.append(item)
+            i += 1
+            continue
+
+        reg = reg_num(item[2])
+        net = 0
+        j = i
+        while j < len(items) and items[j][0] == "op" and \
+                items[j][1] in ("INC", "DEC") and reg_num(items[j][2]) == reg:
+            net += 1 if items[j][1] == "INC" else -1
+            j += 1
+
+        # INC and DEC wrap around, so only the net count mod 256 matters
+        net = (net + 128) % 256 - 128
+        opcode = "INC" if net > 0 else "DEC"
+        result += [("op", opcode, item[2], None, item[-1])] * abs(net)
+        i = j
+
+    return result
+
+
+def drop_redundant_ldi(items):
+    """
+    Drop LDIs that load a register with the value it already holds.
+    Values are only tracked within straight-line code: every label, data
+    item and call forgets them.
     """
-    Pass 1
 
-    * Read the source code lines
-    * Parse labels, opcodes, and operands
-    * Record label offsets
-    * Emit machine code
+    result = []
+    known = {}
+
+    for item in items:
+        if item[0] != "op":
+            known = {}
+            result.append(item)
+            continue
+
+        _, opcode, op_a, op_b, _ = item
+        reg = reg_num(op_a)
+
+        if opcode == "LDI" and reg is not None:
+            value = ldi_value(op_b)
+            if reg in known and known[reg] == value:
+                continue
+            known[reg] = value
+
+        elif opcode in ("INC", "DEC") and isinstance(known.get(reg), int):
+            step = 1 if opcode == "INC" else -1
+            known[reg] = (known[reg] + step) & 0xFF
+
+        elif opcode in WRITES_REG_A:
+            known.pop(reg, None)
+            if opcode in WRITES_SP:
+                known.pop(7, None)
+
+        elif opcode in WRITES_SP:
+            known.pop(7, None)
+
+        elif opcode in ("CALL", "INT") or opcode in NO_FALLTHROUGH:
+            # whatever runs next may have changed any register
+            known = {}
+
+        result.append(item)
+
+    return result
+
+
+def peephole(items):
+    """Run the optimisations over the parsed items until nothing changes"""
+
+    while True:
+        optimised = drop_nops(items)
+        optimised = drop_unreachable(optimised)
+        optimised = thread_jumps(optimised)
+        optimised = fold_inc_dec(optimised)
+        optimised = drop_redundant_ldi(optimised)
+
+        if optimised == items:
+            return items
+
+        items = optimised
+
+
+def parse(inputfile):
+    """
+    Read source lines and yield parsed items one at a time:
+    ("label", name, line_num), ("op", opcode, op_a, op_b, line_num), or
+    ("DS"/"DB", line, line_num).
     """
 
-    # Source line number
-    line_num = 0
+    for line_num, line in enumerate(inputfile, 1):
+        # Strip comments
+        comment_index = line.find(';')
+        if comment_index != -1:
+            line = line[:comment_index]
 
-    # Current code address (for labels)
-    addr = 0
+        # Normalize
+        line = line.strip()
 
-    def get_reg(op, fatal=True):
-        """Get a register number from a string, e.g. "R2" -> 2"""
+        # Ignore blank lines
+        if line == '':
+            continue
 
-        nonlocal line_num
+        # match the uppercased line, rather than uppercasing each group
+        m = LINE_RE.match(line.upper())
 
-        m = re.match(r"R([0-7])", op)
+        if m is not None:
+            label, opcode, op_a, op_b = m.groups()
 
-        if m is None:
-            if fatal:
-                print(f"Line {line_num}: unknown register {op}",
-                      file=sys.stderr)
-                sys.exit(1)
-            else:
-                return None
+            if label is not None:
+                yield ("label", label, line_num)
 
-        return int(m.group(1))
+            if opcode is not None:
+                if opcode == 'DS' or opcode == 'DB':
+                    yield (opcode, line, line_num)
+                else:
+                    # Check operand count
+                    check_ops(opcode, op_a, op_b, line_num)
+                    yield ("op", opcode, op_a, op_b, line_num)
+        else:
+            print(f"No match: {line}", file=sys.stderr)
+            sys.exit(3)
 
-    def out0(opcode, op_a, op_b, machine_code):
-        """Handle opcodes with zero operands"""
 
-        nonlocal addr
+def check_ops(opcode, op_a, op_b, line_num):
+    """Check operands for sanity with a particular opcode"""
 
-        code.append(f"{machine_code} # {opcode}")
-        addr += 1
+    def check_ops_count(desired, found):
+        # Makes sure we have right operand count
+        if found < desired:
+            print(f"Line {line_num}: missing operand to {opcode}",
+                  file=sys.stderr)
+            sys.exit(1)
+        elif found > desired:
+            print(f"Line {line_num}: unexpected operand to {opcode}",
+                  file=sys.stderr)
+            sys.exit(1)
 
-    def out1(opcode, op_a, op_b, machine_code):
-        """Handle opcodes with one operand"""
+    # Make sure we know this opcode at all
+    if opcode not in OPCODES:
+        print(f"line {line_num}: unknown opcode {opcode}", file=sys.stderr)
+        sys.exit(2)
 
-        nonlocal addr
+    op_type = OPCODES[opcode]["type"]
 
-        reg_a = get_reg(op_a)
-        code.append(f"{machine_code} # {opcode} {op_a}")
-        code.append(p8(reg_a))
-        addr += 2
+    total_operands = 0
 
-    def out2(opcode, op_a, op_b, machine_code):
-        """Handle opcodes with two operands"""
+    if op_a is not None:
+        total_operands += 1
 
-        nonlocal addr
+    if op_b is not None:
+        total_operands += 1
 
-        reg_a = get_reg(op_a)
-        reg_b = get_reg(op_b)
+    if op_type == 0 or op_type == 1 or op_type == 2:
+        # 0, 1, or 2 register operands
+        check_ops_count(op_type, total_operands)
 
-        code.append(f"{machine_code} # {opcode} {op_a},{op_b}")
-        code.append(p8(reg_a))
-        code.append(p8(reg_b))
+    elif op_type == 8:
+        # LDI r,i or LDI r,label
+        check_ops_count(2, total_operands)
 
-        addr += 3
 
-    def out8(opcode, op_a, op_b, machine_code):
-        """Handle LDI opcode (type 8)"""
+def pass1(inputfile, sym, write, optimise=False):
+    """
+    Pass 1
 
-        nonlocal addr
+    * Stream the parsed source lines (see parse)
+    * Optionally run the peephole optimiser over them
+    * Record label offsets
+    * Emit machine code, passing finished output lines to write in chunks
+
+    An LDI of a label that isn't defined yet leaves a placeholder, which
+    is filled in when the label turns up. Lines are held back from the
+    first placeholder until every placeholder is filled, spilling to a
+    temporary file past the first chunk, so only the filled-in values stay
+    in memory. The optimiser needs the whole program though, so -O keeps
+    the parsed source in memory.
+    """
 
-        reg_a = get_reg(op_a)
+    # Source line number
+    line_num = 0
 
-        try:
-            val_b = int(op_b, 0)
-            out_b = p8(val_b)
+    # Current code address (for labels)
+    addr = 0
 
-        except ValueError:
-            # If it's not a value, it might be a symbol
-            out_b = f"sym:{op_b}"
+    # Output lines not written yet
+    code = []
 
-        code.append(f"{machine_code} # {opcode} {op_a},{op_b}")
-        code.append(p8(reg_a))
-        code.append(out_b)
+    # Lines held back in the spool file, which comes before code
+    held = 0
+    spool = None
+
+    # Placeholders waiting for a label address: symbol -> indexes into the
+    # held lines, and the values of the placeholders filled in so far
+    fixups = {}
+    filled = {}
+
+    emit = code.append
+
+    def release():
+        """Write out the held lines, filling in the placeholders"""
+
+        nonlocal held, spool
+
+        # index of the next held line
+        index = 0
+
+        if spool is not None:
+            spool.seek(0)
+            while True:
+                # placeholders are spooled as blank lines
+                lines = [line.rstrip("\n") or filled[index + i]
+                         for i, line in
+                         enumerate(itertools.islice(spool, CHUNK_LINES))]
+                if not lines:
+                    break
+                write(lines)
+                index += len(lines)
+            spool.close()
+            spool = None
+
+        write([line or filled[index + i] for i, line in enumerate(code)])
+        code.clear()
+        held = 0
+        filled.clear()
+
+    def get_reg(op):
+        """Get a register number from a string, e.g. "R2" -> 2"""
+
+        if op in REGISTERS:
+            return REGISTERS[op]
 
-        addr += 3
+        m = REG_RE.match(op)
+
+        if m is None:
+            print(f"Line {line_num}: unknown register {op}", file=sys.stderr)
+            sys.exit(1)
+
+        return int(m.group(1))
 
     def handle_ds(line):
         """
         Handle DS pseudo-opcode
         """
 
-        nonlocal addr
-
-        m = re.match(REGEX_DS, line, re.IGNORECASE)
+        m = DS_RE.match(line)
 
         if m is None or m.group(2) is None:
             print(f"line {line_num}: missing argument to DS", file=sys.stderr)
@@ -228,24 +576,18 @@ def pass1(inputfile, sym, code):
 
         data = m.group(2)
 
-        for i in range(len(data)):
-            print_char = data[i]
+        for c in data:
+            print_char = '[space]' if c == ' ' else c
+            emit(f"{p8(ord(c))} # {print_char}")
 
-            if print_char == ' ':
-                print_char = '[space]'
-
-            code.append(f"{p8(ord(data[i]))} # {print_char}")
-
-        addr += len(data)
+        return len(data)
 
     def handle_db(line):
         """
         Handle the DB pseudo-opcode
         """
 
-        nonlocal addr
-
-        m = re.match(REGEX_DB, line, re.IGNORECASE)
+        m = DB_RE.match(line)
 
         if m is None or m.group(2) is None:
             print(f"line {line}: missing argument to DB", file=sys.stderr)
@@ -264,139 +606,319 @@ def pass1(inputfile, sym, code):
         # Force to byte size
         val &= 0xff
 
-        code.append(f"{p8(val)} # {data}")
+        emit(f"{p8(val)} # {data}")
 
-        addr += 1
+        return 1
 
-    def check_ops(opcode, op_a, op_b):
-        """Check operands for sanity with a particular opcode"""
+    items = parse(inputfile)
 
-        def check_ops_count(desired, found):
-            # Makes sure we have right operand count
-            if found < desired:
-                print(f"Line {line_num}: missing operand to {opcode}",
-                      file=sys.stderr)
-                sys.exit(1)
-            elif found > desired:
-                print(f"Line {line_num}: unexpected operand to {opcode}",
+    if optimise:
+        # the optimiser looks across the whole program
+        items = peephole(list(items))
+
+    for item in items:
+        kind = item[0]
+        line_num = item[-1]
+
+        if kind == "op":
+            _, opcode, op_a, op_b, _ = item
+            op_info = OPCODES[opcode]
+            op_type = op_info["type"]
+            machine_code = op_info["code"]
+
+            if op_type == 0:
+                emit(f"{machine_code} # {opcode}")
+                addr += 1
+
+            elif op_type == 1:
+                emit(f"{machine_code} # {opcode} {op_a}")
+                emit(BITS[get_reg(op_a)])
+                addr += 2
+
+            elif op_type == 2:
+                emit(f"{machine_code} # {opcode} {op_a},{op_b}")
+                emit(BITS[get_reg(op_a)])
+                emit(BITS[get_reg(op_b)])
+                addr += 3
+
+            else:
+                # LDI, whose second operand is a value or a symbol
+                emit(f"{machine_code} # {opcode} {op_a},{op_b}")
+                emit(BITS[get_reg(op_a)])
+
+                try:
+                    emit(p8(int(op_b, 0)))
+
+                except ValueError:
+                    # If it's not a value, it might be a symbol, which is
+                    # filled in once its label is known
+                    if op_b in sym:
+                        emit(p8(sym[op_b]))
+                    else:
+                        fixups.setdefault(op_b, []).append(held + len(code))
+                        emit(None)
+
+                addr += 3
+
+        elif kind == "label":
+            # Track label address
+            label = item[1]
+            if label in sym:
+                print(f"line {line_num}: label {label} defined twice",
                       file=sys.stderr)
-                sys.exit(1)
+                sys.exit(2)
+            sym[label] = addr
+            emit(f'# {label} (address {addr}):')
 
-        # Make sure we know this opcode at all
-        if opcode not in OPCODES:
-            print(f"line {line_num}: unknown opcode {opcode}", file=sys.stderr)
-            sys.exit(2)
+            for index in fixups.pop(label, ()):
+                filled[index] = p8(addr)
 
-        op_type = OPCODES[opcode]["type"]
+        elif kind == "DS":
+            addr += handle_ds(item[1])
 
-        total_operands = 0
+        else:
+            addr += handle_db(item[1])
 
-        if op_a is not None:
-            total_operands += 1
+        if len(code) >= CHUNK_LINES:
+            if not fixups:
+                release()
+            else:
+                if spool is None:
+                    spool = tempfile.TemporaryFile("w+")
+                spool.write("\n".join(line or "" for line in code) + "\n")
+                held += len(code)
+                code.clear()
 
-        if op_b is not None:
-            total_operands += 1
+    for s in fixups:
+        print(f"unknown symbol: {s}", file=sys.stderr)
+        sys.exit(2)
 
-        if op_type == 0 or op_type == 1 or op_type == 2:
-            # 0, 1, or 2 register operands
-            check_ops_count(op_type, total_operands)
+    release()
 
-        elif op_type == 8:
-            # LDI r,i or LDI r,label
-            check_ops_count(2, total_operands)
 
-    # Type to function mapping
-    type_f = {
-        0: out0,
-        1: out1,
-        2: out2,
-        8: out8,
-    }
+def write_text(outputfile, lines):
+    """Write output lines in the text .ls8 format."""
 
-    for line in inputfile:
-        line_num += 1
+    if lines:
+        outputfile.write("\n".join(lines) + "\n")
 
-        # Strip comments
-        comment_index = line.find(';')
-        if comment_index != -1:
-            line = line[:comment_index]
 
-        # Normalize
-        line = line.strip()
+def image_bytes(lines):
+    """Machine code in output lines; label comments are skipped."""
 
-        # Ignore blank lines
-        if input == '':
-            continue
+    # every line but a label comment starts with its byte in binary
+    return bytearray(int(c.split(' ', 1)[0], 2) for c in lines
+                     if c[0] != '#')
 
-        # print(line)  # debug
 
-        m = re.match(REGEX, line)
+def write_image(outputfile, data):
+    """Write machine code as a binary image."""
 
-        if m is not None:
-            label, opcode, op_a, op_b = normalize_line(m.groups())
+    header = IMAGE_HEADER.pack(IMAGE_MAGIC, IMAGE_VERSION,
+                               IMAGE_FLAG_CHECKSUM, 0, len(data),
+                               zlib.crc32(data))
+    outputfile.write(header + data)
 
-            # print(label, opcode, op_a, op_b)  # debug
 
-            # Track label address
-            if label is not None:
-                sym[label] = addr
-                # print(f"Label {label}: {addr}")  # debug
-                code.append(f'# {label} (address {addr}):')
+def cache_path(cache_dir, inputfile, optimise=False):
+    """
+    Cache file for a source: named by a hash of the assembler version,
+    the options and the source contents. The source is read in blocks and
+    then rewound, so it must be seekable.
+    """
 
-            if opcode is not None:
-                if opcode == 'DS':
-                    handle_ds(line)
-                elif opcode == 'DB':
-                    handle_db(line)
-                else:
-                    # Check operand count
-                    check_ops(opcode, op_a, op_b)
+    h = hashlib.sha256()
+    h.update(ASM_VERSION.encode())
+    h.update(b"\0")
+    h.update(b"O\0" if optimise else b"\0")
+    for block in iter(lambda: inputfile.read(CHUNK_BYTES), ""):
+        h.update(block.encode())
+    inputfile.seek(0)
+    key = h.hexdigest()
+
+    return os.path.join(cache_dir, key[:2], key + ".ls8")
+
+
+def assemble(inputfile, outputfile, cache_dir=None, binary=False,
+             optimise=False):
+    """
+    Assemble a source file into outputfile, as text or as a binary image.
+    With a cache_dir, the output of a source assembled before is copied
+    from the cache instead; the source must be seekable then.
+    Returns whether the output came from the cache.
+    """
+
+    if binary:
+        # the image header needs the length and checksum up front, so the
+        # bytes are collected first
+        data = bytearray()
+
+        def output(lines):
+            data.extend(image_bytes(lines))
+    else:
+        def output(lines):
+            write_text(outputfile, lines)
+
+    hit = False
+
+    if cache_dir is None:
+        pass1(inputfile, {}, output, optimise)
+
+    else:
+        path = cache_path(cache_dir, inputfile, optimise)
+
+        try:
+            cached = open(path)
+
+        except OSError:
+            # write to a temporary file first so readers never see half an
+            # entry
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+
+            try:
+                with open(tmp, "w") as f:
+                    def tee(lines):
+                        write_text(f, lines)
+                        output(lines)
+
+                    pass1(inputfile, {}, tee, optimise)
+                os.replace(tmp, path)
+
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+
+            prune_cache(cache_dir)
 
-                    # Handle opcodes
-                    op_info = OPCODES[opcode]
-                    handler = type_f[op_info["type"]]
-                    handler(opcode, op_a, op_b, op_info["code"])
         else:
-            print(f"No match: {input}", file=sys.stderr)
-            sys.exit(3)
+            with cached:
+                # mark it recently used, so pruning keeps it
+                os.utime(path)
+                while True:
+                    lines = [line.rstrip("\n") for line in
+                             itertools.islice(cached, CHUNK_LINES)]
+                    if not lines:
+                        break
+                    output(lines)
+            hit = True
+
+    if binary:
+        write_image(outputfile, data)
+
+    return hit
 
 
-def pass2(outputfile, sym, code):
+def prune_cache(cache_dir, keep=CACHE_ENTRIES):
+    """Delete the least recently used cache entries beyond keep."""
+
+    entries = []
+    for sub in os.scandir(cache_dir):
+        if sub.is_dir():
+            entries += [e for e in os.scandir(sub.path)
+                        if not e.name.endswith(".tmp")]
+
+    if len(entries) <= keep:
+        return
+
+    entries.sort(key=lambda e: e.stat().st_mtime)
+    for e in entries[:len(entries) - keep]:
+        try:
+            os.remove(e.path)
+        except OSError:
+            # another process got there first
+            pass
+
+
+def build_one(path, outdir, cache_dir, binary, optimise=False):
     """
-    Output the code, substituting in any symbols.
+    Assemble one source file into a .ls8 file of the same name in outdir.
+    Returns "assembled", "cached" or "unchanged".
     """
 
-    for c in code:
-        # Replace symbols
-        if c[:4] == 'sym:':
-            s = c[4:].strip()
+    out = io.BytesIO() if binary else io.StringIO()
+    with open(path) as f:
+        hit = assemble(f, out, cache_dir, binary, optimise)
 
-            if s in sym:
-                c = p8(sym[s])
+    data = out.getvalue()
+    if not binary:
+        data = data.encode()
+
+    name = os.path.splitext(os.path.basename(path))[0]
+    outfile = os.path.join(outdir, name + ".ls8")
+    try:
+        with open(outfile, "rb") as f:
+            if f.read() == data:
+                return "unchanged"
+    except OSError:
+        pass
+
+    with open(outfile, "wb") as f:
+        f.write(data)
+
+    return "cached" if hit else "assembled"
+
+
+def build_files(paths, outdir, cache_dir, binary, optimise=False,
+                jobs=None):
+    """
+    Assemble every source in paths into outdir, across jobs worker
+    processes (one per CPU by default). Unchanged sources come from the
+    cache, and output files that already hold the right contents are
+    left untouched.
+    """
+
+    os.makedirs(outdir, exist_ok=True)
+
+    n = len(paths)
+    args = ([outdir] * n, [cache_dir] * n, [binary] * n, [optimise] * n)
+
+    if n < 2 or jobs == 1:
+        results = list(map(build_one, paths, *args))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(build_one, paths, *args))
+
+    assembled = results.count("assembled")
+    cached = results.count("cached")
+    unchanged = results.count("unchanged")
+    print(f"{assembled} assembled, {cached} cached, {unchanged} unchanged",
+          file=sys.stderr)
 
-            else:
-                print(f"unknown symbol: {s}", file=sys.stderr)
-                sys.exit(2)
 
-        outputfile.write(f"{c}\n")
+def build_dir(srcdir, outdir, cache_dir, binary, optimise=False, jobs=None):
+    """Assemble every .asm file in srcdir into a .ls8 file in outdir."""
+
+    paths = [os.path.join(srcdir, name) for name in sorted(os.listdir(srcdir))
+             if name.endswith(".asm")]
+
+    build_files(paths, outdir, cache_dir, binary, optimise, jobs)
 
 
 def main(argv):
     # Parse command line
-    inputfile, outputfile = parse_commandline(argv)
+    args = parse_commandline(argv)
 
-    # Open files
-    inputfile, outputfile = open_files(inputfile, outputfile)
+    if args.build:
+        build_dir(args.build[0], args.build[1], args.cache, args.binary,
+                  args.optimise, args.jobs)
+        return 0
 
-    # Set up the symbol table
-    sym = {}
+    if args.out_dir:
+        build_files(args.files, args.out_dir, args.cache, args.binary,
+                    args.optimise, args.jobs)
+        return 0
 
-    # Set up the machine code output
-    code = []
+    if args.inputfile == "-":
+        # piped sources are rarely seen twice
+        args.cache = None
+
+    # Open files
+    inputfile, outputfile = open_files(args.inputfile, args.outputfile,
+                                       args.binary)
 
-    # Assemble
-    pass1(inputfile, sym, code)
-    pass2(outputfile, sym, code)
+    # Assemble, or fetch the result from the cache
+    assemble(inputfile, outputfile, args.cache, args.binary, args.optimise)
 
     return 0
 
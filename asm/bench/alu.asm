@@ -0,0 +1,30 @@
+; alu.asm: tight ALU loop for benchmarking
+;
+; Runs 256 x 128 iterations of a mix of ALU operations. Only R0-R4 are
+; used, so IM, IS and SP keep their reset values.
+;
+; Expected output: 30
+
+    LDI R0,0            ; zero for compares
+    LDI R1,128          ; outer counter
+    LDI R4,0            ; accumulator
+Outer:
+    LDI R3,0            ; inner counter
+Inner:
+    INC R3
+    ADD R4,R3
+    LDI R2,3            ; multiplier and shift
+    MUL R4,R2
+    XOR R4,R3
+    SHR R4,R2
+    OR R4,R3
+    SUB R4,R1
+    CMP R3,R0
+    LDI R2,Inner
+    JNE R2
+    DEC R1
+    CMP R1,R0
+    LDI R2,Outer
+    JNE R2
+    PRN R4
+    HLT
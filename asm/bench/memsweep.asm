@@ -0,0 +1,34 @@
+; memsweep.asm: LD/ST memory sweeps for benchmarking
+;
+; Fills 0x80-0xBF with values and sums them back, 255 times.
+;
+; Expected output: checksum of the last sweep
+
+    LDI R4,255          ; sweep counter
+    LDI R5,0
+Sweep:
+    LDI R0,0x80         ; address
+    LDI R1,0xC0         ; end address
+    LDI R6,Fill
+Fill:
+    ST R0,R4
+    ADD R2,R0
+    INC R0
+    CMP R0,R1
+    JNE R6
+    LDI R0,0x80
+    LDI R2,0            ; checksum
+    LDI R6,Sum
+Sum:
+    LD R3,R0
+    ADD R2,R3
+    INC R0
+    CMP R0,R1
+    JNE R6
+    DEC R4
+    LDI R6,0
+    CMP R4,R6
+    LDI R6,Sweep
+    JNE R6
+    PRN R2
+    HLT
@@ -0,0 +1,32 @@
+; pushpop.asm: PUSH/POP churn for benchmarking
+;
+; Pushes five registers and pops them back 256 x 64 times, counting the
+; outer loops.
+;
+; Expected output: 64
+
+    LDI R0,0            ; inner counter, wraps after 256
+    LDI R1,64           ; outer counter
+    LDI R2,Loop
+    LDI R3,0            ; zero for compares
+    LDI R4,0            ; outer loops done
+Loop:
+    PUSH R0
+    PUSH R1
+    PUSH R2
+    PUSH R3
+    PUSH R4
+    POP R4
+    POP R3
+    POP R2
+    POP R1
+    POP R0
+    INC R0
+    CMP R0,R3
+    JNE R2
+    INC R4
+    DEC R1
+    CMP R1,R3
+    JNE R2
+    PRN R4
+    HLT
@@ -0,0 +1,34 @@
+; recurse.asm: deep CALL/RET recursion for benchmarking
+;
+; Calls Down recursively 60 levels deep, 255 x 16 times.
+;
+; Expected output: 0
+
+    LDI R1,255          ; outer counter
+    LDI R4,Again
+    LDI R5,Down
+    LDI R6,0
+Again:
+    LDI R2,16
+Repeat:
+    LDI R0,60           ; recursion depth
+    CALL R5
+    DEC R2
+    LDI R3,Repeat
+    CMP R2,R6
+    JNE R3
+    DEC R1
+    CMP R1,R6
+    JNE R4
+    PRN R0
+    HLT
+
+; Down: decrement R0 and call itself until it reaches 0
+Down:
+    DEC R0
+    LDI R3,Done
+    CMP R0,R6
+    JEQ R3
+    CALL R5
+Done:
+    RET
@@ -0,0 +1,63 @@
+"""
+Tests for the assembler's command line.
+
+    python -m unittest test_asm
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ASM = os.path.join(HERE, "asm.py")
+SOURCE = os.path.join(HERE, "mult.asm")
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.cache = os.path.join(self.tmp, "cache")
+
+        # the output without any cache, to compare against
+        self.expected = self.assemble("--no-cache")
+
+    def assemble(self, *options, env=None):
+        """Assemble SOURCE with options; returns the output."""
+
+        out = os.path.join(self.tmp, "out.ls8")
+        if os.path.exists(out):
+            os.remove(out)
+        environ = dict(os.environ, HOME=self.tmp)
+        environ.pop("LS8_ASM_CACHE", None)
+        environ.update(env or {})
+        subprocess.run([sys.executable, ASM, *options, SOURCE, out],
+                       env=environ, check=True)
+        with open(out) as f:
+            return f.read()
+
+    def test_cache_takes_no_argument(self):
+        # the source after --cache is the input, not the cache directory
+        env = {"LS8_ASM_CACHE": self.cache}
+        self.assertEqual(self.assemble("--cache", env=env), self.expected)
+        self.assertTrue(os.listdir(self.cache))
+        # and again, from the cache
+        self.assertEqual(self.assemble("--cache", env=env), self.expected)
+
+    def test_cache_dir(self):
+        self.assertEqual(self.assemble("--cache-dir", self.cache),
+                         self.expected)
+        self.assertTrue(os.listdir(self.cache))
+
+    def test_no_cache(self):
+        env = {"LS8_ASM_CACHE": self.cache}
+        self.assertEqual(self.assemble("--no-cache", env=env), self.expected)
+        self.assertFalse(os.path.exists(self.cache))
+
+
+if __name__ == "__main__":
+    unittest.main()
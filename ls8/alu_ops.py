@@ -14,47 +14,77 @@ SHR = 0b10101101
 SUB = 0b10100001
 XOR = 0b10101011
 
+# Each handler does its own math and bitwise-ANDs the result with 0xFF
+# so registers always stay in the range 0 - 255
+
 def handle_ADD(self, operand_a, operand_b):
-    self.alu('ADD', operand_a, operand_b)
+    reg = self.reg
+    reg[operand_a] = (reg[operand_a] + reg[operand_b]) & 0xFF
 
 def handle_AND(self, operand_a, operand_b):
-    self.alu('AND', operand_a, operand_b)
+    reg = self.reg
+    reg[operand_a] = reg[operand_a] & reg[operand_b]
 
 def handle_CMP(self, operand_a, operand_b):
-    self.alu('CMP', operand_a, operand_b)
+    # FL uses the pattern 00000LGE; only one of the flags is set
+    a = self.reg[operand_a]
+    b = self.reg[operand_b]
+    if a == b:
+        self.FL = 0b00000001
+    elif a > b:
+        self.FL = 0b00000010
+    else:
+        self.FL = 0b00000100
 
 def handle_DEC(self, operand_a, operand_b):
-    self.alu('DEC', operand_a, operand_b)
+    reg = self.reg
+    reg[operand_a] = (reg[operand_a] - 1) & 0xFF
 
 def handle_DIV(self, operand_a, operand_b):
-    self.alu('DIV', operand_a, operand_b)
+    reg = self.reg
+    if not reg[operand_b]:
+        self.is_running = False
+        raise Exception("Cannot divide by 0")
+    reg[operand_a] = reg[operand_a] // reg[operand_b]
 
 def handle_INC(self, operand_a, operand_b):
-    self.alu('INC', operand_a, operand_b)
+    reg = self.reg
+    reg[operand_a] = (reg[operand_a] + 1) & 0xFF
 
 def handle_MOD(self, operand_a, operand_b):
-    self.alu('MOD', operand_a, operand_b)
+    reg = self.reg
+    if not reg[operand_b]:
+        self.is_running = False
+        raise Exception("Cannot divide by 0")
+    reg[operand_a] = reg[operand_a] % reg[operand_b]
 
 def handle_MUL(self, operand_a, operand_b):
-    self.alu('MUL', operand_a, operand_b)
+    reg = self.reg
+    reg[operand_a] = (reg[operand_a] * reg[operand_b]) & 0xFF
 
 def handle_NOT(self, operand_a, operand_b):
-    self.alu('NOT', operand_a, operand_b)
+    reg = self.reg
+    reg[operand_a] = reg[operand_a] ^ 0xFF
 
 def handle_OR(self, operand_a, operand_b):
-    self.alu('OR', operand_a, operand_b)
+    reg = self.reg
+    reg[operand_a] = reg[operand_a] | reg[operand_b]
 
 def handle_SHL(self, operand_a, operand_b):
-    self.alu('SHL', operand_a, operand_b)
+    reg = self.reg
+    reg[operand_a] = (reg[operand_a] << reg[operand_b]) & 0xFF
 
 def handle_SHR(self, operand_a, operand_b):
-    self.alu('SHR', operand_a, operand_b)
+    reg = self.reg
+    reg[operand_a] = reg[operand_a] >> reg[operand_b]
 
 def handle_SUB(self, operand_a, operand_b):
-    self.alu('SUB', operand_a, operand_b)
+    reg = self.reg
+    reg[operand_a] = (reg[operand_a] - reg[operand_b]) & 0xFF
 
 def handle_XOR(self, operand_a, operand_b):
-    self.alu('XOR', operand_a, operand_b)
+    reg = self.reg
+    reg[operand_a] = reg[operand_a] ^ reg[operand_b]
 
 # Imported to CPU class as a branch table
 
@@ -73,4 +103,23 @@ alu_branch = {
     SHR: handle_SHR,
     SUB: handle_SUB,
     XOR: handle_XOR,
-}
\ No newline at end of file
+}
+
+# Opcode for each ALU operation name, used by CPU.alu
+
+alu_opcodes = {
+    "ADD": ADD,
+    "AND": AND,
+    "CMP": CMP,
+    "DEC": DEC,
+    "DIV": DIV,
+    "INC": INC,
+    "MOD": MOD,
+    "MUL": MUL,
+    "NOT": NOT,
+    "OR": OR,
+    "SHL": SHL,
+    "SHR": SHR,
+    "SUB": SUB,
+    "XOR": XOR,
+}
@@ -0,0 +1,477 @@
+#!/usr/bin/env python3
+
+"""
+Ahead-of-time translator.
+Turns a whole program into a Python module before it runs: the control
+flow graph is walked from the entry point through every fall-through and
+every jump and CALL target (the constants LDI puts in the registers they
+go through), and each basic block found becomes a function, generated
+by the same emitter as the JIT's blocks. The module is written to a
+cache directory keyed by a hash of the RAM image, so Python keeps it as
+a .pyc and later runs of the same program skip both translation and
+decoding.
+
+The blocks work on the CPU's own registers, RAM and console, and run()
+still delivers timer ticks and interrupts, so the output is the same as
+interpreting. Addresses no block starts at (a computed jump target) are
+interpreted one instruction at a time. A program that writes into its
+own code is flagged and runs interpreted from then on; one that
+visibly does so (a ST to a constant address inside a block) is never
+translated at all.
+
+    cpu = CPU(aot=True)
+    cpu.load("examples/call.ls8")
+    cpu.run()
+
+    python3 aot.py examples/call.ls8 [-o call.py]
+"""
+
+import argparse
+import hashlib
+import importlib.util
+import os
+import py_compile
+import sys
+import types
+
+from main_ops import (CALL, HLT, INT, IRET, JMP, JNE, LDI, NOP, PUSH, RET,
+                      ST)
+from jit import (BLOCK_ENDS, HANDLERS, JUMP_FLAGS, MAX_BLOCK_LEN, WRITES_A,
+                 emit_block)
+
+# Bump when the generated code changes, so modules cached by older
+# versions are not reused
+AOT_VERSION = "4"
+
+# Where translated modules are cached, keyed by a hash of the program
+DEFAULT_CACHE_DIR = os.environ.get(
+    "LS8_AOT_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "ls8-aot"))
+
+# Interrupt vectors I0-I7; the handlers they point at are entry points
+VECTORS = range(0xF8, 0x100)
+
+# Instructions that jump through the register in operand a
+TARGETS = frozenset(JUMP_FLAGS) | {JNE, JMP, CALL}
+
+# Instructions after which the rest of the block can't run
+UNCONDITIONAL = frozenset([JMP, RET, IRET, HLT])
+
+# Translated programs kept in memory, by hash
+MODULE_CACHE = 256
+
+# (module, reason) for each program translated by this process, oldest
+# first
+_modules = {}
+
+
+def walk(ram, start):
+    """
+    Walk the straight-line code at start, like JIT.find_block.
+    Returns a list of (address, opcode, operand_a, operand_b).
+    """
+
+    block = []
+    addr = start
+
+    while len(block) < MAX_BLOCK_LEN and addr < 256:
+        ir = ram[addr]
+        size = (ir >> 6) + 1
+        if addr + size > 256:
+            # code that wraps around the top of RAM is interpreted
+            break
+
+        block.append((addr, ir, ram[(addr + 1) & 0xFF],
+                      ram[(addr + 2) & 0xFF]))
+        addr += size
+
+        if ir in BLOCK_ENDS or ir == INT:
+            break
+
+    return block
+
+
+def find_blocks(ram, entry):
+    """
+    Build the control flow graph from entry.
+    Returns ({start address: block}, reason), where reason says why the
+    program must be interpreted instead, or is None.
+
+    Jumps and CALLs go through registers, so the constants LDI leaves in
+    them are followed from block to block to find where they go. They are
+    only used to find blocks: a block reached some other way with other
+    values in its registers still runs correctly, it's just found late
+    (interpreted) or translated for nothing.
+    """
+
+    blocks = {}
+    # known register values on entry to each block, merged over every
+    # way in found so far
+    states = {}
+    # addresses a constant-address ST writes to
+    stores = set()
+    todo = []
+
+    def reach(target, consts):
+        old = states.get(target)
+        if old is None:
+            states[target] = dict(consts)
+        else:
+            merged = {r: v for r, v in old.items() if consts.get(r) == v}
+            if merged == old:
+                return
+            states[target] = merged
+        todo.append(target)
+
+    def guess(value):
+        # a value that may be an address; empty RAM reads as NOPs, so one
+        # pointing at a NOP is taken for data
+        if ram[value] != NOP:
+            reach(value, {})
+
+    reach(entry, {})
+    for vector in VECTORS:
+        reach(ram[vector], {})
+
+    while todo:
+        start = todo.pop()
+        block = blocks.get(start) or walk(ram, start)
+        if not block:
+            continue
+        blocks[start] = block
+
+        consts = dict(states[start])
+        for addr, ir, a, b in block:
+            if ir == LDI:
+                consts[a] = b
+            elif ir in TARGETS:
+                if a in consts:
+                    reach(consts[a], consts)
+            elif ir == ST:
+                if b in consts:
+                    # most likely an interrupt vector
+                    guess(consts[b])
+                if a in consts:
+                    stores.add(consts[a])
+            elif ir == PUSH:
+                if a in consts:
+                    # a return address pushed by hand
+                    guess(consts[a])
+            elif ir in WRITES_A:
+                consts.pop(a, None)
+
+        addr, ir = block[-1][:2]
+        if ir not in UNCONDITIONAL:
+            # a jump not taken, or a block cut short; after a CALL
+            # nothing is known about what the subroutine left behind
+            reach((addr + (ir >> 6) + 1) & 0xFF, {} if ir == CALL else consts)
+
+    code = covered(blocks)
+    for address in sorted(stores):
+        if code[address]:
+            return blocks, f"ST into its own code at 0x{address:02X}"
+    return blocks, None
+
+
+def covered(blocks):
+    """Return a bytearray with a 1 at every address the blocks cover."""
+
+    code = bytearray(256)
+    for block in blocks.values():
+        addr, ir = block[-1][:2]
+        start = block[0][0]
+        end = addr + (ir >> 6) + 1
+        code[start:end] = b"\x01" * (end - start)
+    return code
+
+
+def translate(ram, entry=0, im=False):
+    """
+    Generate the module for the program in ram, starting at entry; im
+    says whether IM is set already. Returns (source, reason); source is
+    None when reason says the program must be interpreted.
+    """
+
+    blocks, reason = find_blocks(ram, entry)
+    if reason is not None:
+        return None, reason
+
+    # while IM stays 0 no interrupt can be due, so programs that never
+    # set it can use R6 like any other register for free
+    checks = im or any(ir == IRET or ir in WRITES_A and a == 5
+                       for block in blocks.values()
+                       for _, ir, a, _ in block)
+
+    sizes = [0] * 256
+    for start, block in blocks.items():
+        sizes[start] = len(block)
+
+    lines = [
+        '"""',
+        "LS-8 program translated ahead of time by aot.py; do not edit.",
+        '"""',
+        "",
+        f"VERSION = {AOT_VERSION!r}",
+        "",
+        "# 1 at every address the blocks were translated from",
+        f"CODE = bytes.fromhex({covered(blocks).hex()!r})",
+        "",
+        "# Instructions in the block at each address (0 = no block)",
+        f"SIZES = {tuple(sizes)!r}",
+        "",
+        "# Whether blocks check for a due interrupt after writing IM or IS",
+        f"CHECKS = {checks!r}",
+        "",
+        "",
+        "def make(cpu, handlers, fault):",
+        '    """Return the block for each address (None = no block)."""',
+        "    ram = cpu.ram",
+        "    reg = cpu.reg",
+        "    ram_write = cpu.ram_write",
+        "    console = cpu.console",
+        "    blocks = [None] * 256",
+    ]
+    owners = {}
+
+    for start in sorted(blocks):
+        lines.append("")
+        lines.append(f"    def block_{start:02X}():")
+        lines.append("        try:")
+        emit_block(start, blocks[start], lines, owners, 12, checks=checks)
+        # an instruction that raises stops the block where it is
+        lines.extend(["        except Exception as e:",
+                      "            fault(e.__traceback__.tb_lineno)",
+                      "            raise",
+                      f"    blocks[{start}] = block_{start:02X}"])
+
+    lines.extend([
+        "",
+        "    return blocks",
+        "",
+        "",
+        "# The instruction each line of make() belongs to, for faults:",
+        "# {line: (address, instructions before it in its block)}",
+        f"LINES = {owners!r}",
+        "",
+    ])
+
+    return "\n".join(lines), None
+
+
+def program_hash(ram, entry, im):
+    digest = hashlib.sha256()
+    digest.update(AOT_VERSION.encode())
+    digest.update(bytes(ram))
+    digest.update(bytes((entry, im)))
+    return digest.hexdigest()
+
+
+def write_module(path, source):
+    """Write source to path and compile it to its cached .pyc."""
+
+    # write under a temporary name first so a concurrent run never
+    # imports half a file
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(source)
+    os.replace(tmp, path)
+    py_compile.compile(path, doraise=True)
+
+
+def load_module(ram, entry=0, im=False, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Return (module, reason) for the program in ram, building and caching
+    the module if needed; module is None when reason says the program
+    must be interpreted. With cache_dir None nothing is written to disk.
+    """
+
+    key = program_hash(ram, entry, im)
+    if key in _modules:
+        return _modules[key]
+
+    name = f"ls8_{key[:32]}"
+    path = None if cache_dir is None else os.path.join(cache_dir, name + ".py")
+
+    if path is not None and os.path.exists(path):
+        source, reason = None, None
+    else:
+        source, reason = translate(ram, entry, im)
+
+    if reason is not None:
+        result = (None, reason)
+
+    elif path is None:
+        module = types.ModuleType(name)
+        exec(compile(source, f"<ls8 aot {key[:12]}>", "exec"),
+             module.__dict__)
+        result = (module, None)
+
+    else:
+        if source is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            write_module(path, source)
+        # the import machinery reuses the .pyc in __pycache__
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        result = (module, None)
+
+    if len(_modules) >= MODULE_CACHE:
+        del _modules[next(iter(_modules))]
+    _modules[key] = result
+    return result
+
+
+class AOT:
+    """The translated program a CPU runs, built on its first run."""
+
+    def __init__(self, cpu, cache_dir=DEFAULT_CACHE_DIR):
+        self.cpu = cpu
+        self.cache_dir = cache_dir
+        self.flush()
+
+    def flush(self):
+        """Forget the translation, e.g. after a new program is loaded."""
+
+        self.blocks = None
+        self.sizes = None
+        # whether the blocks check for interrupts (see translate)
+        self.checks = False
+        # 1 at every address the blocks cover
+        self.code = bytearray(256)
+        # why the program runs interpreted, or None
+        self.reason = None
+        # instructions a faulting block ran before the fault
+        self.partial = 0
+
+    def prepare(self):
+        """Translate the program now in RAM, or load it from the cache."""
+
+        cpu = self.cpu
+        module, self.reason = load_module(cpu.ram, cpu.pc, bool(cpu.reg[5]),
+                                          self.cache_dir)
+        if module is None:
+            self.blocks = ()
+            self.code[:] = bytes(256)
+            return
+
+        self.blocks = module.make(cpu, HANDLERS, self.fault(module.LINES))
+        self.sizes = module.SIZES
+        self.checks = module.CHECKS
+        self.code[:] = module.CODE
+
+    def fault(self, owners):
+        def fault(line):
+            # leave the PC on the faulting instruction, like the
+            # interpreter, and have execute() count the ones that ran
+            self.cpu.pc, self.partial = owners[line]
+        return fault
+
+    def invalidate(self, addr):
+        """Called by CPU.ram_write: a write into the code flags the program."""
+
+        if self.code[addr]:
+            self.reason = f"wrote into its own code at 0x{addr:02X}"
+            self.code[:] = bytes(256)
+            # in place, so the running block sees it and stops
+            self.blocks[:] = [None] * 256
+
+    def execute(self, limit):
+        """
+        Run until HLT or until cycles reaches limit, calling blocks where
+        there are any. A block only starts if it can't run past the
+        limit, so timer ticks land on the same cycle as interpreted.
+        """
+
+        cpu = self.cpu
+        reg = cpu.reg
+        if self.blocks is None or \
+                self.reason is None and reg[5] and not self.checks:
+            # IM was set, so blocks without the checks won't do any more
+            self.prepare()
+        if self.reason is not None or cpu.mapped:
+            # LD and ST are only translated for plain RAM
+            return cpu.execute(limit)
+
+        blocks = self.blocks
+        sizes = self.sizes
+        checks = self.checks
+        decoded = cpu.decoded
+        cycles = cpu.cycles
+
+        try:
+            while cpu.is_running and cycles < limit:
+                if reg[5] & reg[6] and cpu.interrupts_enabled:
+                    cpu.interrupt()
+                    if self.reason is not None:
+                        break
+
+                pc = cpu.pc
+                block = blocks[pc]
+
+                if block is not None and cycles + sizes[pc] <= limit:
+                    cycles += block()
+                    continue
+
+                # anywhere else, one instruction at a time
+                entry = decoded[pc] or cpu.decode(pc)
+                if cycles + entry[4] > limit:
+                    # a fused sequence would run past the limit
+                    entry = cpu.decode_one(pc)
+                handler, operand_a, operand_b, add_to_pc, count = entry
+
+                handler(cpu, operand_a, operand_b)
+
+                cpu.pc = (cpu.pc + add_to_pc) & 0xFF
+                cycles += count
+                if self.reason is not None or reg[5] and not checks:
+                    break
+        except Exception:
+            # instructions that ran in a block before one raised
+            cycles += self.partial
+            self.partial = 0
+            raise
+        finally:
+            cpu.cycles = cycles
+
+        if cpu.is_running and cycles < limit:
+            # flagged, or IM set by untranslated code: start again, which
+            # interprets or rebuilds the blocks
+            return self.execute(limit)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="aot.py")
+    parser.add_argument("file", metavar="filename")
+    parser.add_argument("-o", "--output",
+                        help="write the module here instead of the cache")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_DIR,
+                        help="directory for translated modules")
+    args = parser.parse_args(argv[1:])
+
+    from client import read_program
+
+    try:
+        ram = read_program(args.file)
+    except FileNotFoundError:
+        print(f"{argv[0]}: {args.file} not found", file=sys.stderr)
+        return 1
+
+    source, reason = translate(ram)
+    if reason is not None:
+        print(f"{argv[0]}: {args.file} runs interpreted: {reason}",
+              file=sys.stderr)
+        return 1
+
+    path = args.output
+    if path is None:
+        os.makedirs(args.cache, exist_ok=True)
+        path = os.path.join(args.cache,
+                            f"ls8_{program_hash(ram, 0, False)[:32]}.py")
+    write_module(path, source)
+    print(path)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,122 @@
+"""
+Batch runner.
+Runs many .ls8 programs across a process pool, each with its own output
+capture and cycle/time limits, and collects the results into one report.
+"""
+
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from cpu import CPU, FAULT
+from console import Console
+
+
+def read_manifest(filename):
+    """
+    Read a manifest: one program path per line, '#' starts a comment.
+    Relative paths are relative to the manifest's directory.
+    """
+
+    base = os.path.dirname(os.path.abspath(filename))
+    paths = []
+
+    with open(filename) as f:
+        for line in f:
+            path = line.split('#')[0].strip()
+            if path:
+                paths.append(os.path.join(base, path))
+
+    return paths
+
+
+def run_program(path, max_cycles=None, time_limit=None, jit=False):
+    """
+    Run one program and return a result dict:
+    path, status (halted, cycle_limit, time_limit or error), error,
+    cycles, seconds and output.
+    """
+
+    result = {
+        "path": path,
+        "status": "halted",
+        "error": None,
+        "cycles": 0,
+        "seconds": 0.0,
+        "output": "",
+    }
+
+    if not os.path.isfile(path):
+        result["status"] = "error"
+        result["error"] = f"{path} not found"
+        return result
+
+    cpu = CPU(jit=jit, console=Console(collect=True))
+    start = time.perf_counter()
+    deadline = None if time_limit is None else time.monotonic() + time_limit
+
+    try:
+        cpu.load(path)
+        run = cpu.run(max_cycles=max_cycles, deadline=deadline)
+
+        if run.status == FAULT:
+            result["status"] = "error"
+            result["error"] = f"{type(run.error).__name__}: {run.error}"
+        else:
+            result["status"] = run.status
+
+    except Exception as e:
+        result["status"] = "error"
+        result["error"] = f"{type(e).__name__}: {e}"
+
+    result["cycles"] = cpu.cycles
+    result["seconds"] = time.perf_counter() - start
+    result["output"] = cpu.console.getvalue().decode("latin-1")
+    return result
+
+
+def run_batch(paths, workers=None, max_cycles=None, time_limit=None,
+              jit=False):
+    """
+    Run every program in paths across a pool of worker processes.
+    Returns the results in the same order as paths.
+    """
+
+    n = len(paths)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(run_program, paths, [max_cycles] * n,
+                           [time_limit] * n, [jit] * n)
+        return list(results)
+
+
+def write_report(results, filename):
+    """Write the combined results as JSON ("-" for stdout)."""
+
+    halted = sum(1 for r in results if r["status"] == "halted")
+    report = {
+        "programs": len(results),
+        "halted": halted,
+        "failed": len(results) - halted,
+        "cycles": sum(r["cycles"] for r in results),
+        "results": results,
+    }
+
+    text = json.dumps(report, indent=2)
+
+    if filename == "-":
+        print(text)
+    else:
+        with open(filename, "w") as f:
+            f.write(text + "\n")
+
+
+def print_summary(results):
+    """Print one line per program: status, cycles, time and path."""
+
+    for r in results:
+        line = f"{r['status']:<12} {r['cycles']:>10} {r['seconds']:8.3f}s  {r['path']}"
+        if r["error"]:
+            line += f"  ({r['error']})"
+        print(line)
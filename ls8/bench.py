@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks.
+Runs the example programs and the stress programs in benchmarks/ on each
+execution engine, reporting instructions per second, wall time and peak
+memory. Results can be saved as a JSON baseline, and a later run compared
+against it fails if throughput dropped by more than a threshold.
+
+Usage: bench.py [--engines interp,jit,aot,vector] [--save FILE]
+                [--compare FILE] [--threshold PCT] [programs...]
+"""
+
+import argparse
+import glob
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+from cpu import CPU, FAULT
+from console import Console
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Programs that never halt (interrupts.ls8, keyboard.ls8) stop here
+MAX_CYCLES = 2000000
+# Vector runs are capped in steps, each step running every lane
+VECTOR_LANES = 256
+VECTOR_STEPS = 5000
+# Every program runs at least REPEAT times, and short ones are repeated
+# until they have run for MIN_SECONDS; the fastest run is reported
+REPEAT = 3
+MIN_SECONDS = 0.1
+
+
+def default_programs():
+    programs = sorted(glob.glob(os.path.join(HERE, "examples", "*.ls8")))
+    programs += sorted(glob.glob(os.path.join(HERE, "benchmarks", "*.ls8")))
+    return programs
+
+
+def run_scalar(path, jit=False, aot=False):
+    """
+    Run a program once on a CPU. Returns (instructions, seconds, status),
+    counting only the instructions run, not idle loops skipped over.
+    """
+
+    cpu = CPU(jit=jit, aot=aot, console=Console(collect=True))
+    cpu.load(path)
+
+    start = time.perf_counter()
+    result = cpu.run(max_cycles=MAX_CYCLES)
+    seconds = time.perf_counter() - start
+
+    status = "error" if result.status == FAULT else result.status
+    return result.cycles - cpu.idle_cycles, seconds, status
+
+
+def run_vector(path):
+    """Run a program on VECTOR_LANES lanes; counts every lane's instructions."""
+
+    from vector import VectorCPU
+
+    vcpu = VectorCPU.from_file(path, VECTOR_LANES)
+
+    start = time.perf_counter()
+    vcpu.run(max_cycles=VECTOR_STEPS)
+    seconds = time.perf_counter() - start
+
+    if vcpu.faulted.any():
+        status = "error"
+    elif vcpu.running.any():
+        status = "cycle_limit"
+    else:
+        status = "halted"
+
+    return int(vcpu.cycles.sum()), seconds, status
+
+
+ENGINES = {
+    "interp": lambda path: run_scalar(path, jit=False),
+    "jit": lambda path: run_scalar(path, jit=True),
+    # the first run translates; later ones reuse the module
+    "aot": lambda path: run_scalar(path, aot=True),
+    "vector": run_vector,
+}
+
+
+def available_engines():
+    names = ["interp", "jit", "aot"]
+    try:
+        import numpy  # noqa: F401
+        names.append("vector")
+    except ImportError:
+        pass
+    return names
+
+
+def measure(engine, path, memory=True):
+    """
+    Benchmark one program on one engine.
+    Returns a dict with instructions and seconds of the fastest run, ips,
+    runs, peak_bytes and status.
+    """
+
+    run = ENGINES[engine]
+    best = None
+    total = 0.0
+    runs = 0
+
+    while runs < REPEAT or total < MIN_SECONDS:
+        n, t, status = run(path)
+        total += t
+        runs += 1
+        if best is None or n * best[1] > best[0] * t:
+            best = (n, t)
+        if n == 0:
+            break
+
+    instructions, seconds = best
+    result = {
+        "instructions": instructions,
+        "seconds": seconds,
+        "ips": instructions / seconds if seconds else 0.0,
+        "runs": runs,
+        "status": status,
+        "peak_bytes": None,
+    }
+
+    if memory:
+        # separate run, since tracing allocations slows everything down
+        tracemalloc.start()
+        try:
+            run(path)
+            result["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return result
+
+
+def run_benchmarks(programs, engines, memory=True):
+    results = {}
+
+    for path in programs:
+        name = os.path.relpath(path, HERE)
+        for engine in engines:
+            results[f"{name}:{engine}"] = measure(engine, path, memory)
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Return the benchmarks whose ips fell more than threshold percent
+    below the baseline, as (name, old ips, new ips, percent change).
+    """
+
+    regressions = []
+
+    for name, old in baseline.items():
+        new = results.get(name)
+        if new is None or not old["ips"]:
+            continue
+
+        change = (new["ips"] - old["ips"]) / old["ips"] * 100
+        if change < -threshold:
+            regressions.append((name, old["ips"], new["ips"], change))
+
+    return regressions
+
+
+def print_results(results):
+    print(f"{'benchmark':<36} {'MIPS':>8} {'seconds':>9} {'peak KiB':>9}  status")
+    for name, r in results.items():
+        peak = "-" if r["peak_bytes"] is None else f"{r['peak_bytes'] / 1024:.1f}"
+        print(f"{name:<36} {r['ips'] / 1e6:8.3f} {r['seconds']:9.3f} "
+              f"{peak:>9}  {r['status']}")
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="bench.py")
+    parser.add_argument("programs", nargs="*")
+    parser.add_argument("--engines",
+                        help="comma separated engines (default: all available)")
+    parser.add_argument("--save", help="write results as a JSON baseline")
+    parser.add_argument("--compare", help="JSON baseline to check against")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="allowed drop in throughput, in percent")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip the peak memory runs")
+    args = parser.parse_args(argv[1:])
+
+    programs = args.programs or default_programs()
+    if args.engines:
+        engines = args.engines.split(",")
+    else:
+        engines = available_engines()
+
+    for engine in engines:
+        if engine not in ENGINES:
+            print(f"unknown engine: {engine}", file=sys.stderr)
+            return 2
+
+    results = run_benchmarks(programs, engines, memory=not args.no_memory)
+    print_results(results)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"python": platform.python_version(),
+                       "results": results}, f, indent=2)
+            f.write("\n")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+
+        regressions = compare(results, baseline, args.threshold)
+        for name, old, new, change in regressions:
+            print(f"REGRESSION {name}: {old / 1e6:.3f} -> {new / 1e6:.3f} "
+                  f"MIPS ({change:+.1f}%)", file=sys.stderr)
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+"""
+Client.
+A thin stand-in for ls8.py that runs programs on a warm daemon (see
+daemon.py) instead of starting an emulator of its own. It only reads the
+program and talks to the socket, so it starts quickly.
+
+    python3 daemon.py &
+    python3 client.py examples/print8.ls8
+
+Protocol: the client sends one JSON line,
+
+    {"program": "<256 bytes of RAM as hex>", "max_cycles": null,
+     "time_limit": null, "jit": false, "realtime": true}
+
+followed by key presses until it shuts down its side of the socket. The
+daemon answers with frames of a kind byte and a big endian length:
+OUTPUT frames carry console output as it's produced, and a final RESULT
+frame carries {"status", "cycles", "error", "pc"} as JSON.
+"""
+
+import argparse
+import json
+import os
+import socket
+import struct
+import sys
+
+from image import is_image, load_image
+
+# Frame header: kind, payload length
+FRAME = struct.Struct(">cI")
+OUTPUT = b"o"
+RESULT = b"r"
+
+
+def default_socket():
+    """The daemon's socket: $LS8_SOCKET, or one per user in the temp dir."""
+
+    path = os.environ.get("LS8_SOCKET")
+    if path:
+        return path
+    # tempfile.gettempdir() would cost more to import than the rest of
+    # the client
+    tmp = os.environ.get("TMPDIR", "/tmp")
+    return os.path.join(tmp, f"ls8-{os.getuid()}.sock")
+
+
+def read_program(filename):
+    """Return the 256 bytes of RAM a program loads into, like CPU.load."""
+
+    ram = bytearray(256)
+
+    if is_image(filename):
+        load_image(filename, ram)
+
+    else:
+        address = 0
+        with open(filename) as f:
+            for line in f:
+                n = line.split('#')[0].strip()
+                if n:
+                    ram[address] = int(n, 2)
+                    address += 1
+
+    return ram
+
+
+def read_exactly(sock, n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError("daemon closed the connection")
+        data += chunk
+    return bytes(data)
+
+
+def request(ram, keys=b"", path=None, max_cycles=None, time_limit=None,
+            jit=False, out=None, realtime=True):
+    """
+    Run a program on the daemon, writing its output to out (a binary
+    file, sys.stdout's buffer by default) as it arrives. Returns the
+    result dict.
+    """
+
+    out = sys.stdout.buffer if out is None else out
+    header = {"program": bytes(ram).hex(), "max_cycles": max_cycles,
+              "time_limit": time_limit, "jit": jit, "realtime": realtime}
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(default_socket() if path is None else path)
+        sock.sendall(json.dumps(header).encode() + b"\n" + bytes(keys))
+        # no more keys
+        sock.shutdown(socket.SHUT_WR)
+
+        while True:
+            kind, length = FRAME.unpack(read_exactly(sock, FRAME.size))
+            payload = read_exactly(sock, length)
+            if kind == OUTPUT:
+                out.write(payload)
+                out.flush()
+            elif kind == RESULT:
+                return json.loads(payload)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="client.py")
+    parser.add_argument("file", metavar="filename")
+    parser.add_argument("--socket", help="daemon socket path")
+    parser.add_argument("--jit", action="store_true",
+                        help="compile hot basic blocks")
+    parser.add_argument("--no-realtime", dest="realtime",
+                        action="store_false",
+                        help="skip idle time instead of waiting it out")
+    parser.add_argument("--max-cycles", type=int,
+                        help="instructions the program may run")
+    parser.add_argument("--time-limit", type=float,
+                        help="seconds the program may run")
+    parser.add_argument("--input", metavar="FILE",
+                        help="bytes to press as keys ('-' for stdin)")
+    args = parser.parse_args(argv[1:])
+
+    try:
+        ram = read_program(args.file)
+    except FileNotFoundError:
+        print(f"{argv[0]}: {args.file} not found")
+        return 1
+
+    keys = b""
+    if args.input == "-":
+        keys = sys.stdin.buffer.read()
+    elif args.input:
+        with open(args.input, "rb") as f:
+            keys = f.read()
+
+    path = args.socket or default_socket()
+    try:
+        result = request(ram, keys, path, args.max_cycles, args.time_limit,
+                         args.jit, realtime=args.realtime)
+    except (FileNotFoundError, ConnectionRefusedError):
+        print(f"{argv[0]}: no daemon listening on {path}", file=sys.stderr)
+        return 1
+
+    status = result["status"]
+    if status == "halted":
+        return 0
+    if status == "idle":
+        print(f"{argv[0]}: waiting for a key press, stopping",
+              file=sys.stderr)
+        return 0
+    if status == "fault":
+        print(f"{argv[0]}: fault at PC 0x{result['pc']:02X}: "
+              f"{result['error']}", file=sys.stderr)
+    elif status == "error":
+        print(f"{argv[0]}: {result['error']}", file=sys.stderr)
+    else:
+        print(f"{argv[0]}: stopped: {status}", file=sys.stderr)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
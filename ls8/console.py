@@ -0,0 +1,83 @@
+"""
+Console output device.
+PRN and PRA write into a buffer that is flushed to the sink in one go at
+HLT, when the buffer fills up, or on an explicit flush(), instead of
+calling print() for every instruction.
+"""
+
+import io
+import sys
+
+# Bytes held before the buffer is flushed
+BUFFER_SIZE = 8192
+
+
+class Console:
+    """Buffered output device attached to a CPU."""
+
+    def __init__(self, sink=None, buffer_size=None, collect=False):
+        """
+        sink is a text or binary file; None means sys.stdout at flush time.
+        With collect=True nothing is written anywhere and the output is
+        kept for getvalue().
+        buffer_size defaults to BUFFER_SIZE, or to flushing every write
+        when the sink is a terminal, like stdio's line buffering.
+        """
+
+        self.sink = sink
+        self.collect = collect
+        self.buf = bytearray()
+
+        if collect:
+            self.limit = None
+        elif buffer_size is not None:
+            self.limit = buffer_size
+        elif self.isatty():
+            self.limit = 0
+        else:
+            self.limit = BUFFER_SIZE
+
+    def isatty(self):
+        sink = sys.stdout if self.sink is None else self.sink
+        try:
+            return sink.isatty()
+        except (AttributeError, ValueError):
+            return False
+
+    def write(self, data):
+        """Queue bytes for output."""
+
+        buf = self.buf
+        buf += data
+        if self.limit is not None and len(buf) >= self.limit:
+            self.flush()
+
+    def flush(self):
+        """Write out everything buffered so far."""
+
+        if self.collect or not self.buf:
+            return
+
+        sink = sys.stdout if self.sink is None else self.sink
+        data = bytes(self.buf)
+        self.buf.clear()
+
+        # PRA writes one byte per character, so latin-1 maps it back to the
+        # same character print(chr(value)) would have written
+        if isinstance(sink, io.TextIOBase):
+            sink.write(data.decode("latin-1"))
+        else:
+            sink.write(data)
+        sink.flush()
+
+    def getvalue(self):
+        """Everything collected so far (collect=True only)."""
+
+        return bytes(self.buf)
+
+    def take(self):
+        """Everything collected so far, emptying the buffer."""
+
+        data = bytes(self.buf)
+        self.buf.clear()
+        return data
@@ -3,9 +3,21 @@ CPU functionality.
 Constructor that contains all of the instructions for the CPU
 """
 
-import sys
-from main_ops import main_branch
-from alu_ops import alu_branch
+import time
+from collections import namedtuple
+
+from main_ops import main_branch, handle_NOP, LDI, NOP
+from alu_ops import alu_branch, alu_opcodes, CMP
+from jit import JIT
+from aot import AOT, DEFAULT_CACHE_DIR
+from fusion import fuse, HEADS, MAX_SPAN, MAX_COUNT
+from image import is_image, load_image
+from console import Console
+from profiler import Profiler
+from tracer import Tracer
+from debugger import Debugger
+from devices import device_branch
+import snapshot
 
 # Branchtable variables
 HLT = 0b00000001 
@@ -20,15 +32,71 @@ JLT = 0b01011000
 JMP = 0b01010100
 JNE = 0b01010110
 
+# Instructions that set the PC themselves
+JUMPS = frozenset([CALL, RET, JEQ, JGE, JGT, JLE, JLT, JMP, JNE, IRET])
+
+# Conditional jumps, and the FL bits that make each one jump
+# (JNE jumps when E is clear)
+CONDITIONS = {JEQ: 0b001, JGT: 0b010, JLT: 0b100, JGE: 0b011, JLE: 0b101,
+              JNE: 0b001}
+
+# Cycle limit used when run() is not given one
+NO_LIMIT = 1 << 62
+
+# Instructions run between checks of a run() deadline
+DEADLINE_SLICE = 10000
+
+# What run() and step() return: why the CPU stopped, the instructions it
+# ran, and the exception for a fault
+Result = namedtuple("Result", ["status", "cycles", "error"])
+
+# Result statuses
+HALTED = "halted"
+CYCLE_LIMIT = "cycle_limit"
+TIME_LIMIT = "time_limit"
+FAULT = "fault"
+# idle, waiting for an event only the host can deliver (a key press)
+IDLE = "idle"
+# stopped at a breakpoint or watchpoint (see debugger.py)
+BREAK = "break"
+
+# Instructions in one virtual second
+CYCLES_PER_SECOND = 1000000
+
+# Cycles between timer interrupts (one virtual second)
+TIMER_PERIOD = CYCLES_PER_SECOND
+
+# Cleared decoded entries written over by ram_write
+CLEAR_SPAN = [None] * MAX_SPAN
+
+# Interrupt vectors I0-I7 live at 0xF8-0xFF
+VECTOR_TABLE = 0xF8
+# Most recent key pressed
+KEY_ADDRESS = 0xF4
+
 
 class CPU:
     """Main CPU class."""
 
-    def __init__(self):
-        # ram that holds 256 bytes (list of 0)
-        self.ram = [0] * 256
-        # 8 registers (list of 0)
-        self.reg = [0] * 8
+    # fixed set of attributes keeps instances small and lookups fast
+    __slots__ = ('ram', 'reg', 'pc', 'is_running', 'FL', 'cycles',
+                 'interrupts_enabled', 'timer_period', 'next_timer',
+                 'timer_written', 'idle', 'idle_cycles', 'busy_loops',
+                 'realtime', 'decoded', 'fuse', 'jit', 'console',
+                 'profiler', 'tracer', 'debugger', 'devices', 'mapped',
+                 'aot')
+
+    # branch tables are shared by every CPU
+    main_branch = main_branch
+    alu_branch = alu_branch
+
+    def __init__(self, jit=False, console=None, timer_period=TIMER_PERIOD,
+                 profile=False, trace=None, fuse=True, realtime=False,
+                 aot=False):
+        # ram that holds 256 bytes (bytearray of 0)
+        self.ram = bytearray(256)
+        # 8 registers (bytearray of 0)
+        self.reg = bytearray(8)
         # reg7 resets/defaults to 0xF4
         self.reg[7] = 0XF0
         # internal pc register = 0
@@ -37,26 +105,194 @@ class CPU:
         self.is_running = False
         # use pattern 00000LGE for FL register
         self.FL = 0b00000000
-        # use R5 for interrupt mask, R6 for interrupt status
-        self.IM = self.reg[5]
-        self.IS = self.reg[6]
-        self.main_branch = main_branch
-        self.alu_branch = alu_branch
+        # instructions executed since power on
+        self.cycles = 0
+        # cleared while an interrupt handler runs
+        self.interrupts_enabled = True
+        # the timer interrupt fires every timer_period cycles
+        self.timer_period = timer_period
+        self.next_timer = timer_period
+        # set by a write to the timer period (see devices.TimerPort);
+        # stops execution so run() can restart the timer from the cycle
+        # count the loop keeps to itself
+        self.timer_written = False
+        # set by a JMP that closes an idle loop; stops execution so run()
+        # can skip ahead to the next interrupt
+        self.idle = False
+        # the part of cycles that idle loops skipped rather than ran
+        self.idle_cycles = 0
+        # start of a short loop known not to be idle, by JMP address
+        self.busy_loops = [None] * 256
+        # sleep through skipped idle time, so the virtual clock keeps
+        # pace with the wall clock
+        self.realtime = realtime
+        # decoded instruction cache, one entry per address (None = not decoded)
+        self.decoded = [None] * 256
+        # fuse common instruction sequences into one decoded entry; off
+        # while profiling or tracing, which want every instruction
+        self.fuse = fuse and not profile and not trace
+        # optional translation cache of compiled blocks
+        self.jit = JIT(self) if jit else None
+        # output device for PRN and PRA
+        self.console = Console() if console is None else console
+        # optional profiler; run() uses its counting loop while attached
+        self.profiler = Profiler(self) if profile else None
+        # optional execution trace: True keeps it in memory, a filename
+        # also dumps it there when the program halts or crashes
+        if trace:
+            dump_path = None if trace is True else trace
+            self.tracer = Tracer(self, dump_path=dump_path)
+        else:
+            self.tracer = None
+        # attached by debug(); run() only uses its checking loop while
+        # something is armed
+        self.debugger = None
+        # memory-mapped device at each address (None = plain RAM), and
+        # whether there are any; see attach()
+        self.devices = [None] * 256
+        self.mapped = False
+        # optional ahead-of-time translation of the whole program: True
+        # caches it in the default directory, a path caches it there
+        if aot:
+            cache_dir = DEFAULT_CACHE_DIR if aot is True else aot
+            self.aot = AOT(self, cache_dir=cache_dir)
+        else:
+            self.aot = None
 
+    # use R5 for interrupt mask, R6 for interrupt status
+    @property
+    def IM(self):
+        return self.reg[5]
 
+    @IM.setter
+    def IM(self, value):
+        self.reg[5] = value & 0xFF
+
+    @property
+    def IS(self):
+        return self.reg[6]
+
+    @IS.setter
+    def IS(self, value):
+        self.reg[6] = value & 0xFF
 
     def ram_read(self, MAR): # MAR = Memory address register
         # uses an address to read and returns the value stored at that address
         return self.ram[MAR]
 
+    def bus_read(self, MAR):
+        # like ram_read, but a device mapped at the address answers instead
+        device = self.devices[MAR]
+        if device is None:
+            return self.ram[MAR]
+        return device.read(self, MAR) & 0xFF
+
+    def bus_write(self, MAR, MDR):
+        # like ram_write, but a device mapped at the address takes the value
+        device = self.devices[MAR]
+        if device is None:
+            self.ram_write(MAR, MDR)
+        else:
+            device.write(self, MAR, MDR & 0xFF)
+
+    def attach(self, device, address, size=1):
+        """
+        Map a device (see devices.py) over size addresses from address.
+        LD and ST on those addresses go to the device from now on.
+        Raises ValueError if any of them is already mapped.
+        """
+
+        if address < 0 or address + size > 256:
+            raise ValueError("device does not fit in the address space")
+        for MAR in range(address, address + size):
+            if self.devices[MAR] is not None:
+                raise ValueError(f"address 0x{MAR:02X} is already mapped")
+
+        self.devices[address:address + size] = [device] * size
+        self.remap()
+
+    def detach(self, device):
+        """Unmap a device from every address it was attached to."""
+
+        self.devices[:] = [None if d is device else d for d in self.devices]
+        self.remap()
+
+    def remap(self):
+        self.mapped = any(d is not None for d in self.devices)
+        # LD and ST decode (and compile) differently with devices mapped
+        self.decoded[:] = [None] * 256
+        if self.jit is not None:
+            self.jit.flush()
+        if self.aot is not None:
+            self.aot.flush()
+
     def ram_write(self, MAR, MDR): # MDR = Memory data register
-        self.ram[MAR] = MDR
+        # RAM only holds bytes, so wrap the value around to 0 - 255
+        self.ram[MAR] = MDR & 0xFF
+        # drop any decoded instruction or fused sequence that covers this
+        # byte; plain instructions can also wrap around from the top
+        decoded = self.decoded
+        if MAR >= MAX_SPAN - 1:
+            decoded[MAR - MAX_SPAN + 1:MAR + 1] = CLEAR_SPAN
+        else:
+            decoded[:MAR + 1] = CLEAR_SPAN[:MAR + 1]
+            decoded[MAR - 1] = decoded[MAR - 2] = None
+        if self.jit is not None:
+            self.jit.invalidate(MAR)
+        if self.aot is not None:
+            self.aot.invalidate(MAR)
+
+    def decode(self, pc):
+        """
+        Decode the instruction at pc and store it in the decoded cache.
+        Returns (handler, operand_a, operand_b, add_to_pc, count); add_to_pc
+        is 0 for instructions that set the PC themselves, and count is the
+        number of instructions the entry runs (more than 1 for a fused
+        sequence, see fusion.py).
+        """
+
+        entry = self.decode_one(pc)
+        if self.fuse and self.ram[pc] in HEADS:
+            entry = fuse(self.ram, pc) or entry
+
+        self.decoded[pc] = entry
+        return entry
+
+    def decode_one(self, pc):
+        """Decode just the instruction at pc, without fusing or caching."""
+
+        ir = self.ram[pc]
+        operand_a = self.ram[(pc + 1) & 0xFF]
+        operand_b = self.ram[(pc + 2) & 0xFF]
+
+        if self.mapped and ir in device_branch:
+            handler = device_branch[ir]
+        elif ir in self.main_branch:
+            handler = self.main_branch[ir]
+        else:
+            # unknown opcodes are skipped like a NOP
+            handler = self.alu_branch.get(ir, handle_NOP)
+
+        if ir in JUMPS:
+            add_to_pc = 0
+        else:
+            add_to_pc = (ir >> 6) + 1
+
+        return (handler, operand_a, operand_b, add_to_pc, 1)
 
 
     def load(self, filename):
-        """Load a program into memory."""
+        """
+        Load a program into memory.
+        Binary images (see image.py) are mapped and copied in one go;
+        anything else is read as the text .ls8 format.
+        Raises FileNotFoundError if the file is missing.
+        """
 
-        try:
+        if is_image(filename):
+            load_image(filename, self.ram)
+
+        else:
             address = 0
             with open(filename) as f:
                 for line in f:
@@ -66,129 +302,371 @@ class CPU:
                         value = int(n,2)
                         self.ram[address] = value
                         address += 1
+
+        # RAM was written directly, so start with an empty cache
+        self.decoded[:] = [None] * 256
+        self.busy_loops[:] = [None] * 256
+        if self.jit is not None:
+            self.jit.flush()
+        if self.aot is not None:
+            self.aot.flush()
         
-        except FileNotFoundError:
-            print(f"{sys.argv[0]}: {filename} not found")
-        
+
+    def snapshot(self):
+        """Return the CPU state as an immutable bytes blob."""
+        return snapshot.pack(self)
+
+    def restore(self, blob):
+        """Put the CPU back into the state captured by snapshot()."""
+        snapshot.unpack(blob, self)
+
+        # RAM was written directly, so start with an empty cache
+        self.decoded[:] = [None] * 256
+        self.busy_loops[:] = [None] * 256
+        if self.jit is not None:
+            self.jit.flush()
+        if self.aot is not None:
+            self.aot.flush()
+
+    @classmethod
+    def from_snapshot(cls, blob, **kwargs):
+        """Make a new CPU in the state captured by a snapshot."""
+        cpu = cls(**kwargs)
+        cpu.restore(blob)
+        return cpu
+
+    def fork(self, console=None):
+        """
+        Make an independent copy of this CPU with the same engine
+        settings (JIT, AOT, fusion, realtime, profiling and tracing) and
+        its own console. The timer period comes with the snapshot. A
+        profiled or traced copy starts with empty counts and an empty
+        trace, kept in memory so it doesn't overwrite this CPU's dump file.
+        """
+        cpu = type(self).from_snapshot(self.snapshot(),
+                                       jit=self.jit is not None,
+                                       aot=self.aot is not None,
+                                       console=console,
+                                       timer_period=self.timer_period,
+                                       profile=self.profiler is not None,
+                                       trace=self.tracer is not None,
+                                       fuse=self.fuse,
+                                       realtime=self.realtime)
+        if self.aot is not None:
+            cpu.aot.cache_dir = self.aot.cache_dir
+        # the copy shares this CPU's devices
+        if self.mapped:
+            cpu.devices[:] = self.devices
+            cpu.remap()
+        return cpu
+
+    def save_snapshot(self, filename):
+        snapshot.write(filename, self.snapshot())
+
+    def load_snapshot(self, filename):
+        self.restore(snapshot.read(filename))
 
     def alu(self, op, reg_a, reg_b):
         """
         ALU operations.
-        Operations which perform math must bitwise-AND 
-        w/ 0xFF (255) to ensure they stay in the range
-        of 0 - 255
+        Looks up the handler for the named operation in the ALU branch
+        table; each handler bitwise-ANDs its result with 0xFF (255) to
+        keep it in the range of 0 - 255
         """
 
-        if op == "ADD":
-            self.reg[reg_a] += self.reg[reg_b]
-            self.reg[reg_a] &= 0xFF
-
-        elif op == 'MUL':
-            self.reg[reg_a] *= self.reg[reg_b]
-            self.reg[reg_a] &= 0xFF
-
-        elif op == 'AND':
-            self.reg[reg_a] &= self.reg[reg_b]
-            self.reg[reg_a] &= 0xFF
+        if op not in alu_opcodes:
+            raise Exception("Unsupported ALU operation")
 
-        elif op == 'CMP':
-            if self.reg[reg_a] == self.reg[reg_b]:
-                # set E to true and leave others alone
-                self.FL = self.FL | 0b00000001
-            elif self.reg[reg_a] > self.reg[reg_b]:
-                # set G to true and leave others alone
-                self.FL = self.FL | 0b00000010
-            elif self.reg[reg_a] < self.reg[reg_b]:
-                # set L to true and leave others alone
-                self.FL = self.FL | 0b00000100
+        self.alu_branch[alu_opcodes[op]](self, reg_a, reg_b)
 
-        elif op == 'DEC':
-            self.reg[reg_a] -= 1
-            self.reg[reg_a] &= 0xFF
+    def trace(self):
+        """
+        Handy function to print out the CPU state. You might want to call this
+        from run() if you need help debugging.
+        """
 
-        elif op == 'DIV':
-            if self.reg[reg_b]:
-                self.reg[reg_a] /= self.reg[reg_b]
+        print(f"TRACE: %02X | %02X %02X %02X |" % (
+            self.pc,
+            #self.fl,
+            #self.ie,
+            self.ram_read(self.pc),
+            self.ram_read((self.pc + 1) & 0xFF),
+            self.ram_read((self.pc + 2) & 0xFF)
+        ), end='')
 
-            else:
-                self.main_branch[HLT]
-                raise Exception("Cannot divide by 0")
+        for i in range(8):
+            print(" %02X" % self.reg[i], end='')
 
-        elif op == 'INC':
-            self.reg[reg_a] += 1
-            self.reg[reg_a] &= 0xFF
+        print()
 
-        elif op == 'MOD':
-            if self.reg[reg_b]: 
-                self.reg[reg_a] %= self.reg[reg_b]
+    def raise_interrupt(self, n):
+        """Set bit n of IS, as an external device would."""
+        self.reg[6] |= 1 << n
 
-            else:
-                self.main_branch[HLT]
-                raise Exception("Cannot divide by 0")
+    def key_press(self, key):
+        """Latch a key into 0xF4 and raise the keyboard interrupt (I1)."""
+        self.ram_write(KEY_ADDRESS, key)
+        self.raise_interrupt(1)
 
-        elif op == 'NOT':
-            self.reg[reg_a] = self.reg[reg_a] ^ 0b11111111
+    def tick_timer(self):
+        """
+        Raise the timer interrupt (I0) and schedule the next tick.
+        Ticks that arrive while I0 is masked off in IM are dropped, so
+        programs that don't use interrupts never see R6 change.
+        """
+        if self.reg[5] & 1:
+            self.reg[6] |= 1
+        self.next_timer += self.timer_period
 
-        elif op == 'OR':
-            self.reg[reg_a] |= self.reg[reg_b]
+    def interrupt(self):
+        """
+        Service the lowest numbered pending interrupt in IM & IS:
+        push PC, FL and R0-R6, then jump through the vector table.
+        """
+        reg = self.reg
+        masked = reg[5] & reg[6]
+        # isolate the lowest set bit
+        n = (masked & -masked).bit_length() - 1
 
-        elif op == 'SHL':
-            self.reg[reg_a] = (self.reg[reg_a] << self.reg[reg_b])
+        self.interrupts_enabled = False
+        reg[6] &= ~(1 << n) & 0xFF
 
-        elif op == 'SHR':
-            self.reg[reg_a] = (self.reg[reg_a] >> self.reg[reg_b])
+        sp = reg[7]
+        for value in (self.pc, self.FL, *reg[0:7]):
+            sp = (sp - 1) & 0xFF
+            self.ram_write(sp, value)
+        reg[7] = sp
 
-        elif op == 'SUB':
-            self.reg[reg_a] -= self.reg[reg_b]
+        self.pc = self.ram[VECTOR_TABLE + n]
 
-        elif op == 'XOR':
-            self.reg[reg_a] = self.reg[reg_a] ^ self.reg[reg_b]
+    def check_idle(self, start):
+        """
+        Called by a JMP at self.pc back to start. If the loop between them
+        only runs NOP, LDI, CMP and conditional jumps that don't jump, and
+        running it again would leave the registers and FL as they are,
+        the program can only be waiting for an interrupt: set idle and
+        stop execution so run() can skip ahead.
+        """
+        pc = self.pc
 
-        else:
-            raise Exception("Unsupported ALU operation")
+        ram = self.ram
+        reg = bytearray(self.reg)
+        fl = self.FL
+        addr = start
 
-    def trace(self):
+        try:
+            while addr < pc:
+                ir = ram[addr]
+                a = ram[addr + 1]
+                b = ram[addr + 2]
+
+                if ir == LDI:
+                    reg[a] = b
+                elif ir == CMP:
+                    x = reg[a]
+                    y = reg[b]
+                    fl = 1 if x == y else 2 if x > y else 4
+                elif ir in CONDITIONS:
+                    if bool(fl & CONDITIONS[ir]) != (ir == JNE):
+                        # jumps away this time around
+                        return
+                elif ir != NOP:
+                    self.busy_loops[pc] = start
+                    return
+
+                addr += (ir >> 6) + 1
+        except IndexError:
+            # a register operand above R7
+            self.busy_loops[pc] = start
+            return
+
+        if addr != pc:
+            # the instructions don't line up with the JMP
+            self.busy_loops[pc] = start
+            return
+
+        if reg == self.reg and fl == self.FL and \
+                reg[ram[(pc + 1) & 0xFF]] == start:
+            self.idle = True
+            self.is_running = False
+
+    def skip_idle(self, stop, deadline):
         """
-        Handy function to print out the CPU state. You might want to call this
-        from run() if you need help debugging.
+        Skip the cycles an idle program would spend spinning, up to the
+        next timer tick or stop. Returns False if nothing but the host can
+        wake the program up.
+        """
+        reg = self.reg
+        if reg[5] & reg[6] and self.interrupts_enabled:
+            # an interrupt is already due
+            return True
+        if not (self.interrupts_enabled and reg[5] & 1):
+            return False
+
+        wake = min(stop, self.next_timer)
+        skipped = wake - self.cycles
+
+        if self.realtime:
+            # let output so far show up before going to sleep
+            self.console.flush()
+            seconds = skipped / CYCLES_PER_SECOND
+            if deadline is not None:
+                seconds = min(seconds, max(0.0, deadline - time.monotonic()))
+                skipped = min(skipped, int(seconds * CYCLES_PER_SECOND))
+            time.sleep(seconds)
+
+        self.cycles += skipped
+        self.idle_cycles += skipped
+        return True
+
+    def debug(self):
+        """Return the CPU's debugger, attaching one if needed."""
+        if self.debugger is None:
+            self.debugger = Debugger(self)
+        return self.debugger
+
+    def run(self, max_cycles=None, deadline=None):
+        """
+        Run the CPU until HLT, until max_cycles more instructions have run,
+        or until time.monotonic() reaches deadline. Returns a Result; a
+        fault (an exception from an instruction) stops the CPU and is
+        returned rather than raised.
+
+        A program spinning in an idle loop (see check_idle) skips ahead to
+        the next timer tick, counting the skipped cycles. If only a key
+        press could wake it, run() returns with status IDLE. With a
+        debugger armed (see debug()), it returns with status BREAK when a
+        breakpoint or watchpoint is hit.
+
+        The deadline is checked every DEADLINE_SLICE instructions, so it
+        costs nothing per instruction.
+
+        The timer runs off the cycle counter: execution stops at the next
+        tick, the tick is delivered, and execution carries on.
         """
+        # pick the loop once, so nothing is checked per instruction
+        if self.debugger is not None and self.debugger.armed:
+            execute = self.debugger.execute
+        elif self.profiler is not None:
+            execute = self.profiler.execute
+        elif self.tracer is not None:
+            execute = self.tracer.execute
+        elif self.aot is not None:
+            execute = self.aot.execute
+        elif self.jit is not None:
+            execute = self.jit.execute
+        else:
+            execute = self.execute
 
-        print(f"TRACE: %02X | %02X %02X %02X |" % (
-            self.pc,
-            #self.fl,
-            #self.ie,
-            self.ram_read(self.pc),
-            self.ram_read(self.pc + 1),
-            self.ram_read(self.pc + 2)
-        ), end='')
+        return self.run_with(execute, max_cycles, deadline)
 
-        for i in range(8):
-            print(" %02X" % self.reg[i], end='')
+    def step(self, n=1):
+        """
+        Run exactly n instructions (fewer if the CPU halts or faults).
+        Compiled blocks are not used, since they run whole. Returns a
+        Result like run().
+        """
+        if self.debugger is not None and self.debugger.armed:
+            execute = self.debugger.execute
+        elif self.profiler is not None:
+            execute = self.profiler.execute
+        elif self.tracer is not None:
+            execute = self.tracer.execute
+        else:
+            execute = self.execute
 
-        print()
+        return self.run_with(execute, n, None)
 
-    def run(self):
-        """Run the CPU."""
+    def run_with(self, execute, max_cycles, deadline):
+        """The run() loop, using execute(limit) to run instructions."""
         self.is_running = True
+        start = self.cycles
+        stop = NO_LIMIT if max_cycles is None else start + max_cycles
+        status = CYCLE_LIMIT
+        error = None
 
-        while self.is_running:
-            # read the memory address stored in PC and store it in IR(instruction register local to this method)
-            ir = self.ram_read(self.pc)
+        try:
+            while self.is_running and self.cycles < stop:
+                if self.cycles >= self.next_timer:
+                    self.tick_timer()
+                limit = min(stop, self.next_timer)
+                if deadline is not None:
+                    limit = min(limit, self.cycles + DEADLINE_SLICE)
+
+                stopped = execute(limit)
+                if self.timer_written:
+                    # the new period counts from the end of the write
+                    self.timer_written = False
+                    self.is_running = True
+                    self.next_timer = self.cycles + self.timer_period
+                if stopped:
+                    # only the debugger's loop returns anything
+                    status = BREAK
+                    break
+
+                if self.idle:
+                    self.idle = False
+                    self.is_running = True
+                    if not self.skip_idle(stop, deadline):
+                        status = IDLE
+                        break
+
+                if deadline is not None and self.is_running and \
+                        time.monotonic() >= deadline:
+                    status = TIME_LIMIT
+                    break
+
+            if not self.is_running:
+                status = HALTED
+
+        except Exception as e:
+            self.is_running = False
+            status = FAULT
+            error = e
+
+        finally:
+            self.console.flush()
+
+        return Result(status, self.cycles - start, error)
+
+    def execute(self, limit):
+        """
+        Interpret instructions until HLT or until cycles reaches limit.
+        """
+        decoded = self.decoded
+        reg = self.reg
+        cycles = self.cycles
+        # a fused sequence runs whole, so stop short of the limit and
+        # finish one instruction at a time
+        fast_limit = limit - MAX_COUNT + 1 if self.fuse else limit
 
-            operand_a = self.ram_read(self.pc + 1)
-            operand_b = self.ram_read(self.pc + 2)
+        try:
+            while self.is_running and cycles < fast_limit:
+                # one masked test per cycle; IM & IS is almost always 0
+                if reg[5] & reg[6] and self.interrupts_enabled:
+                    self.interrupt()
 
-            add_to_pc = (ir >> 6) + 1
+                pc = self.pc
+                # decode each address once; later visits hit the cache
+                entry = decoded[pc] or self.decode(pc)
+                handler, operand_a, operand_b, add_to_pc, count = entry
 
-            if ir in main_branch.keys():
-                self.main_branch[ir](self, operand_a, operand_b)
-            elif ir in alu_branch.keys():
-                self.alu_branch[ir](self, operand_a, operand_b)
+                handler(self, operand_a, operand_b)
 
-            jumps = [CALL, RET, JEQ, JGE, JGT, JLE, JLT, JMP, JNE, IRET]
+                self.pc = (self.pc + add_to_pc) & 0xFF
+                cycles += count
 
-            if ir not in jumps:
-                self.pc += add_to_pc
+            while self.is_running and cycles < limit:
+                if reg[5] & reg[6] and self.interrupts_enabled:
+                    self.interrupt()
 
+                pc = self.pc
+                handler, operand_a, operand_b, add_to_pc, _ = \
+                    self.decode_one(pc)
 
+                handler(self, operand_a, operand_b)
 
+                self.pc = (self.pc + add_to_pc) & 0xFF
+                cycles += 1
+        finally:
+            self.cycles = cycles
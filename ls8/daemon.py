@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+"""
+Daemon.
+A long-lived emulator server on a Unix socket, so running a program
+doesn't pay for starting Python, importing the emulator and building its
+tables every time. Each connection is a run request (see client.py for
+the protocol); runs are hosted as sessions on one event loop (see
+sessions.py), so many can run at once, and their output is streamed back
+as it's produced.
+
+Programs are decoded once: the decoded cache for a program's RAM image
+is kept and copied into every later run of the same image.
+
+Runs are paced like ls8.py's: a program idling until the next timer
+tick waits for it in real time, so interrupts.ls8 prints once a second.
+A request with "realtime": false skips the idle time instead.
+
+    python3 daemon.py [--socket PATH]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import time
+
+from cpu import CPU, FAULT
+from console import Console
+from client import FRAME, OUTPUT, RESULT, default_socket
+from sessions import Scheduler
+
+# Programs whose decoded caches are kept
+PROGRAM_CACHE = 256
+
+
+class Frames:
+    """Writer that wraps console output in OUTPUT frames for Session."""
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def write(self, data):
+        self.writer.write(FRAME.pack(OUTPUT, len(data)) + data)
+
+    async def drain(self):
+        await self.writer.drain()
+
+
+class Server:
+    """Runs programs for clients on a Unix socket."""
+
+    def __init__(self, path=None, cache_size=PROGRAM_CACHE):
+        self.path = default_socket() if path is None else path
+        self.cache_size = cache_size
+        self.scheduler = Scheduler()
+        # RAM image -> decoded cache entries, oldest first
+        self.programs = {}
+
+    def prepare(self, ram, jit=False):
+        """Return a CPU loaded with ram, with its decoded cache warm."""
+
+        cpu = CPU(jit=jit, console=Console(collect=True))
+        cpu.ram[:] = ram
+
+        decoded = self.programs.get(ram)
+        if decoded is None:
+            # entries only depend on the bytes they cover, and ram_write
+            # drops them when those change, so they can be shared
+            decoded = [cpu.decode(pc) for pc in range(256)]
+            if len(self.programs) >= self.cache_size:
+                del self.programs[next(iter(self.programs))]
+            self.programs[ram] = decoded
+
+        cpu.decoded[:] = decoded
+        return cpu
+
+    async def send_result(self, writer, result):
+        payload = json.dumps(result).encode()
+        writer.write(FRAME.pack(RESULT, len(payload)) + payload)
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        """Serve one run request."""
+
+        try:
+            try:
+                header = json.loads(await reader.readline())
+                ram = bytes.fromhex(header["program"])
+                if len(ram) != 256:
+                    raise ValueError("program must be 256 bytes of RAM")
+                max_cycles = header.get("max_cycles")
+                time_limit = header.get("time_limit")
+                jit = bool(header.get("jit"))
+                realtime = bool(header.get("realtime", True))
+            except (ValueError, KeyError, TypeError) as e:
+                await self.send_result(writer, {
+                    "status": "error", "cycles": 0,
+                    "error": f"bad request: {e}", "pc": None})
+                return
+
+            cpu = self.prepare(ram, jit)
+            deadline = None
+            if time_limit is not None:
+                deadline = time.monotonic() + time_limit
+
+            session = self.scheduler.spawn(cpu, Frames(writer), max_cycles,
+                                           deadline, realtime)
+            feeder = asyncio.create_task(session.feed(reader))
+            try:
+                await session.task
+                result = {"status": session.status, "cycles": cpu.cycles,
+                          "error": None, "pc": cpu.pc}
+            except ConnectionError:
+                # the client went away
+                return
+            except Exception as e:
+                result = {"status": FAULT, "cycles": cpu.cycles,
+                          "error": f"{type(e).__name__}: {e}",
+                          "pc": cpu.pc}
+            finally:
+                feeder.cancel()
+
+            await self.send_result(writer, result)
+
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def listening(self):
+        """Whether another daemon is accepting connections on the path."""
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(self.path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                return False
+            return True
+
+    async def serve(self):
+        """
+        Listen on the socket until cancelled. Raises FileExistsError if
+        another daemon is listening on it already.
+        """
+
+        if os.path.exists(self.path):
+            if self.listening():
+                raise FileExistsError(
+                    f"a daemon is already listening on {self.path}")
+            # a socket left behind by a daemon that didn't shut down
+            # cleanly
+            os.unlink(self.path)
+
+        server = await asyncio.start_unix_server(self.handle, self.path)
+        print(f"daemon.py: listening on {self.path}", file=sys.stderr)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="daemon.py")
+    parser.add_argument("--socket", help="socket path to listen on")
+    args = parser.parse_args(argv[1:])
+
+    try:
+        asyncio.run(Server(args.socket).serve())
+    except FileExistsError as e:
+        print(f"{argv[0]}: {e}", file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
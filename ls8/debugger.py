@@ -0,0 +1,182 @@
+"""
+Debugger.
+PC breakpoints (optionally conditional), conditions checked on every
+instruction, and read/write watchpoints on RAM addresses. While anything
+is armed CPU.run uses the checking loop here instead of its own; with
+nothing armed it runs the normal loop, so an attached debugger costs
+nothing until it's needed.
+
+    dbg = cpu.debug()
+    dbg.break_at(0x1A, lambda cpu: cpu.reg[0] == 5)
+    dbg.watch(0xF4, read=False)
+    result = cpu.run()
+    if result.status == BREAK:
+        print(dbg.hit)
+
+Execution stops before the instruction that hits, so its effects can be
+inspected; the next run() or step() carries on from there. Interrupt
+dispatch pushing onto the stack doesn't trigger watchpoints.
+"""
+
+from collections import namedtuple
+
+from main_ops import LD, POP, RET, IRET, ST, PUSH, CALL
+
+# Why the debugger stopped: kind is "breakpoint", "condition", "read" or
+# "write"; address is the RAM address for a watchpoint, otherwise None
+Hit = namedtuple("Hit", ["kind", "pc", "address"])
+
+# Instructions that read or write RAM (besides fetching themselves)
+MEMORY_OPS = frozenset([LD, POP, RET, IRET, ST, PUSH, CALL])
+
+
+class Debugger:
+    """Breakpoints and watchpoints for one CPU."""
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        # address -> condition (a callable taking the CPU) or None
+        self.breakpoints = {}
+        # conditions checked before every instruction
+        self.conditions = []
+        # watched addresses
+        self.reads = set()
+        self.writes = set()
+        # what stopped execution last
+        self.hit = None
+        # (pc, cycles) where execution stopped, so it can carry on
+        self.stopped = None
+
+    @property
+    def armed(self):
+        return bool(self.breakpoints or self.conditions or self.reads or
+                    self.writes)
+
+    def break_at(self, pc, condition=None):
+        """
+        Stop before the instruction at pc runs; with a condition, only
+        when condition(cpu) is true.
+        """
+
+        self.breakpoints[pc & 0xFF] = condition
+
+    def break_when(self, condition):
+        """Stop before any instruction where condition(cpu) is true."""
+
+        self.conditions.append(condition)
+
+    def watch(self, address, read=True, write=True):
+        """Stop before an instruction reads or writes a RAM address."""
+
+        if read:
+            self.reads.add(address & 0xFF)
+        if write:
+            self.writes.add(address & 0xFF)
+
+    def clear(self, pc=None):
+        """Remove the breakpoint at pc, or everything if pc is None."""
+
+        if pc is None:
+            self.breakpoints.clear()
+            self.conditions.clear()
+            self.reads.clear()
+            self.writes.clear()
+        else:
+            self.breakpoints.pop(pc & 0xFF, None)
+
+    def unwatch(self, address):
+        self.reads.discard(address & 0xFF)
+        self.writes.discard(address & 0xFF)
+
+    def check_access(self, ir, operand_a, operand_b):
+        """Return a Hit if the instruction touches a watched address."""
+
+        reg = self.cpu.reg
+        sp = reg[7]
+
+        if ir == LD:
+            reads, writes = (reg[operand_b],), ()
+        elif ir == POP or ir == RET:
+            reads, writes = (sp,), ()
+        elif ir == IRET:
+            # R6-R0, FL and PC
+            reads, writes = [(sp + i) & 0xFF for i in range(9)], ()
+        elif ir == ST:
+            reads, writes = (), (reg[operand_a],)
+        else:
+            # PUSH and CALL
+            reads, writes = (), ((sp - 1) & 0xFF,)
+
+        pc = self.cpu.pc
+        for address in reads:
+            if address in self.reads:
+                return Hit("read", pc, address)
+        for address in writes:
+            if address in self.writes:
+                return Hit("write", pc, address)
+
+        return None
+
+    def execute(self, limit):
+        """
+        Interpret instructions until HLT or limit, checking breakpoints
+        and watchpoints before each one. Returns True if one was hit.
+        """
+
+        cpu = self.cpu
+        ram = cpu.ram
+        reg = cpu.reg
+        decoded = cpu.decoded
+        breakpoints = self.breakpoints
+        conditions = self.conditions
+        watching = bool(self.reads or self.writes)
+        cycles = cpu.cycles
+
+        # don't stop again on the instruction we stopped at
+        resume = self.stopped == (cpu.pc, cycles)
+        self.stopped = None
+
+        try:
+            while cpu.is_running and cycles < limit:
+                if reg[5] & reg[6] and cpu.interrupts_enabled:
+                    cpu.interrupt()
+                    resume = False
+
+                pc = cpu.pc
+                entry = decoded[pc] or cpu.decode(pc)
+                if entry[4] > 1:
+                    # a fused sequence would run past breakpoints inside it
+                    entry = cpu.decode_one(pc)
+                handler, operand_a, operand_b, add_to_pc, _ = entry
+
+                if resume:
+                    resume = False
+                else:
+                    # conditions may look at the cycle count
+                    cpu.cycles = cycles
+                    hit = None
+                    if pc in breakpoints:
+                        condition = breakpoints[pc]
+                        if condition is None or condition(cpu):
+                            hit = Hit("breakpoint", pc, None)
+                    if hit is None:
+                        for condition in conditions:
+                            if condition(cpu):
+                                hit = Hit("condition", pc, None)
+                                break
+                    if hit is None and watching and ram[pc] in MEMORY_OPS:
+                        hit = self.check_access(ram[pc], operand_a,
+                                                operand_b)
+                    if hit is not None:
+                        self.hit = hit
+                        self.stopped = (pc, cycles)
+                        return True
+
+                handler(cpu, operand_a, operand_b)
+
+                cpu.pc = (cpu.pc + add_to_pc) & 0xFF
+                cycles += 1
+        finally:
+            cpu.cycles = cycles
+
+        return False
@@ -0,0 +1,112 @@
+"""
+Memory-mapped devices.
+Peripherals claim addresses with CPU.attach, and LD and ST on those
+addresses go to the device instead of RAM. The CPU keeps a table with a
+slot per address (None for plain RAM). It only decodes LD and ST to the
+checking handlers here once something is attached, so programs without
+devices run exactly as before. Instruction fetch, the stack and the
+interrupt vectors always use RAM.
+
+    cpu.attach(ConsolePort(), CONSOLE_ADDRESS)
+    cpu.attach(Port(read=lambda address: random.getrandbits(8)), 0xF6)
+"""
+
+from main_ops import LD, ST
+
+# Where the devices below go by default, in the addresses the spec
+# reserves
+CONSOLE_ADDRESS = 0xF5
+TIMER_ADDRESS = 0xF6
+
+# Cycles per unit of the timer period register (1 ms at 1 MHz)
+TIMER_UNIT = 1000
+
+
+class Device:
+    """
+    A peripheral on the bus. The defaults behave like RAM, so a device
+    only overrides the accesses it handles.
+    """
+
+    def read(self, cpu, address):
+        return cpu.ram[address]
+
+    def write(self, cpu, address, value):
+        cpu.ram_write(address, value)
+
+
+class Port(Device):
+    """A device made of callbacks: read(address) and write(address, value)."""
+
+    def __init__(self, read=None, write=None):
+        self.on_read = read
+        self.on_write = write
+
+    def read(self, cpu, address):
+        if self.on_read is None:
+            return cpu.ram[address]
+        return self.on_read(address)
+
+    def write(self, cpu, address, value):
+        if self.on_write is None:
+            cpu.ram_write(address, value)
+        else:
+            self.on_write(address, value)
+
+
+class ConsolePort(Device):
+    """One byte: a character written here goes straight to the console."""
+
+    def read(self, cpu, address):
+        return 0
+
+    def write(self, cpu, address, value):
+        cpu.console.write(bytes((value,)))
+
+
+class TimerPort(Device):
+    """
+    Two bytes, little endian: the timer period in TIMER_UNITs of cycles.
+    Writing it restarts the timer with the new period. The loop running
+    the write keeps the cycle count in a local, so the write stops it
+    and run() restarts the timer.
+    """
+
+    def __init__(self, address=TIMER_ADDRESS):
+        self.address = address
+
+    def read(self, cpu, address):
+        units = cpu.timer_period // TIMER_UNIT
+        return (units >> 8 * (address - self.address)) & 0xFF
+
+    def write(self, cpu, address, value):
+        shift = 8 * (address - self.address)
+        units = cpu.timer_period // TIMER_UNIT
+        units = units & ~(0xFF << shift) | value << shift
+        # a period of 0 would tick every cycle forever
+        cpu.timer_period = max(units, 1) * TIMER_UNIT
+        cpu.timer_written = True
+        cpu.is_running = False
+
+
+def handle_LD(self, operand_a, operand_b):
+    address = self.reg[operand_b]
+    device = self.devices[address]
+    if device is None:
+        self.reg[operand_a] = self.ram[address]
+    else:
+        self.reg[operand_a] = device.read(self, address) & 0xFF
+
+def handle_ST(self, operand_a, operand_b):
+    address = self.reg[operand_a]
+    device = self.devices[address]
+    if device is None:
+        self.ram_write(address, self.reg[operand_b])
+    else:
+        device.write(self, address, self.reg[operand_b])
+
+# Handlers used instead of the plain ones while devices are attached
+device_branch = {
+    LD: handle_LD,
+    ST: handle_ST,
+}
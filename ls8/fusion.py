@@ -0,0 +1,149 @@
+"""
+Superinstructions.
+Programs from asm.py are full of fixed idioms: load an address into a
+register and jump or call through it, and compare then branch. The decoder
+fuses these into one decoded entry, so the interpreter dispatches them
+once instead of two or three times:
+
+    LDI Rn, addr; JMP/Jxx/CALL Rm
+    CMP Ra, Rb; Jxx Rm
+    LDI Rn, addr; CMP Ra, Rb; Jxx Rm
+
+Fused handlers run the same steps as the plain ones, in order. Every
+address keeps its own decoded entry, so a jump into the middle of a fused
+sequence simply decodes and runs the plain instructions from there.
+"""
+
+from main_ops import LDI, CALL, JMP, JEQ, JNE, JGT, JLT, JGE, JLE
+from main_ops import handle_CALL, IDLE_SPAN
+from alu_ops import CMP
+
+# Longest fused sequence in bytes; ram_write drops decoded entries this
+# far back from a written byte
+MAX_SPAN = 8
+
+# Most instructions in a fused sequence
+MAX_COUNT = 3
+
+# Opcodes a fused sequence can start with
+HEADS = frozenset([LDI, CMP])
+
+# Whether each conditional jump is taken, indexed by FL
+TAKEN = {
+    JEQ: tuple(bool(fl & 0b001) for fl in range(256)),
+    JNE: tuple(not fl & 0b001 for fl in range(256)),
+    JGT: tuple(bool(fl & 0b010) for fl in range(256)),
+    JLT: tuple(bool(fl & 0b100) for fl in range(256)),
+    JGE: tuple(bool(fl & 0b011) for fl in range(256)),
+    JLE: tuple(bool(fl & 0b101) for fl in range(256)),
+}
+
+
+def ldi_jmp(m):
+    def handle_LDI_JMP(cpu, operand_a, operand_b):
+        reg = cpu.reg
+        reg[operand_a] = operand_b
+        addr = reg[m]
+        # the JMP may close an idle loop, see handle_JMP
+        pc = cpu.pc + 3
+        if 0 <= pc - addr < IDLE_SPAN and cpu.busy_loops[pc] != addr:
+            cpu.pc = pc
+            cpu.check_idle(addr)
+        cpu.pc = addr
+    return handle_LDI_JMP
+
+
+def ldi_jcc(taken, m):
+    def handle_LDI_Jxx(cpu, operand_a, operand_b):
+        reg = cpu.reg
+        reg[operand_a] = operand_b
+        if taken[cpu.FL]:
+            cpu.pc = reg[m]
+        else:
+            cpu.pc += 5
+    return handle_LDI_Jxx
+
+
+def ldi_call(m):
+    def handle_LDI_CALL(cpu, operand_a, operand_b):
+        cpu.reg[operand_a] = operand_b
+        # CALL pushes the address after itself
+        cpu.pc += 3
+        handle_CALL(cpu, m, 0)
+    return handle_LDI_CALL
+
+
+def cmp_jcc(taken, m):
+    def handle_CMP_Jxx(cpu, operand_a, operand_b):
+        reg = cpu.reg
+        a = reg[operand_a]
+        b = reg[operand_b]
+        fl = 0b001 if a == b else 0b010 if a > b else 0b100
+        cpu.FL = fl
+        if taken[fl]:
+            cpu.pc = reg[m]
+        else:
+            cpu.pc += 5
+    return handle_CMP_Jxx
+
+
+def ldi_cmp_jcc(ra, rb, taken, m):
+    def handle_LDI_CMP_Jxx(cpu, operand_a, operand_b):
+        reg = cpu.reg
+        reg[operand_a] = operand_b
+        a = reg[ra]
+        b = reg[rb]
+        fl = 0b001 if a == b else 0b010 if a > b else 0b100
+        cpu.FL = fl
+        if taken[fl]:
+            cpu.pc = reg[m]
+        else:
+            cpu.pc += 8
+    return handle_LDI_CMP_Jxx
+
+
+def fuse(ram, pc):
+    """
+    Return a fused decoded entry (handler, operand_a, operand_b, 0, count)
+    for the sequence at pc, or None if there isn't one. Sequences never
+    wrap around the top of memory.
+    """
+
+    if pc + 5 > 256:
+        return None
+
+    ir = ram[pc]
+    operand_a = ram[pc + 1]
+    operand_b = ram[pc + 2]
+    next_ir = ram[pc + 3]
+    m = ram[pc + 4]
+
+    # a bad register after the first instruction would fault halfway
+    # through the entry, after the first instruction had already run
+    if m > 7:
+        return None
+
+    if ir == LDI:
+        # R5 and R6 are the interrupt mask and status; the interrupt
+        # check after an LDI to them must not be skipped
+        if operand_a == 5 or operand_a == 6:
+            return None
+
+        if next_ir == JMP:
+            return (ldi_jmp(m), operand_a, operand_b, 0, 2)
+        if next_ir == CALL:
+            return (ldi_call(m), operand_a, operand_b, 0, 2)
+        if next_ir in TAKEN:
+            return (ldi_jcc(TAKEN[next_ir], m), operand_a, operand_b, 0, 2)
+
+        if next_ir == CMP and pc + 8 <= 256:
+            jump = ram[pc + 6]
+            if jump in TAKEN and max(ram[pc + 5], ram[pc + 7]) <= 7:
+                handler = ldi_cmp_jcc(ram[pc + 4], ram[pc + 5],
+                                      TAKEN[jump], ram[pc + 7])
+                return (handler, operand_a, operand_b, 0, 3)
+
+    elif ir == CMP and next_ir in TAKEN:
+        return (cmp_jcc(TAKEN[next_ir], m), operand_a, operand_b, 0, 2)
+
+    return None
@@ -0,0 +1,590 @@
+#!/usr/bin/env python3
+
+"""
+Differential fuzzer.
+Generates random programs from the assembler's opcode table and runs
+each one under the execution engines. The final registers, FL, PC, RAM,
+output and status are compared with a reference: a plain loop over
+main_branch/alu_branch with no decoded cache, fusion, JIT or idle
+skipping. An engine can stop at a different cycle count than the
+reference (an idle loop, or the JIT finishing its block past the limit).
+So every result is compared with the reference state at the same cycle
+count.
+
+Mismatching programs are shrunk to a small reproducer. Batches of seeds
+run across a process pool, and each batch reuses one CPU per engine, so
+it's quick enough to run after every performance change. By default
+only the interpreter, the JIT and the vector engine are checked, at
+about a thousand programs a second per core; --engines all adds the
+rest at about a third of that:
+
+    fuzz.py -n 20000                   # exit status 1 on any mismatch
+    fuzz.py -n 5000 --engines all      # every engine
+    fuzz.py --seed 1234 -n 1 --out .   # replay one program
+
+Programs write R5 and R6 (IM and IS) and use IRET like any other
+register or instruction, so some of them take interrupts. The vectors
+are left at 0, so an interrupt starts the program again from the top.
+The timer ticks every TIMER_PERIOD cycles, so programs that unmask I0
+take timer interrupts too, and idle loops skip ahead to the next tick.
+The reference ticks the timer, takes interrupts and skips idle loops
+the way CPU.run does, and every engine but the vector one must match it
+exactly. The vector engine has no interrupts, so its results from past
+the reference's first interrupt are not compared.
+
+Usage: fuzz.py [-n PROGRAMS] [--seed N] [--workers N] [--engines LIST]
+               [--max-cycles N] [--out DIR]
+"""
+
+import argparse
+import importlib.util
+import os
+import random
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import snapshot
+from cpu import CPU, HALTED, FAULT, JUMPS
+from console import Console
+from main_ops import main_branch, handle_NOP, HLT
+from alu_ops import alu_branch
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ASM_PATH = os.path.join(os.path.dirname(HERE), "asm", "asm.py")
+
+# Cycles each program may run
+MAX_CYCLES = 500
+# Programs per task handed to a worker; the vector engine runs them all
+# as lanes of one batch, which gets cheaper per program the wider it is
+BATCH = 1000
+# Generated code stays below the stack, which starts at 0xEF
+MAX_CODE = 0xC0
+# Cycles between timer ticks; short, so most programs see a few
+TIMER_PERIOD = 97
+# Chance of an idle loop in place of each instruction, so skipping
+# ahead to the next tick gets checked too
+IDLE_LOOPS = 0.02
+
+# How the run ended; engines that stop early for an idle loop count as
+# still running
+RUNNING = "running"
+
+# Final state of one run
+State = namedtuple("State", ["status", "cycles", "pc", "reg", "FL", "ram",
+                             "output", "error"])
+
+# A program that made an engine disagree with the reference
+Failure = namedtuple("Failure", ["seed", "program", "engine", "field",
+                                 "expected", "actual"])
+
+
+def load_opcodes():
+    """The assembler's opcode table, as {mnemonic: (type, opcode)}."""
+
+    spec = importlib.util.spec_from_file_location("asm", ASM_PATH)
+    asm = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(asm)
+
+    return {name: (info["type"], int(info["code"], 2))
+            for name, info in asm.OPCODES.items()}
+
+
+OPCODES = load_opcodes()
+
+# Opcodes the generator picks from
+CHOICES = sorted(op for _, op in OPCODES.values())
+
+
+def generate(rng):
+    """
+    Return a random program as a list of instructions, each a bytes
+    object. LDI values are often instruction addresses, so jumps and
+    calls land on real code. Now and then I0 is unmasked and followed
+    by an idle loop, which CPU.run skips to the next tick.
+    """
+
+    size = {op: t for t, op in OPCODES.values()}
+    ldi = OPCODES["LDI"][1]
+    jmp = OPCODES["JMP"][1]
+    program = []
+    # indexes of the LDIs that idle loops jump through
+    loops = set()
+    length = 0
+    n = rng.randint(1, 40)
+
+    while len(program) < n:
+        if rng.random() < IDLE_LOOPS and length + 9 <= MAX_CODE:
+            target = rng.randrange(8)
+            loops.add(len(program) + 1)
+            program += [bytes([ldi, 5, 1]),
+                        bytes([ldi, target, length + 3]),
+                        bytes([jmp, target])]
+            length += 8
+            continue
+
+        op = rng.choice(CHOICES)
+        op_type = size[op]
+        width = 3 if op_type == 8 else op_type + 1
+        if length + width + 1 > MAX_CODE:
+            break
+
+        operands = [register(rng) for _ in range(min(op_type, 2))]
+        if op_type == 8:
+            operands = [register(rng), rng.randrange(256)]
+
+        program.append(bytes([op] + operands))
+        length += width
+
+    program.append(bytes([HLT]))
+
+    # point some LDIs at instruction boundaries
+    starts = addresses(program)
+    for i, instruction in enumerate(program):
+        if instruction[0] == ldi and i not in loops and rng.random() < 0.6:
+            program[i] = instruction[:2] + bytes([rng.choice(starts)])
+
+    return program
+
+
+def register(rng):
+    # now and then an operand that isn't a register at all, which faults
+    if rng.random() < 0.02:
+        return rng.randrange(8, 256)
+    return rng.randrange(8)
+
+
+def addresses(program):
+    """Start address of each instruction."""
+
+    starts = []
+    addr = 0
+    for instruction in program:
+        starts.append(addr)
+        addr += len(instruction)
+    return starts
+
+
+def image(program):
+    """The 256 bytes of RAM a program loads into."""
+
+    ram = bytearray(256)
+    code = b"".join(program)
+    ram[:len(code)] = code
+    return ram
+
+
+def state(cpu, status, error):
+    if status == HALTED:
+        status = "halted"
+    elif status == FAULT:
+        status = "fault"
+    else:
+        status = RUNNING
+
+    return State(status, cpu.cycles, cpu.pc, bytes(cpu.reg), cpu.FL,
+                 bytes(cpu.ram), cpu.console.getvalue(),
+                 None if error is None else type(error).__name__)
+
+
+def make_cpu(**kwargs):
+    return CPU(console=Console(collect=True), timer_period=TIMER_PERIOD,
+               **kwargs)
+
+
+# Snapshot of a CPU just switched on, with empty RAM
+BLANK = make_cpu().snapshot()
+
+
+def power_on(ram):
+    """Snapshot of a CPU just switched on with ram loaded."""
+
+    return BLANK[:snapshot.RAM_OFFSET] + bytes(ram)
+
+
+class Reference:
+    """
+    The reference loop over one program: a plain loop over
+    main_branch/alu_branch with no decoded cache, fusion or JIT. It
+    runs forward as far as it's asked, so engines that stop at the same
+    cycle count share one run; asking for an earlier count starts again
+    from the top.
+    """
+
+    def __init__(self, cpu, boot):
+        self.cpu = cpu
+        self.boot = boot
+        # states by cycle count
+        self.states = {}
+        # cycle count the first interrupt was taken at (None = none yet)
+        self.first_interrupt = None
+        self.reset()
+
+    def reset(self):
+        self.cpu.restore(self.boot)
+        self.cpu.console.take()
+        self.cpu.is_running = True
+        self.status = RUNNING
+        self.error = None
+
+    def state(self, cycles):
+        """The state after cycles instructions, or at HLT or a fault."""
+
+        if cycles not in self.states:
+            if self.cpu.cycles > cycles:
+                self.reset()
+            self.run(cycles)
+            self.states[cycles] = state(self.cpu, self.status, self.error)
+
+        return self.states[cycles]
+
+    def run(self, max_cycles):
+        cpu = self.cpu
+        reg = cpu.reg
+        mem = cpu.ram
+
+        while cpu.is_running and cpu.cycles < max_cycles:
+            if cpu.cycles >= cpu.next_timer:
+                cpu.tick_timer()
+            if reg[5] & reg[6] and cpu.interrupts_enabled:
+                if self.first_interrupt is None:
+                    self.first_interrupt = cpu.cycles
+                cpu.interrupt()
+
+            pc = cpu.pc
+            ir = mem[pc]
+            handler = main_branch.get(ir) or alu_branch.get(ir, handle_NOP)
+
+            try:
+                handler(cpu, mem[(pc + 1) & 0xFF], mem[(pc + 2) & 0xFF])
+            except Exception as e:
+                cpu.is_running = False
+                self.status = FAULT
+                self.error = e
+                return
+
+            # a jump falling through at the top of memory leaves the PC
+            # past 255; CPU.run wraps it the same way
+            advance = 0 if ir in JUMPS else (ir >> 6) + 1
+            cpu.pc = (cpu.pc + advance) & 0xFF
+            cpu.cycles += 1
+
+            if cpu.idle:
+                # skip ahead to the next tick as CPU.run does; when
+                # nothing can wake the program, engines stop (which
+                # counts as still running) and the reference spins on
+                cpu.idle = False
+                cpu.is_running = True
+                cpu.skip_idle(max_cycles, None)
+
+        if not cpu.is_running:
+            self.status = HALTED
+
+
+def run_engine(cpu, boot, max_cycles):
+    cpu.restore(boot)
+    cpu.console.take()
+    result = cpu.run(max_cycles=max_cycles)
+    return state(cpu, result.status, result.error)
+
+
+def debug_cpu():
+    # the debugger's checking loop, with a condition that never hits
+    cpu = make_cpu()
+    cpu.debug().break_when(lambda cpu: False)
+    return cpu
+
+
+def aot_cpu():
+    # translated in memory, so thousands of programs don't fill the cache
+    cpu = make_cpu(aot=True)
+    cpu.aot.cache_dir = None
+    return cpu
+
+
+def run_vector(images, max_cycles):
+    """Run one program per lane. Returns a State for each."""
+
+    from vector import VectorCPU
+
+    vcpu = VectorCPU(len(images))
+    for i, ram in enumerate(images):
+        vcpu.ram[i] = list(ram)
+    vcpu.run(max_cycles)
+
+    states = []
+    for i in range(len(images)):
+        if vcpu.faulted[i]:
+            status = "fault"
+        elif vcpu.running[i]:
+            status = RUNNING
+        else:
+            status = "halted"
+        output = "".join(vcpu.output[i]).encode("latin-1")
+        # lanes don't keep the exception, only that there was one
+        states.append(State(status, int(vcpu.cycles[i]), int(vcpu.pc[i]),
+                            vcpu.reg[i].tobytes(), int(vcpu.FL[i]),
+                            vcpu.ram[i].tobytes(), output, None))
+    return states
+
+
+# Engines that run one program at a time, by how to make their CPU
+ENGINES = {
+    "interp": make_cpu,
+    "nofuse": lambda: make_cpu(fuse=False),
+    "jit": lambda: make_cpu(jit=True),
+    "profile": lambda: make_cpu(profile=True),
+    "trace": lambda: make_cpu(trace=True),
+    "debug": debug_cpu,
+    "aot": aot_cpu,
+}
+
+# Engines that don't take interrupts where the reference does: the
+# vector engine has none
+INEXACT = frozenset(["vector"])
+
+# Engines checked unless --engines says otherwise. nofuse, profile,
+# trace and debug run copies of the interpreter loop, and the AOT
+# compiles a module for every program, which costs more than all of
+# these together
+DEFAULT_ENGINES = ("interp", "jit", "vector")
+
+
+def available_engines():
+    names = list(ENGINES)
+    try:
+        import numpy  # noqa: F401
+        names.append("vector")
+    except ImportError:
+        pass
+    return names
+
+
+def default_engines():
+    available = available_engines()
+    return [name for name in DEFAULT_ENGINES if name in available]
+
+
+def engine_cpus(engines):
+    """
+    A CPU for the reference and one for each engine but vector, reused
+    from program to program.
+    """
+
+    cpus = {name: ENGINES[name]() for name in engines if name != "vector"}
+    cpus["reference"] = make_cpu(fuse=False)
+    return cpus
+
+
+def compare(actual, reference, exact=True):
+    """
+    Compare an engine's final state with the reference at the same cycle
+    count. Returns (field, expected, actual) for the first difference, or
+    None. An engine that isn't exact about interrupts is only compared up
+    to the reference's first one.
+    """
+
+    # a fault doesn't count the faulting instruction, so give the
+    # reference room to reach it
+    cycles = actual.cycles
+    if actual.status == "fault":
+        cycles += 1
+    expected = reference.state(cycles)
+
+    first = reference.first_interrupt
+    if not exact and first is not None and first < cycles:
+        return None
+
+    for field in State._fields:
+        want = getattr(expected, field)
+        got = getattr(actual, field)
+        if field == "error" and got is None:
+            # the vector engine doesn't keep exceptions
+            continue
+        if want != got:
+            return field, want, got
+
+    return None
+
+
+def check(ram, engines, max_cycles, vector_state=None, cpus=None):
+    """
+    Run one program under every engine, on cpus from engine_cpus if
+    given. Returns (engine, field, expected, actual) for the first
+    mismatch, or None.
+    """
+
+    if cpus is None:
+        cpus = engine_cpus(engines)
+
+    boot = power_on(ram)
+    reference = Reference(cpus["reference"], boot)
+
+    for name in engines:
+        if name == "vector":
+            if vector_state is None:
+                vector_state = run_vector([ram], max_cycles)[0]
+            actual = vector_state
+        else:
+            actual = run_engine(cpus[name], boot, max_cycles)
+
+        mismatch = compare(actual, reference, name not in INEXACT)
+        if mismatch is not None:
+            return (name,) + mismatch
+
+    return None
+
+
+def shrink(program, engines, max_cycles):
+    """
+    Make a failing program smaller while it still fails on the same
+    engine: drop runs of instructions (halving the run length each time
+    nothing more can go), then zero single operands.
+    """
+
+    def fails(candidate):
+        mismatch = check(image(candidate), engines, max_cycles)
+        return mismatch is not None and mismatch[0] == engine
+
+    engine = check(image(program), engines, max_cycles)[0]
+
+    chunk = max(len(program) // 2, 1)
+    while chunk >= 1:
+        i = 0
+        while i < len(program):
+            candidate = program[:i] + program[i + chunk:]
+            if candidate and fails(candidate):
+                program = candidate
+            else:
+                i += chunk
+        chunk //= 2
+
+    for i, instruction in enumerate(program):
+        for j in range(1, len(instruction)):
+            if instruction[j] == 0:
+                continue
+            candidate = list(program)
+            candidate[i] = instruction[:j] + b"\0" + instruction[j + 1:]
+            if fails(candidate):
+                program = candidate
+                instruction = candidate[i]
+
+    return program
+
+
+def fuzz_batch(seed, count, engines, max_cycles):
+    """
+    Check programs for seeds seed .. seed + count - 1.
+    Returns the failures, unshrunk.
+    """
+
+    programs = [generate(random.Random(s)) for s in range(seed, seed + count)]
+    images = [image(p) for p in programs]
+
+    vector_states = [None] * count
+    if "vector" in engines:
+        vector_states = run_vector(images, max_cycles)
+
+    cpus = engine_cpus(engines)
+    failures = []
+    for i, ram in enumerate(images):
+        mismatch = check(ram, engines, max_cycles, vector_states[i], cpus)
+        if mismatch is not None:
+            failures.append(Failure(seed + i, programs[i], *mismatch))
+
+    return failures
+
+
+def disassemble(program):
+    """Text .ls8 listing of a program, loadable by CPU.load."""
+
+    names = {op: name for name, (_, op) in OPCODES.items()}
+    lines = []
+    for addr, instruction in zip(addresses(program), program):
+        name = names.get(instruction[0], "???")
+        operands = ",".join(str(b) for b in instruction[1:])
+        lines.append(f"{instruction[0]:08b} # {addr:02X}: {name} {operands}")
+        lines += [f"{b:08b}" for b in instruction[1:]]
+    return "\n".join(lines) + "\n"
+
+
+def run_fuzz(count, seed=0, workers=None, engines=None, max_cycles=MAX_CYCLES):
+    """
+    Check count programs across a pool of worker processes.
+    Returns the failures, unshrunk, in seed order.
+    """
+
+    engines = default_engines() if engines is None else engines
+
+    batches = [(s, min(BATCH, seed + count - s))
+               for s in range(seed, seed + count, BATCH)]
+    n = len(batches)
+
+    if n < 2 or workers == 1:
+        results = map(fuzz_batch, *zip(*batches), [engines] * n,
+                      [max_cycles] * n)
+        return [f for failures in results for f in failures]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(fuzz_batch, *zip(*batches), [engines] * n,
+                           [max_cycles] * n)
+        return [f for failures in results for f in failures]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="fuzz.py")
+    parser.add_argument("-n", dest="count", type=int, default=10000,
+                        help="number of programs")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the first program")
+    parser.add_argument("--workers", type=int,
+                        help="number of worker processes")
+    parser.add_argument("--engines",
+                        help="comma separated engines, or all (default: "
+                             f"{','.join(DEFAULT_ENGINES)})")
+    parser.add_argument("--max-cycles", type=int, default=MAX_CYCLES,
+                        help="instructions each program may run")
+    parser.add_argument("--out",
+                        help="directory for shrunk reproducers")
+    args = parser.parse_args(argv[1:])
+
+    engines = default_engines()
+    if args.engines == "all":
+        engines = available_engines()
+    elif args.engines:
+        engines = args.engines.split(",")
+    for engine in engines:
+        if engine not in ENGINES and engine != "vector":
+            print(f"unknown engine: {engine}", file=sys.stderr)
+            return 2
+
+    start = time.perf_counter()
+    failures = run_fuzz(args.count, args.seed, args.workers, engines,
+                        args.max_cycles)
+    seconds = time.perf_counter() - start
+
+    print(f"{args.count} programs on {','.join(engines)} in "
+          f"{seconds:.1f}s ({args.count / seconds:.0f}/s), "
+          f"{len(failures)} failed", file=sys.stderr)
+
+    for failure in failures:
+        program = shrink(failure.program, engines, args.max_cycles)
+        engine, field, expected, actual = check(image(program), engines,
+                                                args.max_cycles)
+        print(f"seed {failure.seed}: {engine} differs in {field}: "
+              f"expected {expected!r}, got {actual!r}", file=sys.stderr)
+
+        listing = disassemble(program)
+        if args.out:
+            path = os.path.join(args.out, f"fuzz-{failure.seed}.ls8")
+            with open(path, "w") as f:
+                f.write(listing)
+        else:
+            print(listing, file=sys.stderr)
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,77 @@
+"""
+Binary program images.
+A compact alternative to the text .ls8 format: a small header followed by
+the raw program bytes, which CPU.load copies into RAM in one go.
+
+Header (little endian, 14 bytes):
+    magic         4 bytes  b"LS8\\x00"
+    version       1 byte
+    flags         1 byte   bit 0 set if checksum is valid
+    load address  2 bytes
+    length        2 bytes
+    checksum      4 bytes  zlib.crc32 of the program bytes
+"""
+
+import mmap
+import struct
+import zlib
+
+MAGIC = b"LS8\x00"
+VERSION = 1
+HEADER = struct.Struct("<4sBBHHI")
+FLAG_CHECKSUM = 0b00000001
+
+
+def pack_image(data, load_address=0, checksum=True):
+    """Return the image bytes for a program."""
+
+    data = bytes(data)
+    flags = FLAG_CHECKSUM if checksum else 0
+    crc = zlib.crc32(data) if checksum else 0
+
+    return HEADER.pack(MAGIC, VERSION, flags, load_address, len(data),
+                       crc) + data
+
+
+def is_image(filename):
+    """True if the file starts with the image magic number."""
+
+    with open(filename, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def load_image(filename, ram):
+    """
+    Map an image file and copy its program into ram.
+    Returns the number of bytes loaded.
+    """
+
+    with open(filename, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if len(m) < HEADER.size:
+                raise ValueError(f"{filename}: truncated image header")
+
+            magic, version, flags, address, length, crc = \
+                HEADER.unpack_from(m)
+
+            if magic != MAGIC:
+                raise ValueError(f"{filename}: not an LS-8 image")
+            if version != VERSION:
+                raise ValueError(f"{filename}: unsupported image version {version}")
+            if HEADER.size + length > len(m):
+                raise ValueError(f"{filename}: image is shorter than its header says")
+            if address + length > len(ram):
+                raise ValueError(f"{filename}: program does not fit in RAM")
+
+            # copy straight out of the mapping, without an extra bytes object
+            with memoryview(m) as view:
+                data = view[HEADER.size:HEADER.size + length]
+
+                if flags & FLAG_CHECKSUM and zlib.crc32(data) != crc:
+                    data.release()
+                    raise ValueError(f"{filename}: checksum mismatch")
+
+                ram[address:address + length] = data
+                data.release()
+
+    return length
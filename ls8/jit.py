@@ -0,0 +1,415 @@
+"""
+Basic-block JIT.
+Counts how often each jump target is reached and translates hot blocks
+(straight-line code ending at a CALL/RET/JMP/IRET/HLT, with a side exit
+at each conditional jump) into Python source, compiled once with
+compile() so the whole block runs as one call. Cold code and code that
+keeps rewriting itself stay on the interpreter.
+"""
+
+from main_ops import main_branch, handle_NOP
+from main_ops import (CALL, HLT, INT, IRET, JEQ, JGE, JGT, JLE, JLT, JMP,
+                      JNE, LD, LDI, NOP, POP, PRA, PRN, PUSH, RET, ST,
+                      IDLE_SPAN)
+from alu_ops import alu_branch
+from devices import device_branch
+from alu_ops import (ADD, AND, CMP, DEC, DIV, INC, MOD, MUL, NOT, OR, SHL,
+                     SHR, SUB, XOR)
+
+# Number of visits before a block is compiled
+HOT_THRESHOLD = 50
+# Longest block we will translate, in instructions
+MAX_BLOCK_LEN = 32
+# A block rewritten more often than this stays interpreted
+MAX_RECOMPILES = 4
+
+# Instructions that end a block; conditional jumps only leave it when taken
+BLOCK_ENDS = frozenset([CALL, RET, IRET, HLT, JMP])
+
+
+# Python for the instructions that can be inlined
+# {a} and {b} are the operand bytes
+INLINE = {
+    LDI: "reg[{a}] = {b}",
+    LD: "reg[{a}] = ram[reg[{b}]]",
+    POP: "reg[{a}] = ram[reg[7]]; reg[7] = (reg[7] + 1) & 0xFF",
+    NOP: "pass",
+    ADD: "reg[{a}] = (reg[{a}] + reg[{b}]) & 0xFF",
+    AND: "reg[{a}] = reg[{a}] & reg[{b}]",
+    DEC: "reg[{a}] = (reg[{a}] - 1) & 0xFF",
+    INC: "reg[{a}] = (reg[{a}] + 1) & 0xFF",
+    MUL: "reg[{a}] = (reg[{a}] * reg[{b}]) & 0xFF",
+    NOT: "reg[{a}] = reg[{a}] ^ 0xFF",
+    OR: "reg[{a}] = reg[{a}] | reg[{b}]",
+    SHL: "reg[{a}] = (reg[{a}] << reg[{b}]) & 0xFF",
+    SHR: "reg[{a}] = reg[{a}] >> reg[{b}]",
+    SUB: "reg[{a}] = (reg[{a}] - reg[{b}]) & 0xFF",
+    XOR: "reg[{a}] = reg[{a}] ^ reg[{b}]",
+}
+
+# Instructions that write the register in operand a
+WRITES_A = (frozenset(INLINE) - {NOP}) | {DIV, MOD}
+
+# FL bits tested by each conditional jump (JNE jumps when E is clear)
+JUMP_FLAGS = {
+    JEQ: 0b00000001,
+    JGE: 0b00000011,
+    JGT: 0b00000010,
+    JLE: 0b00000101,
+    JLT: 0b00000100,
+}
+
+# Handler for every opcode; unknown opcodes act like NOP as in CPU.decode
+HANDLERS = dict.fromkeys(range(256), handle_NOP)
+HANDLERS.update(main_branch)
+HANDLERS.update(alu_branch)
+
+# The same with LD and ST going through the device table, for CPUs with
+# devices attached
+DEVICE_HANDLERS = dict(HANDLERS)
+DEVICE_HANDLERS.update(device_branch)
+
+
+def emit_block(start, block, lines, owners, indent, mapped=False,
+               checks=False):
+    """
+    Append the Python for the block at start to lines, indent spaces
+    deep, and record the instruction each line belongs to in owners as
+    {line number: (address, instructions before it)}. Shared by the JIT
+    and the AOT translator.
+
+    The code runs with cpu, ram, reg, ram_write, console, handlers and
+    blocks (the compiled block at each address) in scope, and returns how
+    many instructions ran. It stops after a RAM write once blocks[start]
+    is gone, and with checks, after a write to IM or IS that makes an
+    interrupt due. With mapped, LD and ST go through their handlers so
+    they reach devices.
+    """
+
+    pad = " " * indent
+    fl_known = False
+
+    def emit(line):
+        lines.append(pad + line)
+        owners[len(lines)] = (addr, count - 1)
+
+    def check_write(device=False):
+        # the write may have hit this block's own code, or a device may
+        # have stopped execution
+        test = f"blocks[{start}] is None"
+        if device:
+            test += " or not cpu.is_running"
+        emit(f"if {test}:")
+        emit(f"    cpu.pc = {next_pc}")
+        emit(f"    return {count}")
+
+    for count, (addr, ir, a, b) in enumerate(block, 1):
+        next_pc = (addr + (ir >> 6) + 1) & 0xFF
+
+        if ir in INLINE and not (mapped and ir in device_branch):
+            emit(INLINE[ir].format(a=a, b=b))
+
+        elif ir == CMP:
+            # keep FL in a local too; only CMP changes it inside a block
+            emit(f"x = reg[{a}]; y = reg[{b}]")
+            emit("cpu.FL = fl = 1 if x == y else 2 if x > y else 4")
+            fl_known = True
+
+        elif ir == PRN:
+            emit(f'console.write(b"%d\\n" % reg[{a}])')
+
+        elif ir == PRA:
+            emit(f"console.write(bytes((reg[{a}], 10)))")
+
+        elif ir == ST and not mapped:
+            emit(f"ram_write(reg[{a}], reg[{b}])")
+            check_write()
+
+        elif ir == PUSH:
+            emit(f"v = reg[{a}]")
+            emit("sp = reg[7] = (reg[7] - 1) & 0xFF")
+            emit("ram_write(sp, v)")
+            check_write()
+
+        elif ir == CALL:
+            emit(f"t = reg[{a}]")
+            emit("sp = reg[7] = (reg[7] - 1) & 0xFF")
+            emit(f"ram_write(sp, {next_pc})")
+            emit("cpu.pc = t")
+            emit(f"return {count}")
+            return
+
+        elif ir == RET:
+            emit("cpu.pc = ram[reg[7]]")
+            emit("reg[7] = (reg[7] + 1) & 0xFF")
+            emit(f"return {count}")
+            return
+
+        elif ir == JMP:
+            # a short jump back may close an idle loop, see handle_JMP
+            emit(f"t = reg[{a}]")
+            emit(f"if 0 <= {addr} - t < {IDLE_SPAN} and "
+                 f"cpu.busy_loops[{addr}] != t:")
+            emit(f"    cpu.pc = {addr}")
+            emit("    cpu.check_idle(t)")
+            emit("cpu.pc = t")
+            emit(f"return {count}")
+            return
+
+        elif ir in JUMP_FLAGS or ir == JNE:
+            if not fl_known:
+                emit("fl = cpu.FL")
+                fl_known = True
+            if ir == JNE:
+                test = "not fl & 1"
+            else:
+                test = f"fl & {JUMP_FLAGS[ir]}"
+            # a side exit: the block carries on when it isn't taken
+            emit(f"if {test}:")
+            emit(f"    cpu.pc = reg[{a}]")
+            emit(f"    return {count}")
+
+        elif ir == HLT:
+            emit("cpu.is_running = False")
+            emit("console.flush()")
+            emit(f"cpu.pc = {next_pc}")
+            emit(f"return {count}")
+            return
+
+        elif HANDLERS[ir] is handle_NOP:
+            # unknown opcodes are skipped like a NOP
+            emit("pass")
+
+        else:
+            # DIV, MOD, INT, IRET (and LD and ST with devices) go through
+            # their handlers, which may read the PC or change FL
+            emit(f"cpu.pc = {addr}")
+            emit(f"handlers[{ir}](cpu, {a}, {b})")
+            fl_known = False
+            if ir == IRET:
+                emit(f"return {count}")
+                return
+            if ir == ST:
+                check_write(device=True)
+
+        if checks and ir in WRITES_A and a in (5, 6) and count < len(block):
+            # IM or IS changed: stop here if an interrupt is now due, so
+            # it's taken before the next instruction as when interpreted
+            emit("if reg[5] & reg[6] and cpu.interrupts_enabled:")
+            emit(f"    cpu.pc = {next_pc}")
+            emit(f"    return {count}")
+
+    emit(f"cpu.pc = {next_pc}")
+    emit(f"return {count}")
+
+
+class JIT:
+    """Translation cache of compiled basic blocks for one CPU."""
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        # compiled block for each start address (None = not compiled)
+        self.blocks = [None] * 256
+        # visits to each address while interpreted
+        self.counts = [0] * 256
+        # times the block at each address has been thrown away
+        self.recompiles = [0] * 256
+        # start addresses of the blocks that cover each address
+        self.covers = [[] for _ in range(256)]
+        # addresses covered by the block at each start address
+        self.spans = [()] * 256
+        # instructions in the block at each start address
+        self.sizes = [0] * 256
+        # instructions a faulting block ran before the fault
+        self.partial = 0
+
+    def flush(self):
+        """Throw away every compiled block, e.g. after a new program is loaded."""
+
+        self.blocks[:] = [None] * 256
+        self.counts[:] = [0] * 256
+        self.recompiles[:] = [0] * 256
+        for starts in self.covers:
+            starts.clear()
+        self.spans[:] = [()] * 256
+
+    def invalidate(self, addr):
+        """Drop every compiled block that covers addr."""
+
+        starts = self.covers[addr]
+        if not starts:
+            return
+
+        for start in list(starts):
+            self.blocks[start] = None
+            self.recompiles[start] += 1
+            self.counts[start] = 0
+            for covered in self.spans[start]:
+                self.covers[covered].remove(start)
+            self.spans[start] = ()
+
+    def find_block(self, start):
+        """
+        Walk the straight-line code at start.
+        Returns a list of (address, opcode, operand_a, operand_b).
+        """
+
+        ram = self.cpu.ram
+        block = []
+        addr = start
+
+        while len(block) < MAX_BLOCK_LEN and addr < 256:
+            ir = ram[addr]
+            size = (ir >> 6) + 1
+            if addr + size > 256:
+                # don't translate code that wraps around the top of RAM
+                break
+
+            block.append((addr, ir, ram[(addr + 1) & 0xFF],
+                          ram[(addr + 2) & 0xFF]))
+            addr += size
+
+            # INT ends the block too so pending interrupts are seen quickly
+            if ir in BLOCK_ENDS or ir == INT:
+                break
+
+        return block
+
+    def translate(self, start, block):
+        """
+        Generate the Python source for a block.
+        The compiled block returns how many instructions it executed.
+        Also returns the instruction each source line belongs to, as
+        {line number: (address, instructions before it)}, for faults.
+        """
+
+        lines = ["def make(cpu, ram, reg, blocks, handlers, fault):",
+                 "    ram_write = cpu.ram_write",
+                 "    console = cpu.console",
+                 "    def block():",
+                 "      try:"]
+        owners = {}
+
+        # LD and ST are only inlined when they can't hit a device. Blocks
+        # outlive whatever IM holds now, so every write to IM or IS checks
+        # for a due interrupt, as the interpreter does after each
+        # instruction
+        emit_block(start, block, lines, owners, 8, mapped=self.cpu.mapped,
+                   checks=True)
+
+        # an instruction that raises stops the block where it is; the
+        # handler costs nothing until then
+        lines.extend(["      except Exception as e:",
+                      "        fault(e.__traceback__.tb_lineno)",
+                      "        raise",
+                      "    return block"])
+        return "\n".join(lines), owners
+
+    def compile(self, start):
+        """
+        Translate and compile the block at start.
+        Returns the compiled block, or None if it should stay interpreted.
+        """
+
+        if self.recompiles[start] > MAX_RECOMPILES:
+            return None
+
+        block = self.find_block(start)
+        if not block:
+            return None
+
+        source, owners = self.translate(start, block)
+        namespace = {}
+        exec(compile(source, f"<ls8 block {start:02X}>", "exec"), namespace)
+
+        def fault(line):
+            self.faulted(*owners[line])
+
+        cpu = self.cpu
+        handlers = DEVICE_HANDLERS if cpu.mapped else HANDLERS
+        fn = namespace["make"](cpu, cpu.ram, cpu.reg, self.blocks, handlers,
+                               fault)
+
+        # remember which addresses this block was built from
+        last_addr, last_ir = block[-1][0], block[-1][1]
+        end = last_addr + (last_ir >> 6) + 1
+        span = tuple(range(start, end))
+        self.spans[start] = span
+        self.sizes[start] = len(block)
+        for addr in span:
+            self.covers[addr].append(start)
+
+        self.blocks[start] = fn
+        return fn
+
+    def faulted(self, addr, done):
+        """
+        Called when the instruction at addr in a compiled block raises,
+        after done instructions of the block ran: leave the PC on it, like
+        the interpreter, and have execute() count the ones that ran.
+        """
+
+        self.cpu.pc = addr
+        self.partial = done
+
+    def execute(self, limit):
+        """
+        Run until HLT or until cycles reaches limit, calling compiled
+        blocks where there are any. A block only starts if it can't run
+        past the limit, so timer ticks land on the same cycle as
+        interpreted.
+        """
+
+        cpu = self.cpu
+        blocks = self.blocks
+        sizes = self.sizes
+        counts = self.counts
+        decoded = cpu.decoded
+        reg = cpu.reg
+        cycles = cpu.cycles
+
+        try:
+            while cpu.is_running and cycles < limit:
+                if reg[5] & reg[6] and cpu.interrupts_enabled:
+                    cpu.interrupt()
+
+                pc = cpu.pc
+                block = blocks[pc]
+
+                if block is None:
+                    counts[pc] += 1
+                    if counts[pc] >= HOT_THRESHOLD:
+                        block = self.compile(pc)
+                        # give up on this address for a while if it can't compile
+                        counts[pc] = 0
+
+                if block is not None and cycles + sizes[pc] <= limit:
+                    cycles += block()
+                    continue
+
+                # cold code is interpreted until it jumps, as only jump
+                # targets (and the code after a block) start blocks
+                while True:
+                    entry = decoded[pc] or cpu.decode(pc)
+                    if cycles + entry[4] > limit:
+                        # a fused sequence would run past the limit
+                        entry = cpu.decode_one(pc)
+                    handler, operand_a, operand_b, add_to_pc, count = entry
+
+                    handler(cpu, operand_a, operand_b)
+
+                    cycles += count
+                    if not add_to_pc:
+                        cpu.pc &= 0xFF
+                        break
+                    pc = cpu.pc = (pc + add_to_pc) & 0xFF
+                    if cycles >= limit or not cpu.is_running or \
+                            reg[5] & reg[6]:
+                        break
+        except Exception:
+            # instructions that ran in a block before one raised
+            cycles += self.partial
+            self.partial = 0
+            raise
+        finally:
+            cpu.cycles = cycles
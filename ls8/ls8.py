@@ -2,18 +2,105 @@
 
 """
 Main.
-Runs the cpu
+Runs the cpu, or a batch of programs with --batch
 """
 
 
 import sys
+import argparse
 from cpu import *
 
-if len(sys.argv) != 2:
-    print("Usage: ls8.py filename")
+
+def parse_commandline(argv):
+    parser = argparse.ArgumentParser(prog="ls8.py")
+    parser.add_argument("files", nargs="*", metavar="filename")
+    # --jit compiles hot basic blocks instead of interpreting them
+    parser.add_argument("--jit", action="store_true",
+                        help="compile hot basic blocks")
+    # --aot translates the whole program to a cached Python module first
+    parser.add_argument("--aot", action="store_true",
+                        help="translate the program to Python before running")
+    parser.add_argument("--profile", action="store_true",
+                        help="print an execution profile to stderr")
+    parser.add_argument("--profile-json",
+                        help="write the execution profile as JSON")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="dump an execution trace on halt or crash")
+    parser.add_argument("--batch", action="store_true",
+                        help="run many programs across a process pool")
+    parser.add_argument("--manifest",
+                        help="file listing programs to run, one per line")
+    parser.add_argument("--workers", type=int,
+                        help="number of worker processes")
+    parser.add_argument("--max-cycles", type=int,
+                        help="instructions each program may run")
+    parser.add_argument("--time-limit", type=float,
+                        help="seconds each program may run")
+    parser.add_argument("--report", default="-",
+                        help="file for the JSON results report")
+
+    args = parser.parse_args(argv[1:])
+
+    if not args.batch and len(args.files) != 1:
+        print("Usage: ls8.py [--jit | --aot] filename")
+        sys.exit(1)
+
+    return args
+
+
+def run_batch_mode(args):
+    from batch import read_manifest, run_batch, write_report, print_summary
+
+    paths = list(args.files)
+    if args.manifest:
+        paths += read_manifest(args.manifest)
+
+    results = run_batch(paths, workers=args.workers,
+                        max_cycles=args.max_cycles,
+                        time_limit=args.time_limit, jit=args.jit)
+
+    # keep the summary off stdout when the report goes there
+    if args.report != "-":
+        print_summary(results)
+    write_report(results, args.report)
+
+    return 0 if all(r["status"] == "halted" for r in results) else 1
+
+
+args = parse_commandline(sys.argv)
+
+if args.batch:
+    sys.exit(run_batch_mode(args))
+
+cpu = CPU(jit=args.jit, profile=args.profile or bool(args.profile_json),
+          trace=args.trace, realtime=True, aot=args.aot)
+
+try:
+    cpu.load(args.files[0])
+except FileNotFoundError:
+    print(f"{sys.argv[0]}: {args.files[0]} not found")
     sys.exit(1)
 
-cpu = CPU()
+try:
+    result = cpu.run()
+finally:
+    if cpu.profiler is not None:
+        if args.profile:
+            print(cpu.profiler.text_report(), file=sys.stderr)
+        if args.profile_json:
+            with open(args.profile_json, "w") as f:
+                f.write(cpu.profiler.to_json() + "\n")
+
+if cpu.aot is not None and cpu.aot.reason is not None:
+    print(f"{sys.argv[0]}: ran interpreted: {cpu.aot.reason}",
+          file=sys.stderr)
 
-cpu.load(sys.argv[1])
-cpu.run()
\ No newline at end of file
+if result.status == IDLE:
+    # nothing feeds the keyboard here, so it would wait forever
+    print(f"{sys.argv[0]}: waiting for a key press, stopping",
+          file=sys.stderr)
+
+if result.status == FAULT:
+    print(f"{sys.argv[0]}: fault at PC 0x{cpu.pc:02X}: "
+          f"{type(result.error).__name__}: {result.error}", file=sys.stderr)
+    sys.exit(1)
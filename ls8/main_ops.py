@@ -19,23 +19,27 @@ PUSH = 0b01000101
 RET = 0b00010001
 ST = 0b10000100
 
+# A JMP back at most this many bytes is checked for an idle loop
+IDLE_SPAN = 16
+
 
 def handle_CALL(self, operand_a, operand_b):
     # Get the current address
     addr = self.reg[operand_a]
     # Advance the return address
-    rtn_addr = self.pc + 2
+    rtn_addr = (self.pc + 2) & 0xFF
     # Subtract one ('after' the instruction) from SP
-    self.reg[7] -= 1  
+    self.reg[7] = (self.reg[7] - 1) & 0xFF
     sp = self.reg[7]
     # Push the address of the instruction after CALL to the stack
-    self.ram[sp] = rtn_addr 
+    self.ram_write(sp, rtn_addr)
     # Set the PC to the address in the given register
     self.pc = addr
 
 def handle_HLT(self, *args):
     # Stop all processes
     self.is_running = False
+    self.console.flush()
 
 def handle_LDI(self, operand_a, operand_b):
     # Set the value of the register at op_a to op_b
@@ -43,27 +47,27 @@ def handle_LDI(self, operand_a, operand_b):
 
 def handle_PRN(self, operand_a, operand_b):
     # print the value of the register at op_a
-    print(self.reg[operand_a])
+    self.console.write(b"%d\n" % self.reg[operand_a])
 
 def handle_PUSH(self, operand, *args):
     val = self.reg[operand]
     # decrement the SP
-    self.reg[7] -= 1
+    self.reg[7] = (self.reg[7] - 1) & 0xFF
     # Put the value into the stack at the address indicated by the SP
-    self.ram[self.reg[7]] = val
+    self.ram_write(self.reg[7], val)
 
 def handle_POP(self, operand, *args):
     # Put the value at the top of the stack into the given register
     val = self.ram[self.reg[7]]
     self.reg[operand] = val
     # Increment the stack point
-    self.reg[7] += 1
+    self.reg[7] = (self.reg[7] + 1) & 0xFF
 
 def handle_RET(self, *args):
     # Subroutine complete, return
     rtn_addr = self.ram[self.reg[7]]
     # Increment by one because the value has been handled
-    self.reg[7] += 1
+    self.reg[7] = (self.reg[7] + 1) & 0xFF
     # value from the top of the stack gets stored to PC
     self.pc = rtn_addr
 
@@ -71,18 +75,20 @@ def handle_INT(self, operand, *args):
     # set r6's nth bit to the value in the given reg
     # use hashing w/ or to preserve all other digits
     # hashing number will be a 1 squished over by the amount of the value
-    self.reg[6] |= (1 << self.reg[operand])
+    self.reg[6] |= (1 << self.reg[operand]) & 0xFF
 
 def handle_IRET(self, *args):
     # pop r6-r0 off the stack in that order
     for i in range(6, -1, -1):
-        self.handle_POP(i)
+        handle_POP(self, i)
     # pop the FL reg off the stack
     self.FL = self.ram_read(self.reg[7])
-    self.reg[7] += 1
+    self.reg[7] = (self.reg[7] + 1) & 0xFF
     # pop the return address off and store it in pc
-    self.pc = self.reg[7]
-    #TODO re-enable interupts (?)
+    self.pc = self.ram_read(self.reg[7])
+    self.reg[7] = (self.reg[7] + 1) & 0xFF
+    # re-enable interrupts
+    self.interrupts_enabled = True
 
 def handle_JEQ(self, operand, *args):
     # Check if the flag has a 1 in the E (last position)
@@ -110,13 +116,15 @@ def handle_JGT(self, operand, *args):
         self.pc += 2
 
 def handle_JLE(self, operand, *args):
-    if self.FL & 0b00000110:
+    # less-than (third last) or equal (last) position
+    if self.FL & 0b00000101:
         self.pc = self.reg[operand]
     else:
         self.pc += 2
 
 def handle_JLT(self, operand, *args):
-    if self.FL & 0b00001000:
+    # less-than is the third last position
+    if self.FL & 0b00000100:
         self.pc = self.reg[operand]
     else:
         self.pc += 2
@@ -124,7 +132,11 @@ def handle_JLT(self, operand, *args):
 def handle_JMP(self, operand, *args):
     # Move the pc forward, regardless
     # This call is ignored by the run method.
-    self.pc = self.reg[operand]
+    addr = self.reg[operand]
+    # a short jump back may close a loop that just waits for an interrupt
+    if 0 <= self.pc - addr < IDLE_SPAN and self.busy_loops[self.pc] != addr:
+        self.check_idle(addr)
+    self.pc = addr
 
 def handle_JNE(self, operand, *args):
     # Only jump if E = 0
@@ -142,8 +154,8 @@ def handle_NOP(self, *args):
 def handle_PRA(self, operand, *args):
     # get the value at the indicated reg
     letter = self.reg[operand]
-    # convert it to a letter and print
-    print(chr(letter))
+    # write it out as a character
+    self.console.write(bytes((letter, 10)))
 
 def handle_ST(self, operand_a, operand_b):
     # write to memory; reg_b goes to address in reg_a
@@ -0,0 +1,163 @@
+"""
+Profiler.
+A separate copy of the interpreter loop that counts executions per opcode
+and per PC, and follows CALL/RET (and interrupts/IRET) to build a call
+graph with inclusive instruction counts per subroutine. CPU.run only
+switches to this loop while a profiler is attached, so the normal loop
+pays nothing for it.
+"""
+
+import json
+import time
+
+from main_ops import main_branch, CALL, RET, IRET
+from alu_ops import alu_branch
+
+# Mnemonic for each opcode, from its handler in the branch tables
+# (handle_ADD -> ADD)
+OPCODE_NAMES = {}
+for branch in (main_branch, alu_branch):
+    for ir, handler in branch.items():
+        OPCODE_NAMES[ir] = handler.__name__[len("handle_"):]
+
+
+def opcode_name(ir):
+    return OPCODE_NAMES.get(ir, f"0x{ir:02X}")
+
+
+class Profiler:
+    """Execution counts and call graph for one CPU."""
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        # executions of each opcode
+        self.op_counts = [0] * 256
+        # executions of the instruction at each address
+        self.pc_hits = [0] * 256
+        # subroutine address -> [calls, inclusive instructions]
+        self.subroutines = {}
+        # (caller, callee) -> calls; None is the top level program
+        self.edges = {}
+        # open calls: (subroutine address, cycles when entered)
+        self.frames = []
+        self.instructions = 0
+        self.seconds = 0.0
+
+    def enter(self, addr, cycles):
+        caller = self.frames[-1][0] if self.frames else None
+        self.edges[caller, addr] = self.edges.get((caller, addr), 0) + 1
+        stats = self.subroutines.setdefault(addr, [0, 0])
+        stats[0] += 1
+        self.frames.append((addr, cycles))
+
+    def leave(self, cycles):
+        if not self.frames:
+            # RET with nothing on our call stack; nothing to attribute
+            return
+        addr, entered = self.frames.pop()
+        self.subroutines[addr][1] += cycles - entered
+
+    def execute(self, limit):
+        """Interpret instructions until HLT or limit, counting as we go."""
+
+        cpu = self.cpu
+        ram = cpu.ram
+        reg = cpu.reg
+        decoded = cpu.decoded
+        op_counts = self.op_counts
+        pc_hits = self.pc_hits
+        cycles = cpu.cycles
+        start_cycles = cycles
+        start = time.perf_counter()
+
+        try:
+            while cpu.is_running and cycles < limit:
+                if reg[5] & reg[6] and cpu.interrupts_enabled:
+                    cpu.interrupt()
+                    self.enter(cpu.pc, cycles)
+
+                pc = cpu.pc
+                ir = ram[pc]
+                op_counts[ir] += 1
+                pc_hits[pc] += 1
+
+                entry = decoded[pc] or cpu.decode(pc)
+                handler, operand_a, operand_b, add_to_pc, count = entry
+
+                handler(cpu, operand_a, operand_b)
+
+                cpu.pc = (cpu.pc + add_to_pc) & 0xFF
+                cycles += count
+
+                if ir == CALL:
+                    self.enter(cpu.pc, cycles)
+                elif ir == RET or ir == IRET:
+                    self.leave(cycles)
+        finally:
+            cpu.cycles = cycles
+            self.instructions += cycles - start_cycles
+            self.seconds += time.perf_counter() - start
+
+    def report(self):
+        """Return the profile as a dict, ready for JSON."""
+
+        cycles = self.cpu.cycles
+        subroutines = {addr: list(stats)
+                       for addr, stats in self.subroutines.items()}
+        # calls that haven't returned yet count up to now
+        for addr, entered in self.frames:
+            subroutines[addr][1] += cycles - entered
+
+        def addr_name(addr):
+            return "<main>" if addr is None else f"0x{addr:02X}"
+
+        ips = self.instructions / self.seconds if self.seconds else 0.0
+
+        return {
+            "instructions": self.instructions,
+            "seconds": self.seconds,
+            "instructions_per_second": ips,
+            "opcodes": {opcode_name(ir): n
+                        for ir, n in enumerate(self.op_counts) if n},
+            "pcs": {f"0x{pc:02X}": n
+                    for pc, n in enumerate(self.pc_hits) if n},
+            "subroutines": [
+                {"address": addr_name(addr), "calls": calls,
+                 "inclusive": inclusive}
+                for addr, (calls, inclusive) in sorted(subroutines.items())
+            ],
+            "edges": [
+                {"caller": addr_name(caller), "callee": addr_name(callee),
+                 "calls": n}
+                for (caller, callee), n in self.edges.items()
+            ],
+        }
+
+    def to_json(self):
+        return json.dumps(self.report(), indent=2)
+
+    def text_report(self, top=20):
+        """Return a text report, hottest entries first."""
+
+        r = self.report()
+        lines = [
+            f"instructions: {r['instructions']}",
+            f"seconds:      {r['seconds']:.6f}",
+            f"ips:          {r['instructions_per_second']:.0f}",
+            "",
+            "opcode      count",
+        ]
+        for name, n in sorted(r["opcodes"].items(), key=lambda x: -x[1]):
+            lines.append(f"{name:<8} {n:>8}")
+
+        lines += ["", f"top {top} pcs    count"]
+        for pc, n in sorted(r["pcs"].items(), key=lambda x: -x[1])[:top]:
+            lines.append(f"{pc:<8} {n:>8}")
+
+        if r["subroutines"]:
+            lines += ["", "subroutine   calls  inclusive"]
+            for sub in sorted(r["subroutines"], key=lambda x: -x["inclusive"]):
+                lines.append(f"{sub['address']:<8} {sub['calls']:>8} "
+                             f"{sub['inclusive']:>10}")
+
+        return "\n".join(lines)
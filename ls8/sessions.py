@@ -0,0 +1,228 @@
+"""
+Asyncio hosting.
+Runs CPUs as coroutines on an event loop, so one process can serve many
+sessions. A session runs its CPU a slice of instructions at a time and
+yields to the loop between slices. Console output goes to an asyncio
+stream and waits for it to drain, and key presses are read from a stream
+and delivered between slices. A CPU idling until a key press waits for
+one without running at all.
+
+The Scheduler sizes the slices from the measured instruction rate, so
+one round through every session takes about LATENCY seconds.
+
+    scheduler = Scheduler()
+    for path in paths:
+        cpu = CPU(console=Console(collect=True))
+        cpu.load(path)
+        scheduler.spawn(cpu, writer)
+    await scheduler.join()
+"""
+
+import asyncio
+import collections
+import time
+
+from cpu import HALTED, CYCLE_LIMIT, TIME_LIMIT, FAULT, IDLE, \
+    CYCLES_PER_SECOND
+
+# Instructions per slice when there's no scheduler, and the most per slice
+SLICE = 10000
+# Fewest instructions per slice, however many sessions there are
+MIN_SLICE = 100
+# Time for one round through every session, in seconds
+LATENCY = 0.05
+
+
+class Session:
+    """One CPU hosted on the event loop."""
+
+    def __init__(self, cpu, writer=None):
+        """
+        cpu should have a collecting console (Console(collect=True));
+        its output is written to writer, an asyncio StreamWriter, or kept
+        in the console when writer is None.
+        """
+
+        self.cpu = cpu
+        self.writer = writer
+        self.keys = collections.deque()
+        # set when a key is queued, for a CPU idling until one arrives
+        self.key_event = asyncio.Event()
+        # no more keys will come (feed() reached the end of its stream)
+        self.closed = False
+        # why run() returned: HALTED, CYCLE_LIMIT, TIME_LIMIT or IDLE
+        self.status = None
+        self.task = None
+
+    def press(self, key):
+        """Queue a key press for the CPU."""
+
+        self.keys.append(key & 0xFF)
+        self.key_event.set()
+
+    async def feed(self, reader):
+        """
+        Press every byte read from an asyncio StreamReader. At the end of
+        the stream the session is closed, so a CPU idling until a key
+        press stops instead of waiting forever.
+        """
+
+        while True:
+            data = await reader.read(256)
+            if not data:
+                self.closed = True
+                self.key_event.set()
+                return
+            for key in data:
+                self.press(key)
+
+    async def flush(self):
+        """Send console output to the writer, waiting if it's backed up."""
+
+        if self.writer is None:
+            return
+
+        data = self.cpu.console.take()
+        if data:
+            self.writer.write(data)
+            await self.writer.drain()
+
+    async def run(self, scheduler=None, slice=SLICE, max_cycles=None,
+                  deadline=None, realtime=False):
+        """
+        Run the CPU until HLT, yielding to the event loop every slice
+        instructions (or as often as the scheduler says). Stops early
+        after max_cycles instructions, when time.monotonic() reaches
+        deadline, or when it idles until a key press on a closed session;
+        status says which. Returns the number of cycles run.
+
+        With realtime, idle time the CPU skipped is waited out as
+        CPU(realtime=True) does, but without holding up other sessions.
+        """
+
+        cpu = self.cpu
+        keys = self.keys
+        stop = None if max_cycles is None else cpu.cycles + max_cycles
+
+        while True:
+            n = slice if scheduler is None else scheduler.slice()
+            if stop is not None:
+                if cpu.cycles >= stop:
+                    self.status = CYCLE_LIMIT
+                    return cpu.cycles
+                n = min(n, stop - cpu.cycles)
+
+            # one key per slice, so the program's handler sees each one
+            # rather than only the last
+            if keys:
+                cpu.key_press(keys.popleft())
+            if not keys:
+                self.key_event.clear()
+
+            idle_cycles = cpu.idle_cycles
+            start = time.perf_counter()
+            result = cpu.run(max_cycles=n, deadline=deadline)
+            skipped = cpu.idle_cycles - idle_cycles
+            if scheduler is not None:
+                scheduler.record(result.cycles - skipped,
+                                 time.perf_counter() - start)
+
+            await self.flush()
+
+            if result.status == FAULT:
+                raise result.error
+            if result.status in (HALTED, TIME_LIMIT):
+                self.status = result.status
+                return cpu.cycles
+
+            if result.status == IDLE and not keys:
+                # nothing to do until a key press
+                if self.closed:
+                    self.status = IDLE
+                    return cpu.cycles
+                if deadline is None:
+                    await self.key_event.wait()
+                    continue
+                try:
+                    await asyncio.wait_for(self.key_event.wait(),
+                                           deadline - time.monotonic())
+                except asyncio.TimeoutError:
+                    self.status = TIME_LIMIT
+                    return cpu.cycles
+            elif realtime and skipped:
+                seconds = skipped / CYCLES_PER_SECOND
+                if deadline is not None:
+                    seconds = min(seconds, deadline - time.monotonic())
+                await asyncio.sleep(max(seconds, 0))
+            else:
+                await asyncio.sleep(0)
+
+
+class Scheduler:
+    """Round-robin scheduler for many sessions on one event loop."""
+
+    def __init__(self, latency=LATENCY, min_slice=MIN_SLICE,
+                 max_slice=SLICE):
+        self.latency = latency
+        self.min_slice = min_slice
+        self.max_slice = max_slice
+        # running sessions, in the order they were spawned
+        self.sessions = {}
+        # sessions join() hasn't collected yet, finished or not
+        self.spawned = []
+        # measured instructions per second, smoothed
+        self.rate = None
+
+    def slice(self):
+        """Instructions each session gets per turn."""
+
+        if self.rate is None:
+            return self.min_slice
+
+        n = self.rate * self.latency / max(len(self.sessions), 1)
+        return max(self.min_slice, min(self.max_slice, int(n)))
+
+    def record(self, instructions, seconds):
+        if seconds <= 0:
+            return
+
+        rate = instructions / seconds
+        if self.rate is None:
+            self.rate = rate
+        else:
+            self.rate += (rate - self.rate) * 0.1
+
+    def spawn(self, cpu, writer=None, max_cycles=None, deadline=None,
+              realtime=False):
+        """
+        Start running a CPU in a new session, with the limits and pacing
+        of Session.run. Returns the session.
+        """
+
+        session = Session(cpu, writer)
+        session.task = asyncio.create_task(
+            session.run(self, max_cycles=max_cycles, deadline=deadline,
+                        realtime=realtime))
+        self.sessions[session] = None
+        self.spawned.append(session)
+        session.task.add_done_callback(
+            lambda task: self.sessions.pop(session, None))
+        return session
+
+    async def join(self):
+        """
+        Wait for every session spawned since the last join to finish,
+        including those that already have. Returns their results in the
+        order they were spawned; a session that failed gives its
+        exception.
+        """
+
+        spawned, self.spawned = self.spawned, []
+        tasks = [s.task for s in spawned]
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def run_async(cpu, writer=None, slice=SLICE):
+    """Run one CPU as a coroutine. Returns the number of cycles run."""
+
+    return await Session(cpu, writer).run(slice=slice)
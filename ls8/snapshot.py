@@ -0,0 +1,79 @@
+"""
+CPU snapshots.
+A snapshot is an immutable bytes blob holding RAM, registers, PC, FL,
+interrupt and timer state. It is cheap to copy, can be restored into any
+CPU or used to fork new ones, and can be written to disk so a warmed-up
+state is reused across processes.
+
+Layout (little endian):
+    header   magic b"LS8S", version, FL, flags, PC, cycles,
+             timer period, next timer tick
+    reg      8 bytes
+    ram      256 bytes
+"""
+
+import struct
+
+MAGIC = b"LS8S"
+VERSION = 1
+HEADER = struct.Struct("<4sBBBBQQQ")
+
+FLAG_RUNNING = 0b00000001
+FLAG_INTERRUPTS_ENABLED = 0b00000010
+
+REG_OFFSET = HEADER.size
+RAM_OFFSET = REG_OFFSET + 8
+SIZE = RAM_OFFSET + 256
+
+
+def pack(cpu):
+    """Capture the state of a CPU as bytes."""
+
+    flags = 0
+    if cpu.is_running:
+        flags |= FLAG_RUNNING
+    if cpu.interrupts_enabled:
+        flags |= FLAG_INTERRUPTS_ENABLED
+
+    header = HEADER.pack(MAGIC, VERSION, cpu.FL, flags, cpu.pc, cpu.cycles,
+                         cpu.timer_period, cpu.next_timer)
+
+    return b"".join((header, cpu.reg, cpu.ram))
+
+
+def unpack(blob, cpu):
+    """Copy the state in a snapshot into a CPU."""
+
+    if len(blob) != SIZE:
+        raise ValueError("snapshot has the wrong size")
+
+    magic, version, fl, flags, pc, cycles, timer_period, next_timer = \
+        HEADER.unpack_from(blob)
+
+    if magic != MAGIC:
+        raise ValueError("not an LS-8 snapshot")
+    if version != VERSION:
+        raise ValueError(f"unsupported snapshot version {version}")
+
+    view = memoryview(blob)
+    # copy in place; compiled JIT blocks hold on to these bytearrays
+    cpu.reg[:] = view[REG_OFFSET:RAM_OFFSET]
+    cpu.ram[:] = view[RAM_OFFSET:SIZE]
+
+    cpu.FL = fl
+    cpu.pc = pc
+    cpu.cycles = cycles
+    cpu.timer_period = timer_period
+    cpu.next_timer = next_timer
+    cpu.is_running = bool(flags & FLAG_RUNNING)
+    cpu.interrupts_enabled = bool(flags & FLAG_INTERRUPTS_ENABLED)
+
+
+def write(filename, blob):
+    with open(filename, "wb") as f:
+        f.write(blob)
+
+
+def read(filename):
+    with open(filename, "rb") as f:
+        return f.read()
@@ -0,0 +1,66 @@
+"""
+Tests for memory-mapped devices.
+
+    python -m unittest test_devices
+"""
+
+import unittest
+
+from cpu import CPU
+from console import Console
+from devices import TIMER_ADDRESS, TIMER_UNIT, TimerPort
+from main_ops import HLT, JMP, JNE, LDI, ST
+from alu_ops import CMP, INC
+
+# Where the interrupt handler goes, pointed at by the I0 vector
+HANDLER = 32
+
+# Writes a period of 1 unit to the timer 200 times, then unmasks I0 and
+# spins until the tick; the last write ends at cycle 999
+PROGRAM = bytes([
+    LDI, 4, 9,              # 0: R4 = loop
+    LDI, 1, TIMER_ADDRESS,  # 3
+    LDI, 2, 1,              # 6
+    ST, 1, 2,               # 9 loop: restart the timer
+    INC, 3,                 # 12
+    LDI, 0, 200,            # 14
+    CMP, 3, 0,              # 17
+    JNE, 4,                 # 20
+    LDI, 5, 1,              # 22: unmask I0
+    LDI, 4, 28,             # 25
+    INC, 3,                 # 28 spin
+    JMP, 4,                 # 30
+    HLT,                    # 32 handler
+])
+
+
+def make_cpu(**kwargs):
+    # 200 units, so writing the low byte alone leaves a period of 1
+    cpu = CPU(console=Console(collect=True), timer_period=200 * TIMER_UNIT,
+              **kwargs)
+    cpu.attach(TimerPort(), TIMER_ADDRESS, 2)
+    cpu.ram[:len(PROGRAM)] = PROGRAM
+    cpu.ram[0xF8] = HANDLER
+    return cpu
+
+
+class TestTimerPort(unittest.TestCase):
+
+    def test_period_written_mid_run(self):
+        # the tick lands one period after the last write, whichever way
+        # the program runs
+        for kwargs in ({}, {"fuse": False}, {"jit": True}):
+            cpu = make_cpu(**kwargs)
+            cpu.run(max_cycles=100000)
+            self.assertEqual(cpu.cycles, 999 + TIMER_UNIT + 1, kwargs)
+            self.assertEqual(cpu.timer_period, TIMER_UNIT)
+
+        cpu = make_cpu()
+        cpu.step()
+        while cpu.is_running:
+            cpu.step()
+        self.assertEqual(cpu.cycles, 999 + TIMER_UNIT + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
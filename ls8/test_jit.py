@@ -0,0 +1,68 @@
+"""
+Tests for the JIT: compiled blocks must run programs exactly as the
+interpreter does, down to the cycle interrupts are taken on.
+
+    python -m unittest test_jit
+"""
+
+import unittest
+
+from cpu import CPU
+from console import Console
+from main_ops import HLT, IRET, JNE, LDI, PRN
+from alu_ops import CMP, INC
+
+# Where the interrupt handler goes, pointed at by the I0 vector
+HANDLER = 34
+
+# A loop that raises I0 and then unmasks it halfway through the loop
+# body; the interrupt is due right after the LDI R5,1, so the handler's
+# 200 must be printed before each R0
+PROGRAM = bytes([
+    LDI, 2, 12,         # 0: R2 = loop
+    LDI, 3, 0,          # 3
+    LDI, 4, 0,          # 6
+    LDI, 1, 0,          # 9
+    LDI, 5, 0,          # 12 loop: mask everything
+    LDI, 6, 1,          # 15: raise I0
+    LDI, 5, 1,          # 18: unmask it; it's due now
+    PRN, 0,             # 21
+    INC, 0,             # 23
+    LDI, 1, 100,        # 25
+    CMP, 0, 1,          # 28
+    JNE, 2,             # 31
+    HLT,                # 33
+    LDI, 1, 200,        # 34 handler
+    PRN, 1,             # 37
+    IRET,               # 39
+])
+
+
+def run(max_cycles=10000, **kwargs):
+    """Run PROGRAM; returns (output, cycles)."""
+
+    cpu = CPU(console=Console(collect=True), **kwargs)
+    cpu.ram[:len(PROGRAM)] = PROGRAM
+    cpu.ram[0xF8] = HANDLER
+    cpu.run(max_cycles=max_cycles)
+    return cpu.console.getvalue(), cpu.cycles
+
+
+class TestInterrupts(unittest.TestCase):
+
+    def test_im_written_mid_block(self):
+        expected = run(fuse=False)
+        # the loop runs often enough to be compiled
+        self.assertEqual(expected[0].split().count(b"200"), 100)
+        self.assertEqual(run(jit=True), expected)
+
+    def test_blocks_stop_at_the_limit(self):
+        # a block that would run past the limit is interpreted instead,
+        # so timer ticks land where they do when interpreted
+        for max_cycles in range(500, 700, 7):
+            self.assertEqual(run(max_cycles, jit=True),
+                             run(max_cycles, fuse=False))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+"""
+Tests for hosting CPUs on an asyncio event loop.
+
+    python -m unittest test_sessions
+"""
+
+import asyncio
+import unittest
+
+from cpu import CPU
+from console import Console
+from main_ops import HLT, JMP, LDI
+from alu_ops import INC
+from sessions import Scheduler
+
+# Counts in R0 forever
+LOOP = bytes([
+    LDI, 1, 3,      # 0
+    INC, 0,         # 3 loop
+    JMP, 1,         # 5
+])
+
+
+def make_cpu(program):
+    cpu = CPU(console=Console(collect=True))
+    cpu.ram[:len(program)] = program
+    return cpu
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_join_after_a_session_finished(self):
+        async def main():
+            scheduler = Scheduler()
+            short = scheduler.spawn(make_cpu(bytes([HLT])))
+            scheduler.spawn(make_cpu(LOOP), max_cycles=5000)
+            # wait until it's finished and no longer counted as running
+            while short in scheduler.sessions:
+                await asyncio.sleep(0)
+            results = await scheduler.join()
+            return results, await scheduler.join()
+
+        results, again = asyncio.run(main())
+        self.assertEqual(results, [1, 5000])
+        # each session's result is only collected once
+        self.assertEqual(again, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
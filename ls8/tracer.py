@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+
+"""
+Execution trace recorder.
+While attached, the CPU runs a recording copy of the interpreter loop that
+appends one fixed-size binary record per instruction (and per interrupt
+dispatch) into a preallocated ring buffer, instead of printing like
+CPU.trace(). The buffer can be dumped to a file when the program halts or
+crashes, and this module doubles as the offline tool that prints a dump
+or replays it to rebuild the CPU state at any step.
+
+Usage: tracer.py dumpfile [--replay STEP]
+
+Record (16 bytes):
+    pc, opcode, operand_a, operand_b, FL after, kind, 2 unused bytes,
+    R0-R7 after
+kind is 0 for an instruction, 1 for an interrupt dispatch; for those
+operand_a is the interrupt number and operand_b the key byte at 0xF4.
+
+Dump file:
+    header    magic b"LS8T", version, record size, record count
+    snapshot  CPU state before the first record (see snapshot.py)
+    records   oldest first
+"""
+
+import struct
+import sys
+
+import snapshot
+from console import Console
+from profiler import opcode_name
+
+MAGIC = b"LS8T"
+VERSION = 1
+HEADER = struct.Struct("<4sBBHI")
+RECORD = struct.Struct("<BBBBBBxx")
+RECORD_SIZE = RECORD.size + 8
+
+# Most recent key pressed (cpu.KEY_ADDRESS)
+KEY_ADDRESS = 0xF4
+
+KIND_INSTRUCTION = 0
+KIND_INTERRUPT = 1
+
+# Records kept by default
+DEPTH = 4096
+
+
+class Tracer:
+    """Ring buffer of binary trace records for one CPU."""
+
+    def __init__(self, cpu, depth=DEPTH, dump_path=None):
+        """
+        Keeps at least the last depth records. If dump_path is set the
+        buffer is written there when the program halts or crashes.
+        """
+
+        self.cpu = cpu
+        self.depth = depth
+        self.dump_path = dump_path
+        # room for two checkpoints' worth of records, so the oldest
+        # checkpoint always has every record after it
+        self.capacity = 2 * depth
+        self.buf = bytearray(self.capacity * RECORD_SIZE)
+        self.count = 0
+        # (record number, snapshot) for the last two checkpoints
+        self.checkpoints = []
+
+    def checkpoint(self):
+        self.checkpoints = self.checkpoints[-1:] + [(self.count,
+                                                     self.cpu.snapshot())]
+
+    def execute(self, limit):
+        """Interpret instructions until HLT or limit, recording each one."""
+
+        cpu = self.cpu
+        ram = cpu.ram
+        reg = cpu.reg
+        decoded = cpu.decoded
+        buf = self.buf
+        pack_into = RECORD.pack_into
+        end = len(buf)
+        depth = self.depth
+        count = self.count
+        pos = (count % self.capacity) * RECORD_SIZE
+        cycles = cpu.cycles
+
+        if not self.checkpoints:
+            self.checkpoint()
+
+        try:
+            while cpu.is_running and cycles < limit:
+                if reg[5] & reg[6] and cpu.interrupts_enabled:
+                    masked = reg[5] & reg[6]
+                    n = (masked & -masked).bit_length() - 1
+                    cpu.interrupt()
+                    pack_into(buf, pos, cpu.pc, 0, n, ram[KEY_ADDRESS],
+                              cpu.FL, KIND_INTERRUPT)
+                    buf[pos + 8:pos + 16] = reg
+                    pos += RECORD_SIZE
+                    if pos == end:
+                        pos = 0
+                    count += 1
+                    if count % depth == 0:
+                        cpu.cycles = cycles
+                        self.count = count
+                        self.checkpoint()
+
+                pc = cpu.pc
+                ir = ram[pc]
+                entry = decoded[pc] or cpu.decode(pc)
+                handler, operand_a, operand_b, add_to_pc, n = entry
+
+                handler(cpu, operand_a, operand_b)
+
+                cpu.pc = (cpu.pc + add_to_pc) & 0xFF
+                cycles += n
+
+                pack_into(buf, pos, pc, ir, operand_a, operand_b, cpu.FL,
+                          KIND_INSTRUCTION)
+                buf[pos + 8:pos + 16] = reg
+                pos += RECORD_SIZE
+                if pos == end:
+                    pos = 0
+                count += 1
+                if count % depth == 0:
+                    cpu.cycles = cycles
+                    self.count = count
+                    self.checkpoint()
+
+        except BaseException:
+            cpu.cycles = cycles
+            self.count = count
+            if self.dump_path:
+                self.dump(self.dump_path)
+            raise
+
+        cpu.cycles = cycles
+        self.count = count
+        if not cpu.is_running and not cpu.idle and \
+                not cpu.timer_written and self.dump_path:
+            self.dump(self.dump_path)
+
+    def records(self):
+        """
+        Return (base snapshot, record bytes) covering everything since the
+        oldest checkpoint, oldest record first.
+        """
+
+        first, base = self.checkpoints[0]
+        n = self.count - first
+        start = (first % self.capacity) * RECORD_SIZE
+        size = n * RECORD_SIZE
+
+        if start + size <= len(self.buf):
+            data = bytes(self.buf[start:start + size])
+        else:
+            data = bytes(self.buf[start:]) + \
+                bytes(self.buf[:start + size - len(self.buf)])
+
+        return base, data
+
+    def dump(self, filename):
+        """Write the buffered records to a file."""
+
+        base, data = self.records()
+        with open(filename, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, RECORD_SIZE, 0,
+                                len(data) // RECORD_SIZE))
+            f.write(base)
+            f.write(data)
+
+
+def read_dump(filename):
+    """Read a dump file. Returns (base snapshot, list of records)."""
+
+    with open(filename, "rb") as f:
+        data = f.read()
+
+    magic, version, record_size, _, count = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError(f"{filename}: not an LS-8 trace")
+    if version != VERSION or record_size != RECORD_SIZE:
+        raise ValueError(f"{filename}: unsupported trace version {version}")
+
+    offset = HEADER.size
+    base = data[offset:offset + snapshot.SIZE]
+    offset += snapshot.SIZE
+
+    records = []
+    for i in range(count):
+        o = offset + i * RECORD_SIZE
+        pc, ir, a, b, fl, kind = RECORD.unpack_from(data, o)
+        regs = data[o + RECORD.size:o + RECORD_SIZE]
+        records.append((pc, ir, a, b, fl, kind, regs))
+
+    return base, records
+
+
+def format_record(i, record):
+    pc, ir, a, b, fl, kind, regs = record
+    regs = " ".join("%02X" % r for r in regs)
+
+    if kind == KIND_INTERRUPT:
+        return f"{i:>8}  INT I{a} -> {pc:02X}        FL {fl:03b} | {regs}"
+
+    return (f"{i:>8}  {pc:02X} | {ir:02X} {a:02X} {b:02X} "
+            f"{opcode_name(ir):<5} FL {fl:03b} | {regs}")
+
+
+def replay(base, records, step):
+    """
+    Rebuild the CPU state right after record number step by restoring the
+    base snapshot and re-executing each record. Raises ValueError if the
+    re-executed registers or FL stop matching the trace.
+    """
+
+    # cpu imports this module, so import it only when replaying
+    from cpu import CPU
+
+    cpu = CPU.from_snapshot(base, console=Console(collect=True),
+                            fuse=False)
+    cpu.is_running = True
+
+    for i, record in enumerate(records[:step + 1]):
+        pc, ir, a, b, fl, kind, regs = record
+
+        if kind == KIND_INTERRUPT:
+            # redo the external event, then the dispatch itself
+            if a == 1:
+                cpu.ram_write(KEY_ADDRESS, b)
+            cpu.reg[6] |= 1 << a
+            cpu.interrupt()
+
+        else:
+            if cpu.pc != pc:
+                raise ValueError(f"record {i}: PC is {cpu.pc:02X}, "
+                                 f"trace says {pc:02X}")
+            entry = cpu.decode(pc)
+            handler, operand_a, operand_b, add_to_pc, n = entry
+            handler(cpu, operand_a, operand_b)
+            cpu.pc = (cpu.pc + add_to_pc) & 0xFF
+            cpu.cycles += n
+
+        if bytes(cpu.reg) != regs or cpu.FL != fl:
+            raise ValueError(f"record {i}: replayed state does not match")
+
+    return cpu
+
+
+def main(argv):
+    args = argv[1:]
+    step = None
+
+    if "--replay" in args:
+        i = args.index("--replay")
+        step = int(args[i + 1])
+        del args[i:i + 2]
+
+    if len(args) != 1:
+        print("usage: tracer.py dumpfile [--replay STEP]", file=sys.stderr)
+        return 1
+
+    base, records = read_dump(args[0])
+
+    if step is None:
+        for i, record in enumerate(records):
+            print(format_record(i, record))
+        return 0
+
+    cpu = replay(base, records, step)
+    print(format_record(step, records[step]))
+    print(f"PC {cpu.pc:02X}  FL {cpu.FL:03b}  cycles {cpu.cycles}")
+    print("R " + " ".join("%02X" % r for r in cpu.reg))
+    for row in range(0, 256, 16):
+        print(f"{row:02X}: " + " ".join("%02X" % v
+                                        for v in cpu.ram[row:row + 16]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,327 @@
+"""
+Vectorised multi-instance engine.
+Holds N LS-8 CPUs as NumPy arrays and advances them in lockstep: on each
+step the running lanes are grouped by their current opcode and every
+group executes as one array operation. Lanes that halt or fault are
+masked out while the rest carry on.
+
+Requires NumPy. Interrupts are not delivered to vector lanes.
+"""
+
+import numpy as np
+
+from cpu import CPU, JUMPS
+from main_ops import (CALL, HLT, INT, IRET, JEQ, JGE, JGT, JLE, JLT, JMP,
+                      JNE, LD, LDI, POP, PRA, PRN, PUSH, RET, ST)
+from alu_ops import (ADD, AND, CMP, DEC, DIV, INC, MOD, MUL, NOT, OR, SHL,
+                     SHR, SUB, XOR)
+
+# Opcodes whose handlers never move the PC themselves get pc += size
+ADVANCE = np.array([0 if ir in JUMPS else (ir >> 6) + 1 for ir in range(256)],
+                   dtype=np.uint8)
+
+# Opcodes whose operand bytes name registers; a register number above 7
+# faults the lane the way it raises IndexError in CPU.run. Conditional
+# jumps only read their register when taken, so op_Jcc checks it.
+REG_A = np.zeros(256, dtype=bool)
+REG_B = np.zeros(256, dtype=bool)
+for ir in (ADD, AND, CMP, DEC, DIV, INC, MOD, MUL, NOT, OR, SHL, SHR, SUB,
+           XOR, CALL, INT, JMP, LD, LDI, POP, PRA, PRN, PUSH, ST):
+    REG_A[ir] = True
+    REG_B[ir] = (ir >> 6) == 2 and ir != LDI
+
+# FL bits tested by each conditional jump (JNE jumps when E is clear)
+JUMP_FLAGS = {
+    JEQ: 0b00000001,
+    JGE: 0b00000011,
+    JGT: 0b00000010,
+    JLE: 0b00000101,
+    JLT: 0b00000100,
+}
+
+
+def shift_count(s):
+    # shifting a byte by 8 or more always gives 0, so cap the count there
+    return np.minimum(s, 8).astype(np.uint16)
+
+
+class VectorCPU:
+    """N CPUs stored as arrays and run together."""
+
+    def __init__(self, n):
+        self.n = n
+        self.ram = np.zeros((n, 256), dtype=np.uint8)
+        self.reg = np.zeros((n, 8), dtype=np.uint8)
+        # same power on value as CPU
+        self.reg[:, 7] = 0xF0
+        self.pc = np.zeros(n, dtype=np.uint8)
+        self.FL = np.zeros(n, dtype=np.uint8)
+        self.cycles = np.zeros(n, dtype=np.int64)
+        self.running = np.ones(n, dtype=bool)
+        # lanes stopped by an error such as a divide by 0
+        self.faulted = np.zeros(n, dtype=bool)
+        # PRN/PRA output of each lane
+        self.output = [[] for _ in range(n)]
+
+        self.ops = {
+            ADD: self.op_ADD, AND: self.op_AND, CMP: self.op_CMP,
+            DEC: self.op_DEC, DIV: self.op_DIV, INC: self.op_INC,
+            MOD: self.op_MOD, MUL: self.op_MUL, NOT: self.op_NOT,
+            OR: self.op_OR, SHL: self.op_SHL, SHR: self.op_SHR,
+            SUB: self.op_SUB, XOR: self.op_XOR,
+            CALL: self.op_CALL, HLT: self.op_HLT, INT: self.op_INT,
+            IRET: self.op_IRET, JMP: self.op_JMP, LD: self.op_LD,
+            LDI: self.op_LDI, POP: self.op_POP, PRA: self.op_PRA,
+            PRN: self.op_PRN, PUSH: self.op_PUSH, RET: self.op_RET,
+            ST: self.op_ST,
+        }
+        for ir in JUMP_FLAGS:
+            self.ops[ir] = self.op_Jcc
+        self.ops[JNE] = self.op_Jcc
+
+    @classmethod
+    def from_cpu(cls, cpu, n):
+        """Make n lanes that all start from the state of a CPU."""
+
+        vcpu = cls(n)
+        vcpu.ram[:] = np.frombuffer(bytes(cpu.ram), dtype=np.uint8)
+        vcpu.reg[:] = np.frombuffer(bytes(cpu.reg), dtype=np.uint8)
+        vcpu.pc[:] = cpu.pc
+        vcpu.FL[:] = cpu.FL
+        return vcpu
+
+    @classmethod
+    def from_file(cls, filename, n):
+        """Make n lanes with a program loaded into each."""
+
+        cpu = CPU()
+        cpu.load(filename)
+        return cls.from_cpu(cpu, n)
+
+    def lane(self, i):
+        """Copy lane i out into a regular CPU."""
+
+        cpu = CPU()
+        cpu.ram[:] = self.ram[i].tobytes()
+        cpu.reg[:] = self.reg[i].tobytes()
+        cpu.pc = int(self.pc[i])
+        cpu.FL = int(self.FL[i])
+        cpu.cycles = int(self.cycles[i])
+        cpu.is_running = bool(self.running[i])
+        return cpu
+
+    def step(self):
+        """
+        Execute one instruction on every running lane.
+        Returns the number of lanes that ran.
+        """
+
+        lanes = np.flatnonzero(self.running)
+        if lanes.size == 0:
+            return 0
+
+        pc = self.pc[lanes]
+        ram = self.ram
+        ir = ram[lanes, pc]
+        a = ram[lanes, pc + np.uint8(1)]
+        b = ram[lanes, pc + np.uint8(2)]
+
+        bad = (REG_A[ir] & (a > 7)) | (REG_B[ir] & (b > 7))
+        if bad.any():
+            stopped = lanes[bad]
+            self.running[stopped] = False
+            self.faulted[stopped] = True
+            ok = ~bad
+            lanes, pc, ir, a, b = lanes[ok], pc[ok], ir[ok], a[ok], b[ok]
+            if lanes.size == 0:
+                return 0
+
+        # advance everything first; jump handlers overwrite their own lanes
+        self.pc[lanes] = pc + ADVANCE[ir]
+        self.cycles[lanes] += 1
+
+        if (ir == ir[0]).all():
+            # lanes still in lockstep: one group
+            groups = ((ir[0], slice(None)),)
+        else:
+            groups = ((op, ir == op) for op in np.unique(ir))
+
+        for op, sel in groups:
+            handler = self.ops.get(int(op))
+            if handler is not None:
+                handler(int(op), lanes[sel], a[sel], b[sel], pc[sel])
+
+        return lanes.size
+
+    def run(self, max_cycles=None):
+        """Step until every lane has stopped, or for max_cycles steps."""
+
+        steps = 0
+        while self.running.any():
+            if max_cycles is not None and steps >= max_cycles:
+                break
+            self.step()
+            steps += 1
+
+    # ALU operations; uint8 arithmetic wraps at 256 like & 0xFF
+
+    def op_ADD(self, op, lanes, a, b, pc):
+        reg = self.reg
+        reg[lanes, a] = reg[lanes, a] + reg[lanes, b]
+
+    def op_AND(self, op, lanes, a, b, pc):
+        reg = self.reg
+        reg[lanes, a] = reg[lanes, a] & reg[lanes, b]
+
+    def op_CMP(self, op, lanes, a, b, pc):
+        x = self.reg[lanes, a]
+        y = self.reg[lanes, b]
+        self.FL[lanes] = np.where(x == y, 1, np.where(x > y, 2, 4))
+
+    def op_DEC(self, op, lanes, a, b, pc):
+        self.reg[lanes, a] -= np.uint8(1)
+
+    def op_INC(self, op, lanes, a, b, pc):
+        self.reg[lanes, a] += np.uint8(1)
+
+    def fault(self, lanes, bad, pc):
+        """Stop the lanes where bad is set; returns the rest as a mask."""
+
+        if bad.any():
+            stopped = lanes[bad]
+            self.running[stopped] = False
+            self.faulted[stopped] = True
+            # leave the PC on the faulting instruction, which like in
+            # CPU.run doesn't count as executed
+            self.pc[stopped] = pc[bad]
+            self.cycles[stopped] -= 1
+        return ~bad
+
+    def fault_zero(self, lanes, y, pc):
+        """Stop the lanes that would divide by 0; returns the rest."""
+
+        return self.fault(lanes, y == 0, pc)
+
+    def op_DIV(self, op, lanes, a, b, pc):
+        ok = self.fault_zero(lanes, self.reg[lanes, b], pc)
+        lanes, a, b = lanes[ok], a[ok], b[ok]
+        reg = self.reg
+        reg[lanes, a] = reg[lanes, a] // reg[lanes, b]
+
+    def op_MOD(self, op, lanes, a, b, pc):
+        ok = self.fault_zero(lanes, self.reg[lanes, b], pc)
+        lanes, a, b = lanes[ok], a[ok], b[ok]
+        reg = self.reg
+        reg[lanes, a] = reg[lanes, a] % reg[lanes, b]
+
+    def op_MUL(self, op, lanes, a, b, pc):
+        reg = self.reg
+        reg[lanes, a] = reg[lanes, a] * reg[lanes, b]
+
+    def op_NOT(self, op, lanes, a, b, pc):
+        self.reg[lanes, a] ^= np.uint8(0xFF)
+
+    def op_OR(self, op, lanes, a, b, pc):
+        reg = self.reg
+        reg[lanes, a] = reg[lanes, a] | reg[lanes, b]
+
+    def op_SHL(self, op, lanes, a, b, pc):
+        reg = self.reg
+        x = reg[lanes, a].astype(np.uint16)
+        reg[lanes, a] = (x << shift_count(reg[lanes, b])) & 0xFF
+
+    def op_SHR(self, op, lanes, a, b, pc):
+        reg = self.reg
+        x = reg[lanes, a].astype(np.uint16)
+        reg[lanes, a] = x >> shift_count(reg[lanes, b])
+
+    def op_SUB(self, op, lanes, a, b, pc):
+        reg = self.reg
+        reg[lanes, a] = reg[lanes, a] - reg[lanes, b]
+
+    def op_XOR(self, op, lanes, a, b, pc):
+        reg = self.reg
+        reg[lanes, a] = reg[lanes, a] ^ reg[lanes, b]
+
+    # main operations
+
+    def op_HLT(self, op, lanes, a, b, pc):
+        self.running[lanes] = False
+
+    def op_LDI(self, op, lanes, a, b, pc):
+        self.reg[lanes, a] = b
+
+    def op_LD(self, op, lanes, a, b, pc):
+        reg = self.reg
+        reg[lanes, a] = self.ram[lanes, reg[lanes, b]]
+
+    def op_ST(self, op, lanes, a, b, pc):
+        reg = self.reg
+        self.ram[lanes, reg[lanes, a]] = reg[lanes, b]
+
+    def op_PRN(self, op, lanes, a, b, pc):
+        for lane, value in zip(lanes.tolist(), self.reg[lanes, a].tolist()):
+            self.output[lane].append(f"{value}\n")
+
+    def op_PRA(self, op, lanes, a, b, pc):
+        for lane, value in zip(lanes.tolist(), self.reg[lanes, a].tolist()):
+            self.output[lane].append(f"{chr(value)}\n")
+
+    def push(self, lanes, values):
+        reg = self.reg
+        sp = reg[lanes, 7] - np.uint8(1)
+        reg[lanes, 7] = sp
+        self.ram[lanes, sp] = values
+
+    def pop(self, lanes):
+        reg = self.reg
+        sp = reg[lanes, 7]
+        reg[lanes, 7] = sp + np.uint8(1)
+        return self.ram[lanes, sp]
+
+    def op_PUSH(self, op, lanes, a, b, pc):
+        self.push(lanes, self.reg[lanes, a])
+
+    def op_POP(self, op, lanes, a, b, pc):
+        # same order as handle_POP: write the register, then move SP
+        reg = self.reg
+        value = self.ram[lanes, reg[lanes, 7]]
+        reg[lanes, a] = value
+        reg[lanes, 7] += np.uint8(1)
+
+    def op_CALL(self, op, lanes, a, b, pc):
+        target = self.reg[lanes, a]
+        self.push(lanes, pc + np.uint8(2))
+        self.pc[lanes] = target
+
+    def op_RET(self, op, lanes, a, b, pc):
+        self.pc[lanes] = self.pop(lanes)
+
+    def op_INT(self, op, lanes, a, b, pc):
+        reg = self.reg
+        bit = (np.uint16(1) << shift_count(reg[lanes, a])) & 0xFF
+        reg[lanes, 6] |= bit.astype(np.uint8)
+
+    def op_IRET(self, op, lanes, a, b, pc):
+        # R6-R0, then FL, then the return address
+        for r in range(6, -1, -1):
+            self.reg[lanes, r] = self.pop(lanes)
+        self.FL[lanes] = self.pop(lanes)
+        self.pc[lanes] = self.pop(lanes)
+
+    def op_JMP(self, op, lanes, a, b, pc):
+        self.pc[lanes] = self.reg[lanes, a]
+
+    def op_Jcc(self, op, lanes, a, b, pc):
+        fl = self.FL[lanes]
+        if op == JNE:
+            taken = (fl & 1) == 0
+        else:
+            taken = (fl & JUMP_FLAGS[op]) != 0
+        ok = self.fault(lanes, taken & (a > 7), pc)
+        lanes, a, pc, taken = lanes[ok], a[ok], pc[ok], taken[ok]
+        # only taken lanes read their register, which may not exist
+        # for the others
+        target = pc + np.uint8(2)
+        target[taken] = self.reg[lanes[taken], a[taken]]
+        self.pc[lanes] = target